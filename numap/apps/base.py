@@ -3,18 +3,27 @@ nümap applications should subclass the NumapApp.
 '''
 import sys
 import os
+import time
 import importlib
 import logging
 import docopt
 
 # TODO: replace FaceDancerPhy with just FaceDancerApp
 from facedancer import FacedancerUSBApp
-from numap.utils.ulogger import set_default_handler_level
+from numap.utils.ulogger import set_default_handler_level, start_queue_logging, add_ring_buffer
+from numap.fuzz.helpers import AppMode, set_app_mode
+from numap.phy.vhost import get_virtual_host_phy
+from numap.phy.usbmon import trace_phy
+from numap.utils.latency import LatencyRecorder
 
 
 class NumapApp(object):
 
+    #: how the @mutable stages are used by this app (see :class:`~numap.fuzz.helpers.AppMode`)
+    mode = AppMode.emulate
+
     def __init__(self, docstring=None):
+        set_app_mode(self.mode)
         if docstring is not None:
             self.options = docopt.docopt(docstring)
         else:
@@ -34,11 +43,23 @@ class NumapApp(object):
         }
         self.umap_classes = sorted(self.umap_class_dict.keys())
         self.logger = self.get_logger()
+        self.latency_recorder = self.get_latency_recorder()
         self.num_processed = 0
         self.fuzzer = None
         self.setup_packet_received = False
 
     def get_logger(self):
+        '''
+        Set up the numap logger from the -v/-q options:
+
+        - default: info, written from the calling thread
+        - -q: warnings and errors only, written from the calling thread
+        - -v / -vv: debug / verbose, formatted and written by a background thread
+        - -vvv: like -vv, and the most recent records are also kept in a
+          binary ring buffer, written to numap_<time>.logring at exit
+
+        :return: the numap logger
+        '''
         levels = {
             0: logging.INFO,
             1: logging.DEBUG,
@@ -53,11 +74,39 @@ class NumapApp(object):
             set_default_handler_level(logging.VERBOSE)
         if self.options.get('--quiet', False):
             set_default_handler_level(logging.WARNING)
+        elif verbose > 0:
+            start_queue_logging()
+            if verbose > 2:
+                ring_file = 'numap_%s.logring' % time.strftime('%Y%m%d%H%M%S', time.localtime())
+                add_ring_buffer(ring_file)
+                logger.info('Keeping recent log records in %s' % ring_file)
         return logger
 
+    def get_latency_recorder(self):
+        '''
+        Start timing the device handlers if requested with --latency
+
+        :return: the :class:`~numap.utils.latency.LatencyRecorder`, None if not requested
+        '''
+        filename = self.options.get('--latency')
+        if not filename:
+            return None
+        recorder = LatencyRecorder(filename)
+        recorder.start()
+        self.logger.info('Recording handler latency to %s (dump it with SIGUSR1)' % filename)
+        return recorder
+
     def load_phy(self, phy_string):
-        # TODO: support options; bring GadgetFS into FaceDancer2?
-        return FacedancerUSBApp()
+        if phy_string and phy_string.startswith('vhost'):
+            phy = get_virtual_host_phy(self, phy_string)
+        else:
+            # TODO: support options; bring GadgetFS into FaceDancer2?
+            phy = FacedancerUSBApp()
+        pcap_file = self.options.get('--pcap')
+        if pcap_file:
+            self.logger.info('Tracing the USB transfers to %s' % pcap_file)
+            phy = trace_phy(phy, pcap_file)
+        return phy
 
     def load_device(self, dev_name, phy):
         if dev_name in self.umap_classes:
@@ -73,17 +122,40 @@ class NumapApp(object):
             sys.path.insert(0, dirpath)
             module = __import__(modulename, globals(), locals(), [], -1)
         usb_device = module.usb_device
-        kwargs = self.get_user_device_kwargs()
+        kwargs = self.get_user_device_kwargs(dev_name)
         dev = usb_device(self, phy, **kwargs)
         return dev
 
-    def get_user_device_kwargs(self):
+    def get_user_device_kwargs(self, dev_name=None):
         '''
         if user provides values for the device, get them here
+
+        :param dev_name: device class (default: None)
         '''
         kwargs = {}
         self.update_from_user_param('--vid', 'vid', kwargs, 'int')
         self.update_from_user_param('--pid', 'pid', kwargs, 'int')
+        disk = self.options.get('--disk')
+        if (disk or self.options.get('--overlay')) and dev_name != 'mass_storage':
+            raise Exception('--disk and --overlay are only supported by the mass_storage device class, not %s' % dev_name)
+        if disk:
+            backend, _, arg = disk.partition(':')
+            kwargs['disk_backend'] = backend
+            if backend == 'sparse':
+                kwargs['disk_size'] = arg
+            elif backend == 'vfat':
+                # vfat:DIRECTORY[:SIZE]
+                directory, sep, size = arg.rpartition(':')
+                if sep and size[:1].isdigit():
+                    kwargs['disk_image_filename'] = directory
+                    kwargs['disk_size'] = size
+                else:
+                    kwargs['disk_image_filename'] = arg
+            else:
+                kwargs['disk_image_filename'] = arg
+        if self.options.get('--overlay'):
+            kwargs['overlay'] = True
+            kwargs['overlay_delta_filename'] = self.options.get('--overlay-delta')
         return kwargs
 
     def update_from_user_param(self, flag, arg_name, kwargs, type):
@@ -122,3 +194,13 @@ class NumapApp(object):
         mutation is only needed when fuzzing
         '''
         return None
+
+    def should_cache_descriptors(self):
+        '''
+        Devices may cache the descriptors they render only when emulating.
+        When fuzzing or recording stages, each descriptor request should
+        reach the @mutable handlers.
+
+        :return: whether devices may serve descriptors from a cache
+        '''
+        return self.mode == AppMode.emulate
@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+'''
+Benchmark the emulation hot paths, no USB hardware needed
+(the devices are served to the in-process virtual host, see numap.phy.vhost)
+
+Usage:
+    numapbench [-b=BENCHMARK ...] [-C=DEVICE_CLASS ...] [-H=HOST] [-d=SECONDS] [-o=OUTPUT] [-c=BASE] [-v ...]
+    numapbench --list
+
+Options:
+    -b --benchmark BENCHMARK    benchmark to run, may be repeated (default: all of them)
+    -C --class DEVICE_CLASS     device class of the per class benchmarks, may be repeated (default: all classes)
+    -H --host HOST              virtual host personality of the enumeration benchmark [default: linux]
+    -d --duration SECONDS       how long to run each measurement [default: 0.5]
+    -o --output OUTPUT          write the results to a JSON file
+    -c --compare BASE           compare the results to those of a previous run (JSON file)
+    -v --verbose                verbosity level
+    --list                      list the benchmarks
+
+Benchmarks:
+    descriptors         render the device and configuration descriptors of each class
+    request_parsing     parse setup packets into USBDeviceRequest
+    mutable             overhead of a @mutable stage, emulating and fuzzing (no fuzzer attached)
+    class_dispatch      class requests, through USBClass._global_handler and through the device routes
+    scsi                READ(10) and WRITE(10) of 8 blocks through ScsiDevice
+    disk_backends       sequential READ(10) of 128 blocks through ScsiDevice, read back in bulk packets, for each disk backend
+                        (the chunked image with a cache of the whole image, and of 2 chunks)
+    enumeration         full enumeration sessions of the virtual host for each class
+
+Examples:
+    save a baseline:
+        numapbench -o base.json
+    compare to it:
+        numapbench -o new.json -c base.json
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import struct
+import logging
+import platform
+import tempfile
+import importlib
+import traceback
+from numap.apps.base import NumapApp
+from numap.dev.mass_storage import ScsiDevice, DiskImage, FileDiskImage, USBMassStorageInterface
+from numap.dev.chunked_image import ChunkedDiskImage, pack_image
+from numap.core.usb import DescriptorType
+from numap.core.usb_class import USBClass
+from numap.core.usb_device import USBDeviceRequest
+from numap.fuzz.helpers import AppMode, set_app_mode
+from numap.phy.vhost import VirtualHostPhy
+from numap.phy.hosts import hosts
+from numap.utils.ulogger import set_default_handler_level
+
+
+def measure(func, duration, unit_bytes=0):
+    '''
+    Call a function repeatedly for (at least) a given time
+
+    :param func: function to call
+    :param duration: time to spend, in seconds
+    :param unit_bytes: bytes processed by each call, to report the throughput (default: 0)
+    :return: dictionary of the results
+    '''
+    func()
+    count = 0
+    batch = 1
+    start = time.time()
+    elapsed = 0
+    while elapsed < duration:
+        for _ in range(batch):
+            func()
+        count += batch
+        batch = min(batch * 2, 1000)
+        elapsed = time.time() - start
+    result = {
+        'iterations': count,
+        'seconds': elapsed,
+        'per_sec': count / elapsed,
+        'usec': elapsed * 1e6 / count,
+    }
+    if unit_bytes:
+        result['mb_per_sec'] = unit_bytes * count / elapsed / (1024 * 1024)
+    return result
+
+
+def build_cbw(tag, cdb, length, direction_in):
+    return struct.pack(
+        '<4sIIBBB', b'USBC', tag, length, 0x80 if direction_in else 0x00, 0, len(cdb)
+    ) + cdb.ljust(16, b'\x00')
+
+
+class NumapBenchApp(NumapApp):
+
+    benchmarks = ['descriptors', 'request_parsing', 'mutable', 'class_dispatch', 'scsi', 'disk_backends', 'enumeration']
+    disk_image_size = 4 * 1024 * 1024
+    scsi_blocks = 8
+    disk_read_blocks = 128
+
+    def __init__(self, options):
+        super(NumapBenchApp, self).__init__(options)
+        self.duration = float(self.options['--duration'])
+        self.classes = self.options['--class'] or [c for c in self.umap_classes if c != 'mtp']
+        self.results = {}
+        self.tmp_dir = None
+
+    def get_logger(self):
+        logger = super(NumapBenchApp, self).get_logger()
+        if not self.options.get('--verbose'):
+            # the device logs would be measured as well,
+            # and the virtual host sends requests that some devices do not support
+            set_default_handler_level(logging.ERROR)
+        return logger
+
+    def get_disk_image(self):
+        '''
+        :return: path of a temporary disk image for the mass storage device
+        '''
+        if self.tmp_dir is None:
+            self.tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(self.tmp_dir, 'bench.img')
+        with open(path, 'wb') as f:
+            f.truncate(self.disk_image_size)
+        return path
+
+    def create_device(self, dev_name, phy):
+        module = importlib.import_module('numap.dev.%s' % self.umap_class_dict[dev_name][0])
+        kwargs = {}
+        if dev_name == 'mass_storage':
+            kwargs['disk_image_filename'] = self.get_disk_image()
+        return module.usb_device(self, phy, **kwargs)
+
+    def get_phy(self, sessions=0):
+        return VirtualHostPhy(self, hosts[self.options['--host']](), sessions)
+
+    def add_result(self, name, result):
+        self.results[name] = result
+        line = '%-40s %12.2f us %14.1f /s' % (name, result['usec'], result['per_sec'])
+        if 'mb_per_sec' in result:
+            line += ' %10.1f MB/s' % result['mb_per_sec']
+        self.logger.always(line)
+
+    def per_class(self, name, bench):
+        '''
+        Run a benchmark for each class, a failing class is reported and skipped
+        '''
+        for dev_name in self.classes:
+            try:
+                bench(name, dev_name)
+            except Exception:
+                self.logger.error('%s/%s failed:\n%s' % (name, dev_name, traceback.format_exc()))
+                self.results['%s/%s' % (name, dev_name)] = {'error': traceback.format_exc().splitlines()[-1]}
+
+    # benchmarks
+
+    def bench_descriptors(self):
+        set_app_mode(AppMode.emulate)
+        self.per_class('descriptors', self._bench_descriptors)
+
+    def _bench_descriptors(self, name, dev_name):
+        dev = self.create_device(dev_name, self.get_phy())
+
+        def render():
+            dev.get_descriptor_by_type(DescriptorType.device, 0)
+            dev.get_descriptor_by_type(DescriptorType.configuration, 0)
+        self.add_result('%s/%s' % (name, dev_name), measure(render, self.duration))
+        dev.disconnect()
+
+    def bench_request_parsing(self):
+        setup = struct.pack('<BBHHH', 0x80, 6, 0x0200, 0, 0xff)
+
+        def parse():
+            req = USBDeviceRequest(setup)
+            req.get_type()
+            req.get_recipient()
+            return req.value, req.index, req.length, req.data
+        self.add_result('request_parsing', measure(parse, self.duration))
+
+    def bench_mutable(self):
+        dev = self.create_device('keyboard', self.get_phy())
+        for mode in [AppMode.emulate, AppMode.fuzz]:
+            set_app_mode(mode)
+            self.add_result('mutable/%s' % mode, measure(dev.get_descriptor, self.duration))
+        set_app_mode(self.mode)
+        dev.disconnect()
+
+    def bench_class_dispatch(self):
+        set_app_mode(AppMode.emulate)
+        self.per_class('class_dispatch', self._bench_class_dispatch)
+
+    def _bench_class_dispatch(self, name, dev_name):
+        phy = self.get_phy()
+        dev = self.create_device(dev_name, phy)
+        dev.connect()
+        phy.control_transfer(0x00, 9, 1, 0, 0)
+        found = self.find_class_request(dev)
+        if found is None:
+            self.logger.info('%s: no class requests to benchmark' % dev_name)
+            dev.disconnect()
+            return
+        usb_class, setup = found
+        req = USBDeviceRequest(setup)
+        self.add_result('%s/%s/global_handler' % (name, dev_name), measure(lambda: usb_class._global_handler(req), self.duration))
+        self.add_result('%s/%s/routed' % (name, dev_name), measure(lambda: dev.handle_request(setup), self.duration))
+        dev.disconnect()
+
+    def find_class_request(self, dev):
+        '''
+        :return: (class, setup packet) of the first class request that the device handles
+            with the default request values, None if there is none
+        '''
+        for interface in dev.configuration.interfaces:
+            usb_class = interface.usb_class
+            if not isinstance(usb_class, USBClass):
+                continue
+            for request in sorted(usb_class.local_handlers):
+                setup = struct.pack('<BBHHH', 0xa1, request, 0, interface.number, 64)
+                try:
+                    usb_class._global_handler(USBDeviceRequest(setup))
+                except Exception:
+                    continue
+                return usb_class, setup
+        return None
+
+    def bench_scsi(self):
+        set_app_mode(AppMode.emulate)
+        dev = self.create_device('mass_storage', self.get_phy())
+        scsi = dev.scsi_device
+        block_size = dev.disk_image.block_size
+        length = self.scsi_blocks * block_size
+        read_cbw = build_cbw(1, struct.pack('>BBIBHB', 0x28, 0, 8, 0, self.scsi_blocks, 0), length, True)
+        write_cbw = build_cbw(2, struct.pack('>BBIBHB', 0x2a, 0, 8, 0, self.scsi_blocks, 0), length, False)
+        payload = b'\xa5' * length
+
+        def drain():
+            while scsi.get_data() is not None:
+                pass
+
+        def read_10():
+            scsi.handle_data(read_cbw)
+            drain()
+
+        def write_10():
+            scsi.handle_data(write_cbw)
+            scsi.handle_data(payload)
+            drain()
+        self.add_result('scsi/read_10', measure(read_10, self.duration, length))
+        self.add_result('scsi/write_10', measure(write_10, self.duration, length))
+        dev.disconnect()
+
+    def bench_disk_backends(self):
+        set_app_mode(AppMode.emulate)
+        raw_image = self.get_disk_image()
+        with open(raw_image, 'wb') as f:
+            # half random, half zeros: compresses to about 50%
+            for _ in range(self.disk_image_size // 4096):
+                f.write(os.urandom(2048) + b'\x00' * 2048)
+        chunked_image = os.path.join(self.tmp_dir, 'bench.nzi')
+        pack_image(raw_image, chunked_image)
+        backends = [
+            ('mmap', lambda: DiskImage(raw_image, 0x200)),
+            ('file', lambda: FileDiskImage(raw_image, 0x200)),
+            ('chunked', lambda: ChunkedDiskImage(chunked_image, 0x200)),
+            ('chunked_cache_2', lambda: ChunkedDiskImage(chunked_image, 0x200, cache_chunks=2)),
+        ]
+        for name, create in backends:
+            disk_image = create()
+            try:
+                self._bench_disk_backend('disk_backends/read_10/%s' % name, disk_image)
+            finally:
+                disk_image.close()
+
+    def _bench_disk_backend(self, name, disk_image):
+        scsi = ScsiDevice(self, disk_image)
+        scsi.stop()
+        length = self.disk_read_blocks * disk_image.block_size
+        cbws = [
+            build_cbw(1, struct.pack('>BBIBHB', 0x28, 0, lba, 0, self.disk_read_blocks, 0), length, True)
+            for lba in range(0, disk_image.num_blocks - self.disk_read_blocks + 1, self.disk_read_blocks)
+        ]
+        position = [0]
+        max_packet_size = USBMassStorageInterface.max_packet_size
+
+        def read_10():
+            # sequential reads over the whole image
+            scsi.handle_data(cbws[position[0]])
+            position[0] = (position[0] + 1) % len(cbws)
+            # the response is read in packets, as the phy sends it
+            packet = scsi.get_packet(max_packet_size)
+            while packet is not None:
+                bytes(packet)
+                packet = scsi.get_packet(max_packet_size)
+        self.add_result(name, measure(read_10, self.duration, length))
+
+    def bench_enumeration(self):
+        set_app_mode(AppMode.emulate)
+        self.per_class('enumeration', self._bench_enumeration)
+
+    def _bench_enumeration(self, name, dev_name):
+        phy = self.get_phy()
+        dev = self.create_device(dev_name, phy)
+
+        def enumerate_device():
+            dev.connect()
+            phy.service_irqs()
+        self.add_result('%s/%s' % (name, dev_name), measure(enumerate_device, self.duration))
+        dev.disconnect()
+
+    # results
+
+    def compare(self, base_file):
+        with open(base_file, 'r') as f:
+            base = json.load(f)['results']
+        self.logger.always('%-40s %12s %12s %8s' % ('benchmark', 'base (us)', 'now (us)', 'change'))
+        for name in sorted(self.results):
+            if 'usec' not in self.results[name] or 'usec' not in base.get(name, {}):
+                continue
+            before = base[name]['usec']
+            after = self.results[name]['usec']
+            self.logger.always('%-40s %12.2f %12.2f %+7.1f%%' % (name, before, after, (after - before) * 100.0 / before))
+
+    def save(self, filename):
+        report = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime()),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'duration': self.duration,
+            'host': self.options['--host'],
+            'results': self.results,
+        }
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    def run(self):
+        if self.options['--list']:
+            for name in self.benchmarks:
+                print(name)
+            return
+        names = self.options['--benchmark'] or self.benchmarks
+        for name in names:
+            if name not in self.benchmarks:
+                raise Exception('Unknown benchmark %s, use one of: %s' % (name, ', '.join(self.benchmarks)))
+        if self.options['--host'] not in hosts:
+            raise Exception('Unknown virtual host %s, use one of: %s' % (self.options['--host'], ', '.join(sorted(hosts))))
+        try:
+            for name in names:
+                getattr(self, 'bench_%s' % name)()
+        finally:
+            if self.tmp_dir:
+                shutil.rmtree(self.tmp_dir)
+        if self.options['--output']:
+            self.save(self.options['--output'])
+        if self.options['--compare']:
+            self.compare(self.options['--compare'])
+
+
+def main():
+    app = NumapBenchApp(__doc__)
+    app.run()
+
+
+if __name__ == '__main__':
+    main()
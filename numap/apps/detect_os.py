@@ -3,16 +3,19 @@ Try to detect OS based on the USB traffic.
 Not implemented yet.
 
 Usage:
-    numapdetect [-P=PHY_INFO] [-q] [-v ...]
+    numapdetect [-P=PHY_INFO] [-q] [--pcap=PCAP_FILE] [-v ...]
 
 Options:
     -P --phy PHY_INFO           physical layer info, see list below
     -v --verbose                verbosity level
     -q --quiet                  quiet mode. only print warning/error messages
+    --pcap PCAP_FILE            trace the USB transfers to a pcap file (usbmon format, for Wireshark)
 
 Physical layer:
     fd:<serial_port>        use facedancer connected to given serial port
     gadgetfs                use gadgetfs (requires mounting of gadgetfs beforehand)
+    vhost[:HOST[:SESSIONS]] virtual USB host in this process, HOST is linux (default), windows or macos,
+                            the device stops after SESSIONS enumerations (default: 1, 0: never)
 
 Example:
     numapdetect -P fd:/dev/ttyUSB0 -q
@@ -3,19 +3,31 @@
 Emulate a USB device
 
 Usage:
-    numapemulate -C=DEVICE_CLASS [-P=PHY_INFO] [-q] [--vid=VID] [--pid=PID] [-v ...]
+    numapemulate -C=DEVICE_CLASS [-P=PHY_INFO] [-q] [--vid=VID] [--pid=PID] [--latency=FILE] [--disk=DISK] [--overlay] [--overlay-delta=DELTA_FILE] [--pcap=PCAP_FILE] [-v ...]
 
 Options:
     -P --phy PHY_INFO           physical layer info, see list below [default: auto]
     -C --class DEVICE_CLASS     class of the device or path to python file with device class
     -v --verbose                verbosity level
     -q --quiet                  quiet mode. only print warning/error messages
+    --pcap PCAP_FILE            trace the USB transfers to a pcap file (usbmon format, for Wireshark)
     --vid VID                   override vendor ID
     --pid PID                   override product ID
+    --latency FILE              record handler latency histograms, written at exit and on SIGUSR1
+                                (Prometheus text format if FILE ends with .prom, JSON otherwise)
+    --disk DISK                 mass storage: disk backend, mmap:FILE (default: mmap:stick.img), file:FILE,
+                                sparse:SIZE for an empty disk of any size (e.g. sparse:64G),
+                                vfat:DIRECTORY[:SIZE] for a FAT32 disk with the files of DIRECTORY,
+                                or chunked:FILE for a compressed image (see numap-image)
+    --overlay                   mass storage: do not modify the disk image,
+                                drop the writes of the host when it enumerates the device again
+    --overlay-delta DELTA_FILE  mass storage: with --overlay, append the writes of each session to DELTA_FILE
 
 Physical layer:
     fd:<serial_port>        use facedancer connected to given serial port
     gadgetfs                use gadgetfs (requires mounting of gadgetfs beforehand)
+    vhost[:HOST[:SESSIONS]] virtual USB host in this process, HOST is linux (default), windows or macos,
+                            the device stops after SESSIONS enumerations (default: 1, 0: never)
     auto                    automatically detect how we should connect
 
 Examples:
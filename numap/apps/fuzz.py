@@ -3,7 +3,8 @@
 Emulate a USB device to be used for fuzzing
 
 Usage:
-    numapfuzz-C=DEVICE_CLASS [-P=PHY_INFO]  [-q] [--vid=VID] [--pid=PID] [-i=FUZZER_IP] [-p FUZZER_PORT] [-v ...]
+    numapfuzz -C=DEVICE_CLASS [-P=PHY_INFO]  [-q] [--vid=VID] [--pid=PID] [--latency=FILE] [--disk=DISK] [--overlay] [--overlay-delta=DELTA_FILE] [-i=FUZZER_IP] [-p FUZZER_PORT] [-t=TRIGGER_MODE] [--pcap=PCAP_FILE] [-v ...]
+    numapfuzz --local -C=DEVICE_CLASS -s=STAGE_FILE [-P=PHY_INFO] [-q] [--vid=VID] [--pid=PID] [--latency=FILE] [--disk=DISK] [--overlay] [--overlay-delta=DELTA_FILE] [-c=COUNT] [-k=KITTY_OPTIONS] [--corpus=CORPUS_FILE] [--pcap=PCAP_FILE] [-v ...]
 
 Options:
     -P --phy PHY_INFO           physical layer info, see list below
@@ -11,98 +12,201 @@ Options:
     -v --verbose                verbosity level
     -i --fuzzer-ip HOST         hostname or IP of the fuzzer [default: 127.0.0.1]
     -p --fuzzer-port PORT       port of the fuzzer [default: 26007]
+    -t --trigger TRIGGER_MODE   how the fuzzer signals disconnect/reconnect, socket or file [default: socket]
+    --local                     run the kitty fuzzer in this process instead of connecting to numapkitty
+    -s --stage-file STAGE_FILE  local fuzzer: path to stage trace from umap emulation run
+    -c --count COUNT            local fuzzer: stage count (e.g. how many times a stage might repeat
+                                before mutating) [default: 2]
+    -k --kitty-options KITTY_OPTIONS    local fuzzer: options for the kitty fuzzer, use -k -h to get a full list
+    --corpus CORPUS_FILE        local fuzzer: serve the mutations from a pre-rendered corpus (see numap-corpus)
     -q --quiet                  quiet mode. only print warning/error messages
+    --pcap PCAP_FILE            trace the USB transfers to a pcap file (usbmon format, for Wireshark)
     --vid VID                   override vendor ID
     --pid PID                   override product ID
+    --latency FILE              record handler latency histograms, written at exit and on SIGUSR1
+                                (Prometheus text format if FILE ends with .prom, JSON otherwise)
+    --disk DISK                 mass storage: disk backend, mmap:FILE (default: mmap:stick.img), file:FILE,
+                                sparse:SIZE for an empty disk of any size (e.g. sparse:64G),
+                                vfat:DIRECTORY[:SIZE] for a FAT32 disk with the files of DIRECTORY,
+                                or chunked:FILE for a compressed image (see numap-image)
+    --overlay                   mass storage: do not modify the disk image,
+                                drop the writes of the host when it enumerates the device again
+    --overlay-delta DELTA_FILE  mass storage: with --overlay, append the writes of each session to DELTA_FILE
 
 Physical layer:
     fd:<serial_port>        use facedancer connected to given serial port
     gadgetfs                use gadgetfs (requires mounting of gadgetfs beforehand)
+    vhost[:HOST[:SESSIONS]] virtual USB host in this process, HOST is linux (default), windows or macos,
+                            the device stops after SESSIONS enumerations (default: 1, 0: never)
 
 Examples:
     emulate disk-on-key:
         numapfuzz -P fd:/dev/ttyUSB1 -C mass_storage
+    fuzz disk-on-key without numapkitty:
+        numapfuzz --local -P fd:/dev/ttyUSB1 -C mass_storage -s mass_storage.stages
 '''
-import os
-import time
+from threading import Thread
 from kitty.remote.rpc import RpcClient
 from numap.apps.emulate import NumapEmulationApp
+from numap.fuzz.helpers import AppMode
+from numap.fuzz.controller import UmapController
+from numap.fuzz.triggers import Command, QueueTriggerReceiver, trigger_receivers
 
 
 class NumapFuzzApp(NumapEmulationApp):
 
+    mode = AppMode.fuzz
+
     def __init__(self, options):
         super(NumapFuzzApp, self).__init__(options)
         self.count = 0
+        trigger_mode = self.options['--trigger']
+        if trigger_mode not in trigger_receivers:
+            raise Exception('Unknown trigger mode %s, use one of: %s' % (trigger_mode, ', '.join(sorted(trigger_receivers))))
+        self.triggers = trigger_receivers[trigger_mode]()
+        # mutations of the current test, fetched from the fuzzer on the first stage hit
+        self.prefetch = True
+        self.test_mutations = None
+        self.test_stages = []
+        self.test_mutation_served = False
+        self.stop_requested = False
+
+    def run(self):
+        super(NumapFuzzApp, self).run()
+        if self.options.get('--local') and self.fuzzer:
+            self.fuzzer.stop()
 
     def get_fuzzer(self):
+        if self.options.get('--local'):
+            return self.get_local_fuzzer()
         fuzzer = RpcClient(
             host=self.options['--fuzzer-ip'],
             port=int(self.options['--fuzzer-port'])
         )
         fuzzer.start()
+        self.triggers.open()
+        return fuzzer
+
+    def get_local_fuzzer(self):
+        '''
+        Run the kitty fuzzer in this process.
+        Mutations are plain function calls and the disconnect/reconnect
+        triggers are passed through queues to the phy loop.
+
+        :return: the started fuzzer
+        '''
+        # building the model loads all the templates, only do it when fuzzing locally
+        from numap.fuzz.fuzz_engine import get_fuzzer
+        controller = UmapController(trigger_mode='local')
+        self.triggers = QueueTriggerReceiver(controller.triggers)
+        fuzzer = get_fuzzer(
+            {
+                '--stage-file': self.options['--stage-file'],
+                '--count': self.options['--count'],
+                '--kitty-options': self.options['--kitty-options'],
+                '--corpus': self.options['--corpus'],
+            },
+            controller
+        )
+        fuzzer.start()
+        waiter = Thread(target=self._stop_when_done, args=(fuzzer, controller))
+        waiter.daemon = True
+        waiter.start()
         return fuzzer
 
+    def _stop_when_done(self, fuzzer, controller):
+        fuzzer.wait_until_done()
+        controller.trigger_stop()
+
     def should_stop_phy(self):
         self.count = (self.count + 1) % 50
         self.check_connection_commands()
         if self.count == 0:
             self.send_heartbeat()
-        return False
+        return self.stop_requested
 
     def send_heartbeat(self):
-        heartbeat_file = '/tmp/umap_kitty/heartbeat'
-        if os.path.isdir(os.path.dirname(heartbeat_file)):
-            with open(heartbeat_file, 'a'):
-                os.utime(heartbeat_file, None)
+        self.triggers.heartbeat()
 
     def check_connection_commands(self):
         '''
         :return: whether performed reconnection
         '''
-        if self._should_disconnect():
+        if not self.fuzzer:
+            return False
+        command = self.triggers.poll()
+        if command == Command.disconnect:
+            self.end_test()
             self.phy.disconnect()
-            self._clear_disconnect_trigger()
+            self.triggers.ack(command)
             # wait for reconnection request; no point in returning to service_irqs loop while not connected!
-            while not self._should_reconnect():
-                self._clear_disconnect_trigger()  # be robust to additional disconnect requests
-                time.sleep(0.1)
+            command = self.triggers.wait()
+            while command == Command.disconnect:
+                self.triggers.ack(command)  # be robust to additional disconnect requests
+                command = self.triggers.wait()
+        if command == Command.stop:
+            self.stop_requested = True
+            self.triggers.ack(command)
+            return False
         # now that we received a reconnect request, flow into the handling of it...
         # be robust to reconnection requests, whether received after a disconnect request, or standalone
         # (not sure this is right, might be better to *not* be robust in the face of possible misuse?)
-        if self._should_reconnect():
+        if command == Command.connect:
             self.phy.connect(self.dev)
-            self._clear_reconnect_trigger()
+            self.triggers.ack(command)
             return True
         return False
 
-    def _should_reconnect(self):
-        if self.fuzzer:
-            if os.path.isfile('/tmp/umap_kitty/trigger_reconnect'):
-                return True
-        return False
-
-    def _clear_reconnect_trigger(self):
-        trigger = '/tmp/umap_kitty/trigger_reconnect'
-        if os.path.isfile(trigger):
-            os.remove(trigger)
+    def end_test(self):
+        '''
+        Report the stages served in the current test and drop its mutations
+        '''
+        self.report_test_stages()
+        self.test_mutations = None
+        self.test_mutation_served = False
 
-    def _should_disconnect(self):
-        if self.fuzzer:
-            if os.path.isfile('/tmp/umap_kitty/trigger_disconnect'):
-                return True
-        return False
+    def report_test_stages(self):
+        '''
+        Let the fuzzer record the stages served from the fetched mutations
+        '''
+        if self.test_stages:
+            self.fuzzer.report_stages(stages=self.test_stages)
+            self.test_stages = []
 
-    def _clear_disconnect_trigger(self):
-        trigger = '/tmp/umap_kitty/trigger_disconnect'
-        if os.path.isfile(trigger):
-            os.remove(trigger)
+    def fetch_test_mutations(self):
+        '''
+        :return: dictionary of {stage: {'skip': hits to skip, 'payload': payload}}
+            for the current test, None if the fuzzer does not support it
+        '''
+        try:
+            return self.fuzzer.get_test_mutations() or {}
+        except Exception:
+            self.logger.warning('Fuzzer cannot send the test mutations, requesting a mutation on each stage')
+            self.prefetch = False
+            return None
 
     def get_mutation(self, stage, data=None):
-        if self.fuzzer:
-            data = {} if data is None else data
+        if not self.fuzzer:
+            return None
+        data = {} if data is None else data
+        if self.prefetch and not data and self.test_mutations is None:
+            self.test_mutations = self.fetch_test_mutations()
+        if data or not self.prefetch:
+            # mutations based on session data are rendered by the fuzzer on each hit,
+            # so first let it know about the stages served so far
+            self.report_test_stages()
             return self.fuzzer.get_mutation(stage=stage, data=data)
-        return None
+        self.test_stages.append(stage)
+        mutation = self.test_mutations.get(stage)
+        if mutation is None:
+            return None
+        if mutation['skip']:
+            mutation['skip'] -= 1
+            return None
+        if not self.test_mutation_served:
+            self.fuzzer.signal_test_mutation_served()
+            self.test_mutation_served = True
+        return mutation['payload']
 
 
 def main():
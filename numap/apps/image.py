@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+'''
+Pack raw disk images to the chunked, compressed format of the mass storage device, and back
+
+Usage:
+    numapimage pack [-c=CHUNK_SIZE] [-l=LEVEL] [-v ...] RAW_IMAGE IMAGE
+    numapimage unpack [-v ...] IMAGE RAW_IMAGE
+
+Options:
+    -c --chunk-size CHUNK_SIZE  chunk size, in bytes or with a K/M suffix [default: 64K]
+    -l --level LEVEL            zlib compression level, 1 (fastest) to 9 (smallest) [default: 6]
+    -v --verbose                verbosity level
+
+Examples:
+    compress an image:
+        numapimage pack stick.img stick.nzi
+    emulate it:
+        numapemulate -P fd:/dev/ttyUSB0 -C mass_storage --disk chunked:stick.nzi
+'''
+import time
+from numap.apps.base import NumapApp
+from numap.dev.mass_storage import parse_size
+from numap.dev.chunked_image import ChunkedDiskImage, pack_image
+
+
+class NumapImageApp(NumapApp):
+
+    def pack(self):
+        start = time.time()
+        raw_size, compressed_size = pack_image(
+            self.options['RAW_IMAGE'], self.options['IMAGE'],
+            parse_size(self.options['--chunk-size']), int(self.options['--level'])
+        )
+        self.logger.always('Packed %s (%d bytes) to %s (%d bytes, %.1f%%) in %.2f seconds' % (
+            self.options['RAW_IMAGE'], raw_size, self.options['IMAGE'], compressed_size,
+            compressed_size * 100.0 / raw_size if raw_size else 100.0, time.time() - start,
+        ))
+
+    def unpack(self):
+        start = time.time()
+        disk_image = ChunkedDiskImage(self.options['IMAGE'], 0x200)
+        disk_image.unpack(self.options['RAW_IMAGE'])
+        disk_image.close()
+        self.logger.always('Unpacked %s to %s (%d bytes) in %.2f seconds' % (
+            self.options['IMAGE'], self.options['RAW_IMAGE'], disk_image.image_size, time.time() - start,
+        ))
+
+    def run(self):
+        if self.options['pack']:
+            self.pack()
+        else:
+            self.unpack()
+
+
+def main():
+    app = NumapImageApp(__doc__)
+    app.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,36 +3,47 @@
 Prepare stages for USB fuzzing
 
 Usage:
-    numapstages -C=DEVICE_CLASS [-P=PHY_INFO] -s=FILE [-q] [--vid=VID] [--pid=PID] [-v ...]
+    numapstages -C=DEVICE_CLASS [-P=PHY_INFO] -s=FILE [-q] [--vid=VID] [--pid=PID] [--latency=FILE] [--pcap=PCAP_FILE] [-v ...]
 
 Options:
     -P --phy PHY_INFO       physical layer info, see list below
     -C --class DEVICE_CLASS class of the device or path to python file with device class
-    -s --stage-file FILE    file to store list of stages in
+    -s --stage-file FILE    file to store the stage trace in (see numap-stagetrace)
     -q --quiet              quiet mode. only print warning/error messages
+    --pcap PCAP_FILE        trace the USB transfers to a pcap file (usbmon format, for Wireshark)
     -v --verbose            verbosity level
     --vid VID               override vendor ID
     --pid PID               override product ID
+    --latency FILE          record handler latency histograms, written at exit and on SIGUSR1
+                            (Prometheus text format if FILE ends with .prom, JSON otherwise)
 
 Physical layer:
     fd:<serial_port>        use facedancer connected to given serial port
     gadgetfs                use gadgetfs (requires mounting of gadgetfs beforehand)
+    vhost[:HOST[:SESSIONS]] virtual USB host in this process, HOST is linux (default), windows or macos,
+                            the device stops after SESSIONS enumerations (default: 1, 0: never)
 '''
 import time
 from numap.apps.emulate import NumapEmulationApp
-from numap.fuzz.helpers import StageLogger, set_stage_logger
+from numap.fuzz.helpers import AppMode, StageLogger, set_stage_logger
 
 
 class NumapMakeStagesApp(NumapEmulationApp):
 
+    mode = AppMode.record_stages
+
     def load_device(self, dev_name, phy):
         self.start_time = time.time()
         self.stage_file_name = self.options['--stage-file']
-        stage_logger = StageLogger(self.stage_file_name)
-        stage_logger.start()
-        set_stage_logger(stage_logger)
+        self.stage_logger = StageLogger(self.stage_file_name)
+        self.stage_logger.start()
+        set_stage_logger(self.stage_logger)
         return super(NumapMakeStagesApp, self).load_device(dev_name, phy)
 
+    def run(self):
+        super(NumapMakeStagesApp, self).run()
+        self.stage_logger.stop()
+
     def should_stop_phy(self):
         stop_phy = False
         passed = int(time.time() - self.start_time)
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+'''
+Replay the host side of a usbmon capture against an emulated device, no USB hardware needed.
+
+The SETUP and OUT transfers of the host are fed to the device in-process, as fast as it serves them,
+the IN transfers are read back from it, and the responses of the device are compared
+to those in the capture.
+
+Usage:
+    numapreplay -C=DEVICE_CLASS -r=PCAP_FILE [-d=DEVNUM] [-n=COUNT] [-m=MAX_DIFFS] [--vid=VID] [--pid=PID] [-q] [-v ...]
+
+Options:
+    -C --class DEVICE_CLASS     class of the device or path to python file with device class
+    -r --read PCAP_FILE         usbmon capture (Wireshark/tcpdump on usbmonN, or --pcap of the numap apps)
+    -d --devnum DEVNUM          replay the transfers of this device address
+                                (default: the first device enumerated in the capture)
+    -n --count COUNT            how many times to replay the capture [default: 1]
+    -m --max-diffs MAX_DIFFS    how many mismatching responses to print [default: 10]
+    --vid VID                   override vendor ID
+    --pid PID                   override product ID
+    -q --quiet                  quiet mode. only print warning/error messages
+    -v --verbose                verbosity level
+
+Exits with status 1 when a response of the device differs from the capture.
+
+Examples:
+    rerun a keyboard enumeration 1000 times:
+        numapreplay -C keyboard -r keyboard.pcap -n 1000
+'''
+import sys
+import time
+import struct
+import binascii
+from numap.apps.base import NumapApp
+from numap.phy.vhost import VirtualHostPhy
+from numap.phy.usbmon import Usbmon, read_pcap
+
+
+class Transfer(object):
+    '''
+    A host transfer to replay, with the response of the captured device
+    '''
+
+    control = 'control'
+    data_out = 'out'
+    data_in = 'in'
+
+    __slots__ = ('kind', 'ep_num', 'setup', 'data', 'expected', 'expected_length', 'expected_stall', 'index')
+
+    def __init__(self, kind, ep_num, index, setup=None, data=b''):
+        '''
+        :param kind: Transfer.control, Transfer.data_out or Transfer.data_in
+        :param ep_num: endpoint number
+        :param index: index of the submission in the capture
+        :param setup: (bmRequestType, bRequest, wValue, wIndex, wLength) of a control transfer (default: None)
+        :param data: OUT data (default: b'')
+        '''
+        self.kind = kind
+        self.ep_num = ep_num
+        self.index = index
+        self.setup = setup
+        self.data = data
+        # response of the captured device, None if it was not captured
+        self.expected = None
+        self.expected_length = 0
+        self.expected_stall = False
+
+    def describe(self):
+        if self.kind == Transfer.control:
+            return 'control %02x:%02x %04x %04x %d' % self.setup
+        return '%s ep%d' % (self.kind, self.ep_num)
+
+
+def extract_transfers(events, devnum=None):
+    '''
+    Extract the host transfers of a device from usbmon events
+
+    :param events: iterable of :class:`~numap.phy.usbmon.UsbmonEvent`
+    :param devnum: device address, None for the first device enumerated in the capture
+        (the transfers to address 0 until the first SET_ADDRESS, then to the address it set)
+    :return: list of :class:`Transfer`
+    '''
+    # the traffic of the hubs and of the other devices is skipped
+    follow_address = devnum is None
+    devnums = set([0]) if follow_address else set([devnum])
+    transfers = []
+    pending = {}
+    setup_struct = struct.Struct('<BBHHH')
+    for index, event in enumerate(events):
+        if event.devnum not in devnums and not (event.event_type == Usbmon.complete and event.urb_id in pending):
+            continue
+        ep_num = event.epnum & 0x7f
+        direction_in = bool(event.epnum & 0x80)
+        if event.event_type == Usbmon.submit:
+            if event.xfer_type == Usbmon.xfer_control and event.flag_setup == Usbmon.setup_present:
+                setup = setup_struct.unpack(event.setup)
+                transfer = Transfer(Transfer.control, 0, index, setup, b'' if direction_in else event.data)
+                if follow_address and setup[0] == 0x00 and setup[1] == 0x05:
+                    # SET_ADDRESS, follow the device to its new address,
+                    # later enumerations at address 0 are other devices
+                    devnums = set([setup[2]])
+                    follow_address = False
+            elif event.xfer_type in (Usbmon.xfer_bulk, Usbmon.xfer_types[3]) and not direction_in:
+                transfer = Transfer(Transfer.data_out, ep_num, index, data=event.data)
+            else:
+                continue
+            pending[event.urb_id] = transfer
+            transfers.append(transfer)
+        elif event.event_type == Usbmon.complete:
+            if event.xfer_type in (Usbmon.xfer_bulk, Usbmon.xfer_types[3]) and direction_in:
+                if event.status != Usbmon.status_ok:
+                    # cancelled or failed polls of the host
+                    continue
+                transfer = Transfer(Transfer.data_in, ep_num, index)
+                transfers.append(transfer)
+            else:
+                transfer = pending.pop(event.urb_id, None)
+                if transfer is None:
+                    continue
+            transfer.expected = event.data
+            transfer.expected_length = event.length
+            transfer.expected_stall = event.status == Usbmon.status_stall
+    return transfers
+
+
+class NumapReplayApp(NumapApp):
+
+    #: how long to wait for IN data from a device worker thread, in seconds
+    bulk_timeout = 1.0
+
+    def __init__(self, options):
+        super(NumapReplayApp, self).__init__(options)
+        self.count = int(self.options['--count'])
+        self.max_diffs = int(self.options['--max-diffs'])
+        self.diffs = 0
+        self.bytes_transferred = 0
+
+    def load_transfers(self):
+        devnum = self.options['--devnum']
+        devnum = int(devnum, 0) if devnum is not None else None
+        transfers = extract_transfers(read_pcap(self.options['--read']), devnum)
+        if not transfers:
+            raise Exception('No host transfers in %s (no enumeration at address 0? select the device with --devnum)' % self.options['--read'])
+        return transfers
+
+    def replay(self, phy, transfers, compare):
+        '''
+        Replay the transfers once
+
+        :param phy: the :class:`~numap.phy.vhost.VirtualHostPhy` of the device
+        :param transfers: list of :class:`Transfer`
+        :param compare: whether to compare the responses to the capture
+        '''
+        transferred = 0
+        for transfer in transfers:
+            stalled = False
+            response = b''
+            try:
+                if transfer.kind == Transfer.control:
+                    response = phy.control_transfer(*(transfer.setup + (transfer.data,)))
+                    stalled = response is None
+                    response = response or b''
+                elif transfer.kind == Transfer.data_out:
+                    phy.bulk_out(transfer.ep_num, transfer.data)
+                else:
+                    response = phy.bulk_in(transfer.ep_num, self.bulk_timeout) or b''
+            except Exception as e:
+                self.report_diff(transfer, 'device raised %s: %s' % (type(e).__name__, e))
+                continue
+            transferred += len(transfer.data) + len(response)
+            if compare and transfer.expected is not None:
+                self.compare(transfer, response, stalled)
+        self.bytes_transferred += transferred
+
+    def compare(self, transfer, response, stalled):
+        if stalled != transfer.expected_stall:
+            self.report_diff(transfer, 'stalled' if stalled else 'not stalled, expected a stall')
+        elif stalled:
+            return
+        elif transfer.kind == Transfer.data_out or (transfer.kind == Transfer.control and not transfer.setup[0] & 0x80):
+            return
+        elif len(response) != transfer.expected_length or response[:len(transfer.expected)] != transfer.expected:
+            # the capture may only have the first bytes of each transfer
+            self.report_diff(transfer, 'expected (%d bytes) %s, got (%d bytes) %s' % (
+                transfer.expected_length, binascii.hexlify(transfer.expected).decode(),
+                len(response), binascii.hexlify(response).decode(),
+            ))
+
+    def report_diff(self, transfer, message):
+        self.diffs += 1
+        if self.diffs <= self.max_diffs:
+            self.logger.warning('#%d %s: %s' % (transfer.index, transfer.describe(), message))
+
+    def run(self):
+        transfers = self.load_transfers()
+        self.logger.info('Replaying %d transfers from %s' % (len(transfers), self.options['--read']))
+        phy = VirtualHostPhy(self, sessions=0)
+        dev = self.load_device(self.options['--class'], phy)
+        start = time.time()
+        for i in range(self.count):
+            # each connection resets the device address, the capture sets it again
+            dev.connect()
+            self.replay(phy, transfers, compare=(i == 0))
+        elapsed = time.time() - start
+        dev.disconnect()
+        compared = len([t for t in transfers if t.expected is not None])
+        if self.diffs:
+            self.logger.always('%d of %d responses differ from the capture' % (self.diffs, compared))
+        else:
+            self.logger.always('All %d responses match the capture' % compared)
+        self.logger.always('Replayed %d x %d transfers in %.3f seconds: %.1f replays/s, %.0f transfers/s, %.2f MB/s' % (
+            self.count, len(transfers), elapsed, self.count / elapsed,
+            self.count * len(transfers) / elapsed, self.bytes_transferred / elapsed / (1024 * 1024),
+        ))
+        return self.diffs
+
+
+def main():
+    app = NumapReplayApp(__doc__)
+    sys.exit(1 if app.run() else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,16 +2,19 @@
 Scan device support in USB host
 
 Usage:
-    numapscan [-P=PHY_INFO] [-q] [-v ...]
+    numapscan [-P=PHY_INFO] [-q] [--pcap=PCAP_FILE] [-v ...]
 
 Options:
     -P --phy PHY_INFO           physical layer info, see list below
     -v --verbose                verbosity level
     -q --quiet                  quiet mode. only print warning/error messages
+    --pcap PCAP_FILE            trace the USB transfers to a pcap file (usbmon format, for Wireshark)
 
 Physical layer:
     fd:<serial_port>        use facedancer connected to given serial port
     gadgetfs                use gadgetfs (requires mounting of gadgetfs beforehand)
+    vhost[:HOST[:SESSIONS]] virtual USB host in this process, HOST is linux (default), windows or macos,
+                            the device stops after SESSIONS enumerations (default: 1, 0: never)
 
 Example:
     numapscan -P fd:/dev/ttyUSB0 -q
@@ -7,6 +7,39 @@ import logging
 start_time = time.time()
 
 
+class ActorLoggerAdapter(logging.LoggerAdapter):
+    '''
+    Prefix log messages with the actor name.
+    The prefix is only added when the record passes the logger level,
+    and the message arguments are formatted only when it is emitted.
+    '''
+
+    def __init__(self, logger, actor):
+        '''
+        :param logger: the underlying logger
+        :param actor: the :class:`USBBaseActor` that logs
+        '''
+        super(ActorLoggerAdapter, self).__init__(logger, {})
+        self.actor = actor
+
+    def process(self, msg, kwargs):
+        return '[%s] %s' % (self.actor.name, msg), kwargs
+
+    def is_logging(self, level):
+        '''
+        :param level: logging level
+        :return: whether messages of this level would be logged,
+            use it to guard arguments that are expensive to compute
+        '''
+        return self.logger.isEnabledFor(level)
+
+    def verbose(self, msg, *args, **kwargs):
+        self.log(logging.VERBOSE, msg, *args, **kwargs)
+
+    def always(self, msg, *args, **kwargs):
+        self.log(logging.ALWAYS, msg, *args, **kwargs)
+
+
 class USBBaseActor(object):
 
     name = 'Actor'
@@ -20,7 +53,9 @@ class USBBaseActor(object):
         self.app = app
         self.session_data = {}
         self.str_dict = {}
+        self.request_handlers = {}
         self.logger = logging.getLogger('numap')
+        self.actor_logger = ActorLoggerAdapter(self.logger, self)
 
     def get_mutation(self, stage, data=None):
         '''
@@ -30,6 +65,14 @@ class USBBaseActor(object):
         '''
         return self.app.get_mutation(stage, data)
 
+    def get_request_handlers(self):
+        '''
+        Used by the device to build its request routing table
+
+        :return: dictionary (bRequest: handler) of setup requests handled by this actor
+        '''
+        return self.request_handlers
+
     def send_on_endpoint(self, ep, data):
         '''
         Send data on a given endpoint
@@ -76,28 +119,36 @@ class USBBaseActor(object):
         :param str_id: string id
         :return: the string, or None if id does not exist
         '''
-        self.debug('Getting string by id %#x' % (str_id))
+        self.debug('Getting string by id %#x', str_id)
         if str_id in self.str_dict:
             return self.str_dict[str_id]
         return None
 
+    def is_logging(self, level):
+        '''
+        :param level: logging level
+        :return: whether messages of this level would be logged
+            (see :meth:`ActorLoggerAdapter.is_logging`)
+        '''
+        return self.actor_logger.is_logging(level)
+
     def verbose(self, msg, *args, **kwargs):
-        self.logger.verbose('[%s] %s' % (self.name, msg), *args, **kwargs)
+        self.actor_logger.verbose(msg, *args, **kwargs)
 
     def debug(self, msg, *args, **kwargs):
-        self.logger.debug('[%s] %s' % (self.name, msg), *args, **kwargs)
+        self.actor_logger.debug(msg, *args, **kwargs)
 
     def info(self, msg, *args, **kwargs):
-        self.logger.info('[%s] %s' % (self.name, msg), *args, **kwargs)
+        self.actor_logger.info(msg, *args, **kwargs)
 
     def warning(self, msg, *args, **kwargs):
-        self.logger.warning('[%s] %s' % (self.name, msg), *args, **kwargs)
+        self.actor_logger.warning(msg, *args, **kwargs)
 
     def error(self, msg, *args, **kwargs):
-        self.logger.error('[%s] %s' % (self.name, msg), *args, **kwargs)
+        self.actor_logger.error(msg, *args, **kwargs)
 
     def critical(self, msg, *args, **kwargs):
-        self.logger.critical('[%s] %s' % (self.name, msg), *args, **kwargs)
+        self.actor_logger.critical(msg, *args, **kwargs)
 
     def always(self, msg, *args, **kwargs):
-        self.logger.always('[%s] %s' % (self.name, msg), *args, **kwargs)
+        self.actor_logger.always(msg, *args, **kwargs)
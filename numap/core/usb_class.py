@@ -3,6 +3,7 @@
 # Contains class definition for USBClass, intended as a base class (in the OO
 # sense) for implementing device classes (in the USB sense), eg, HID devices,
 # mass storage devices.
+from functools import partial
 from numap.core.usb_base import USBBaseActor
 
 
@@ -51,12 +52,28 @@ class USBClass(USBBaseActor):
     def setup_local_handlers(self):
         self.local_handlers = {}
 
+    def get_request_handlers(self):
+        '''
+        Bind each local handler directly,
+        so routed requests skip the lookup in _global_handler
+        '''
+        return {
+            x: partial(self._handle_local_request, handler) for x, handler in self.local_handlers.items()
+        }
+
     def _global_handler(self, req):
-        handler = self.local_handlers[req.request]
+        self._handle_local_request(self.local_handlers[req.request], req)
+
+    def _handle_local_request(self, handler, req):
         response = handler(req)
         if response is not None:
             self.phy.send_on_endpoint(0, response)
         self.usb_function_supported('class specific setup request received')
 
     def default_handler(self, req):
-        self._global_handler(req)
+        handler = self.local_handlers.get(req.request, None)
+        if handler is None:
+            self.warning('No handler for class request %#x, stalling', req.request)
+            self.phy.stall_ep0()
+            return
+        self._handle_local_request(handler, req)
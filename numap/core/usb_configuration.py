@@ -38,3 +38,31 @@ class USBConfiguration(USBBaseActor, BaseUSBConfiguration):
 
         USBBaseActor.__init__(self, app, phy)
         BaseUSBConfiguration.__init__(self, index, string, interfaces, attributes, max_power)
+
+    # Table 9-10 of USB 2.0 spec (pdf page 293)
+    @mutable('configuration_descriptor')
+    def get_descriptor(self, usb_type='fullspeed', valid=False):
+        interface_descriptors = b''
+        for i in self.interfaces:
+            interface_descriptors += i.get_descriptor(usb_type, valid)
+        bLength = 9
+        bDescriptorType = DescriptorType.configuration
+        wTotalLength = len(interface_descriptors) + bLength
+        d = struct.pack(
+            '<BBHBBBBB',
+            bLength,
+            bDescriptorType,
+            wTotalLength & 0xffff,
+            len(self.interfaces),
+            self.configuration_index,
+            self.configuration_string_index,
+            self.attributes,
+            self.max_power
+        )
+        return d + interface_descriptors
+
+    # USB 2.0 specification, section 9.6.4 (p 264 of pdf)
+    def get_other_speed_descriptor(self, usb_type='fullspeed', valid=False):
+        other_usb_type = 'fullspeed' if usb_type == 'highspeed' else 'highspeed'
+        d = self.get_descriptor(other_usb_type, valid)
+        return d[:1] + struct.pack('B', DescriptorType.other_speed_configuration) + d[2:]
@@ -32,7 +32,7 @@ class USBCSEndpoint(USBBaseActor):
 
     def default_handler(self, req):
         self.interface.phy.send_on_endpoint(0, b'')
-        self.debug('Received an unknown CSEndpoint request: %s, returned an empty response' % req)
+        self.debug('Received an unknown CSEndpoint request: %s, returned an empty response', req)
 
     def set_interface(self, interface):
         self.interface = interface
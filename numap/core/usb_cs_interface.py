@@ -35,9 +35,10 @@ class USBCSInterface(USBBaseActor):
 
         response = None
 
-        self.info((
-            'Received GET_DESCRIPTOR req %d, index %d, language 0x%04x, length %d'
-        ) % (dtype, dindex, lang, n))
+        self.info(
+            'Received GET_DESCRIPTOR req %d, index %d, language 0x%04x, length %d',
+            dtype, dindex, lang, n
+        )
 
         # TODO: handle KeyError
         response = self.descriptors[dtype]
@@ -47,7 +48,7 @@ class USBCSInterface(USBBaseActor):
         if response:
             n = min(n, len(response))
             self.phy.send_on_endpoint(0, response[:n])
-            self.log_verbose('sent %d bytes in response' % (n))
+            self.verbose('sent %d bytes in response', n)
 
     def handle_set_interface_request(self, req):
         self.phy.stall_ep0()
@@ -55,10 +56,13 @@ class USBCSInterface(USBBaseActor):
 
     def default_handler(self, req):
         self.phy.send_on_endpoint(0, b'')
-        self.debug('Received an unknown USBCSInterface request: %s, returned an empty response' % req)
+        self.debug('Received an unknown USBCSInterface request: %s, returned an empty response', req)
 
     def get_descriptor(self, usb_type='fullspeed', valid=False):
         descriptor_type = DescriptorType.cs_interface
-        length = len(self.cs_config) + 2
-        response = struct.pack('BB', length & 0xff, descriptor_type) + self.cs_config.encode("utf-8")
+        cs_config = self.cs_config
+        if not isinstance(cs_config, bytes):
+            cs_config = cs_config.encode('utf-8')
+        length = len(cs_config) + 2
+        response = struct.pack('BB', length & 0xff, descriptor_type) + cs_config
         return response
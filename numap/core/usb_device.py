@@ -8,13 +8,23 @@ import traceback
 import struct
 from numap.core.usb import DescriptorType, State, Request
 from numap.core.usb_base import USBBaseActor
-from numap.fuzz.helpers import mutable
+from numap.fuzz.helpers import mutable, new_stage_cycle, flush_stage_log, set_stage_request
+from numap.utils import latency
 
 from facedancer.USBDevice import USBDevice as BaseUSBDevice
 
 class USBDevice(USBBaseActor, BaseUSBDevice):
     name = 'Device'
 
+    # fields that are rendered into the cached descriptors,
+    # setting any of them drops the descriptor cache
+    descriptor_fields = frozenset([
+        'usb_spec_version', '_device_class', 'device_subclass', 'protocol_rel_num',
+        'max_packet_size_ep0', 'vendor_id', 'product_id', 'device_rev',
+        'manufacturer_string_id', 'product_string_id', 'serial_number_string_id',
+        'strings', 'configurations', 'bos', 'usb_type',
+    ])
+
     def __init__(
             self, app, phy, device_class, device_subclass,
             protocol_rel_num, max_packet_size_ep0, vendor_id, product_id,
@@ -46,10 +56,15 @@ class USBDevice(USBBaseActor, BaseUSBDevice):
         if descriptors is None:
             descriptors = {}
 
+        # maps (descriptor type, index, language id, usb_type) to rendered descriptor,
+        # the language id is only part of the key for string descriptors
+        self._descriptor_cache = {}
         USBBaseActor.__init__(self, app, phy)
         BaseUSBDevice.__init__(self, phy, usb_class, device_subclass, protocol_rel_num, max_packet_size_ep0,
             vendor_id, product_id, device_rev, manufacturer_string, product_string, serial_number_string, configurations, 
-            descriptors)
+            {})
+        # let the application stop the phy loop (see NumapApp.should_stop_phy)
+        self.scheduler.add_task(self.service_app)
 
         self.supported_device_class_trigger = False
         self.supported_device_class_count = 0
@@ -57,6 +72,7 @@ class USBDevice(USBBaseActor, BaseUSBDevice):
         self.strings = []
 
         self.usb_spec_version = 0x0002
+        self.usb_type = 'fullspeed'
         self._device_class = device_class
         self.device_subclass = device_subclass
         self.protocol_rel_num = protocol_rel_num
@@ -115,6 +131,15 @@ class USBDevice(USBBaseActor, BaseUSBDevice):
         self.address = 0
         self.endpoints = {}
 
+        # maps (type, recipient, bRequest, target) to bound handler,
+        # built on first use, on connect and on SET_CONFIGURATION
+        self.request_routes = None
+
+    def __setattr__(self, name, value):
+        if name in self.descriptor_fields:
+            self.invalidate_descriptor_cache()
+        super(USBDevice, self).__setattr__(name, value)
+
     def get_string_id(self, s):
         try:
             i = self.strings.index(s)
@@ -122,8 +147,67 @@ class USBDevice(USBBaseActor, BaseUSBDevice):
             # string descriptors start at index 1
             self.strings.append(s)
             i = len(self.strings)
+            self.invalidate_descriptor_cache()
         return i
 
+    def invalidate_descriptor_cache(self):
+        '''
+        Drop all cached descriptors.
+        Fields of the device itself are tracked automatically
+        and the cache is dropped on SET_CONFIGURATION,
+        call this after changing a configuration, interface or endpoint in place.
+        '''
+        cache = self.__dict__.get('_descriptor_cache')
+        if cache:
+            cache.clear()
+
+    def build_descriptor_cache(self):
+        '''
+        Render the device and configuration descriptors ahead of enumeration,
+        so the first requests from the host are served from the cache as well.
+        Other descriptors are cached when first requested.
+        Does nothing if the application does not allow caching.
+        '''
+        if not self.app.should_cache_descriptors():
+            return
+        self.get_cached_descriptor(DescriptorType.device, 0)
+        for i in range(len(self.configurations)):
+            self.get_cached_descriptor(DescriptorType.configuration, i)
+        if self.bos:
+            self.get_cached_descriptor(DescriptorType.bos, 0)
+
+    def get_cached_descriptor(self, dtype, dindex, lang=0):
+        '''
+        Get a rendered descriptor, from the cache when possible.
+        The cache is bypassed when the application may mutate
+        or record the descriptor stages (see :meth:`NumapApp.should_cache_descriptors`).
+
+        :param dtype: descriptor type
+        :param dindex: descriptor index
+        :param lang: language id, from wIndex of the request,
+            only used for string descriptors (default: 0)
+        :return: the descriptor, None if there is no such descriptor
+        '''
+        if not self.app.should_cache_descriptors():
+            return self.get_descriptor_by_type(dtype, dindex)
+        if dtype != DescriptorType.string:
+            # wIndex is meaningless here, don't let the host grow the cache with it
+            lang = 0
+        key = (dtype, dindex, lang, self.usb_type)
+        response = self._descriptor_cache.get(key)
+        if response is None:
+            response = self.get_descriptor_by_type(dtype, dindex)
+            if response is not None:
+                response = bytes(response)
+                self._descriptor_cache[key] = response
+        return response
+
+    def get_descriptor_by_type(self, dtype, dindex):
+        response = self.descriptors.get(dtype, None)
+        if callable(response):
+            response = response(dindex)
+        return response
+
     def setup_request_handlers(self):
         # see table 9-4 of USB 2.0 spec, page 279
         self.request_handlers = {
@@ -142,6 +226,8 @@ class USBDevice(USBBaseActor, BaseUSBDevice):
         }
 
     def connect(self):
+        self.build_descriptor_cache()
+        self.build_request_routes()
         self.phy.connect(self)
         # skipping USB.state_attached may not be strictly correct (9.1.1.{1,2})
         self.state = State.powered
@@ -149,9 +235,22 @@ class USBDevice(USBBaseActor, BaseUSBDevice):
     def disconnect(self):
         self.phy.disconnect()
         self.state = State.detached
+        flush_stage_log()
+
+    def service_app(self):
+        '''
+        Scheduler task, stop serving when the application asks to
+        '''
+        if self.app.should_stop_phy():
+            self.stop()
+
+    def ack_status_stage(self, blocking=False):
+        self.phy.ack_status_stage(blocking=blocking)
 
-    def ack_status_stage(self):
-        self.phy.ack_status_stage()
+    def handle_set_address_request(self, req):
+        # the host sets the address once per enumeration
+        new_stage_cycle()
+        super(USBDevice, self).handle_set_address_request(req)
 
     @mutable('device_descriptor')
     def get_descriptor(self, index=0, valid=False):
@@ -177,8 +276,124 @@ class USBDevice(USBBaseActor, BaseUSBDevice):
         )
         return d
 
+    def _get_interfaces(self):
+        if self.configuration:
+            return self.configuration.interfaces
+        if self.configurations:
+            return self.configurations[0].interfaces
+        return []
+
+    def _get_recipient(self, req_type, recipient, target):
+        if recipient == Request.recipient_device:
+            return self
+        elif recipient == Request.recipient_interface:
+            for interface in self._get_interfaces():
+                if interface.number == target:
+                    return interface
+        elif recipient == Request.recipient_endpoint:
+            if target == 0:
+                return self
+            return self.endpoints.get(target, None)
+        elif recipient == Request.recipient_other:
+            # e.g. hub port requests, only meaningful to the class/vendor
+            if req_type != Request.type_standard:
+                return self
+        return None
+
+    def _get_handler_entity(self, req_type, recipient, target):
+        '''
+        :return: the actor that should handle requests with the given
+            type and recipient, None if there is no such actor
+        '''
+        actor = self._get_recipient(req_type, recipient, target)
+        if actor is None or req_type == Request.type_standard:
+            return actor
+        if req_type == Request.type_class:
+            attr = 'usb_class'
+        elif req_type == Request.type_vendor:
+            attr = 'usb_vendor'
+        else:
+            return None
+        entity = getattr(actor, attr)
+        if entity is None and actor is not self:
+            entity = getattr(self, attr)
+        if entity is None:
+            # this is fool-proof against weird drivers
+            # that send requests to the device instead of the interface
+            for interface in self._get_interfaces():
+                entity = getattr(interface, attr)
+                if entity is not None:
+                    break
+        return entity
+
+    @staticmethod
+    def _get_request_target(recipient, index):
+        # meaning of bits in wIndex changes whether we're talking about an
+        # interface or an endpoint (see USB 2.0 spec section 9.3.4)
+        if recipient == Request.recipient_interface:
+            return index & 0xff
+        elif recipient == Request.recipient_endpoint:
+            return index & 0x0f
+        return 0
+
+    def build_request_routes(self):
+        '''
+        Build the table that routes setup requests straight to their handlers.
+        It maps (type, recipient, bRequest, target) to a bound handler,
+        where target is the interface/endpoint number from wIndex (0 otherwise).
+        '''
+        targets = [
+            (Request.recipient_device, 0),
+            (Request.recipient_endpoint, 0),
+            (Request.recipient_other, 0),
+        ]
+        if self.configuration:
+            targets.extend((Request.recipient_interface, i.number) for i in self.configuration.interfaces)
+        targets.extend((Request.recipient_endpoint, num) for num in self.endpoints)
+        routes = {}
+        for req_type in (Request.type_standard, Request.type_class, Request.type_vendor):
+            for recipient, target in targets:
+                entity = self._get_handler_entity(req_type, recipient, target)
+                if entity is None:
+                    continue
+                for request, handler in entity.get_request_handlers().items():
+                    # first interface with a given number (i.e. alternate setting 0) wins
+                    routes.setdefault((req_type, recipient, request, target), handler)
+        self.request_routes = routes
+        return routes
+
     # IRQ handlers
     #####################################################
+    def handle_request(self, req):
+        '''
+        :param req: raw setup packet, or a request object of the phy
+            (e.g. the facedancer ``USBDeviceRequest``), converted to a :class:`USBDeviceRequest`
+        '''
+        if not isinstance(req, USBDeviceRequest):
+            req = USBDeviceRequest(req)
+        routes = self.request_routes
+        if routes is None:
+            routes = self.build_request_routes()
+        req_type = req.get_type()
+        recipient = req.get_recipient()
+        target = self._get_request_target(recipient, req.index)
+        handler = routes.get((req_type, recipient, req.request, target), None)
+        if handler is None:
+            entity = self._get_handler_entity(req_type, recipient, target)
+            if entity is None:
+                self.warning('invalid handler entity, stalling: %s', req)
+                self.phy.stall_ep0()
+                return
+            handler = entity.default_handler
+        set_stage_request(req)
+        try:
+            if latency.recorder is None:
+                handler(req)
+            else:
+                latency.recorder.timed(self.name, 'request:%s' % latency.handler_name(handler), handler, req)
+        finally:
+            set_stage_request(None)
+
     @mutable('device_qualifier_descriptor')
     def get_device_qualifier_descriptor(self, n):
         bDescriptorType = 6
@@ -205,21 +420,31 @@ class USBDevice(USBBaseActor, BaseUSBDevice):
         Called when there is no handler for the request
         """
         self.phy.send_on_endpoint(0, b'')
-        self.debug('Received an unknown device request: %s, returned an empty response' % req)
+        self.debug('Received an unknown device request: %s, returned an empty response', req)
 
     def handle_data_available(self, ep_num, data):
         if self.state == State.configured and ep_num in self.endpoints:
             self.usb_function_supported('data received on endpoint %#x' % (ep_num))
             endpoint = self.endpoints[ep_num]
             if callable(endpoint.handler):
-                endpoint.handler(data)
+                if latency.recorder is None:
+                    endpoint.handler(data)
+                else:
+                    latency.recorder.timed(
+                        self.name, 'ep%d:%s' % (ep_num, latency.handler_name(endpoint.handler)), endpoint.handler, data
+                    )
 
     def handle_buffer_available(self, ep_num):
         if self.state == State.configured and ep_num in self.endpoints:
             endpoint = self.endpoints[ep_num]
             if callable(endpoint.handler):
                 try:
-                    endpoint.handler()
+                    if latency.recorder is None:
+                        endpoint.handler()
+                    else:
+                        latency.recorder.timed(
+                            self.name, 'ep%d:%s' % (ep_num, latency.handler_name(endpoint.handler)), endpoint.handler
+                        )
                 except:
                     self.error(traceback.format_exc())
                     self.error(''.join(traceback.format_stack()))
@@ -227,6 +452,18 @@ class USBDevice(USBBaseActor, BaseUSBDevice):
 
     # standard request handlers
 
+    # USB 2.0 specification, section 9.4.3 (p 281 of pdf)
+    def handle_get_descriptor_request(self, req):
+        dtype = (req.value >> 8) & 0xff
+        dindex = req.value & 0xff
+        n = req.length
+
+        self.debug('Received GET_DESCRIPTOR req %d, index %d, language 0x%04x, length %d', dtype, dindex, req.index, n)
+        response = self.get_cached_descriptor(dtype, dindex, req.index)
+        if response:
+            self.phy.send_on_endpoint(0, response[:n])
+        else:
+            self.phy.stall_ep0()
 
     #
     # No need to mutate this one, will mutate
@@ -234,15 +471,15 @@ class USBDevice(USBBaseActor, BaseUSBDevice):
     #
     def get_configuration_descriptor(self, num):
         if num < len(self.configurations):
-            return self.configurations[num].get_descriptor()
+            return self.configurations[num].get_descriptor(self.usb_type)
         else:
-            return self.configurations[0].get_descriptor()
+            return self.configurations[0].get_descriptor(self.usb_type)
 
     def get_other_speed_configuration_descriptor(self, num):
         if num < len(self.configurations):
-            return self.configurations[num].get_other_speed_descriptor()
+            return self.configurations[num].get_other_speed_descriptor(self.usb_type)
         else:
-            return self.configurations[0].get_other_speed_descriptor()
+            return self.configurations[0].get_other_speed_descriptor(self.usb_type)
 
     def get_bos_descriptor(self, num):
         if self.bos:
@@ -261,17 +498,23 @@ class USBDevice(USBBaseActor, BaseUSBDevice):
         )
         return d
 
+    def _encode_string(self, s):
+        # some devices pass their strings as bytes
+        if isinstance(s, bytes):
+            s = s.decode('utf-8')
+        return s.encode('utf-16')
+
     @mutable('string_descriptor')
     def get_string_descriptor(self, num):
-        self.debug('get_string_descriptor: %#x (%#x)' % (num, len(self.strings)))
+        self.debug('get_string_descriptor: %#x (%#x)', num, len(self.strings))
         s = None
         if num <= len(self.strings):
-            s = self.strings[num - 1].encode('utf-16')
+            s = self._encode_string(self.strings[num - 1])
         else:
             if self.configuration:
                 s = self.configuration.get_string_by_id(num)
         if not s:
-            s = self.strings[0].encode('utf-16')
+            s = self._encode_string(self.strings[0])
         # Linux doesn't like the leading 2-byte Byte Order Mark (BOM);
         # FreeBSD is okay without it
         s = s[2:]
@@ -332,11 +575,11 @@ class USBDevice(USBBaseActor, BaseUSBDevice):
 
         # configs are one-based
         if (req.value) > len(self.configurations):
-            self.error('Host tries to set invalid configuration: %#x' % (req.value - 1))
+            self.error('Host tries to set invalid configuration: %#x', req.value - 1)
             self.config_num = 0
         else:
             self.config_num = req.value - 1
-        self.info('Setting configuration: %#x' % self.config_num)
+        self.info('Setting configuration: %#x', self.config_num)
         self.configuration = self.configurations[self.config_num]
         self.state = State.configured
 
@@ -344,6 +587,9 @@ class USBDevice(USBBaseActor, BaseUSBDevice):
         for i in self.configuration.interfaces:
             for e in i.endpoints:
                 self.endpoints[e.number] = e
+        self.build_request_routes()
+        # the string descriptors of the configuration are now reachable
+        self.invalidate_descriptor_cache()
 
         # HACK: blindly acknowledge request
         self.ack_status_stage()
@@ -380,6 +626,11 @@ class USBDevice(USBBaseActor, BaseUSBDevice):
 
 class USBDeviceRequest(object):
 
+    __slots__ = (
+        'raw_bytes', 'request_type', 'request', 'value', 'index', 'length', '_data',
+        'type', 'recipient',
+    )
+
     setup_request_types = {
         Request.type_standard: 'standard',
         Request.type_class: 'class',
@@ -392,31 +643,51 @@ class USBDeviceRequest(object):
         Request.recipient_other: 'other',
     }
 
+    setup_struct = struct.Struct('<BBHHH')
+    _unpack_setup = setup_struct.unpack_from
+
     def __init__(self, obj):
-        """Expects raw 8-byte setup data request packet"""
+        '''
+        :param obj: raw setup packet (8 bytes, optionally followed by the data stage),
+            or a request object with the setup fields (e.g. from facedancer)
 
-        if isinstance(obj, bytes):
-            raw_bytes = obj
+        .. note:: data is a view over the buffer it was parsed from,
+            handlers that keep it around should copy it.
+        '''
+        if isinstance(obj, (bytes, bytearray, memoryview)):
+            self.raw_bytes = obj
+            self._data = None
+            (
+                self.request_type, self.request, self.value, self.index, self.length
+            ) = self._unpack_setup(obj)
         else:
-            raw_bytes = struct.pack('<BBHHH',
-                obj.request_type,
-                obj.request,
-                obj.value,
-                obj.index,
-                obj.length
-            )
-            raw_bytes += obj.data
-
-        self.raw_bytes = raw_bytes
+            self.raw_bytes = None
+            self._data = obj.data
+            self.request_type = obj.request_type
+            self.request = obj.request
+            self.value = obj.value
+            self.index = obj.index
+            self.length = obj.length
+        self.type = (self.request_type >> 5) & 0x03
+        self.recipient = self.request_type & 0x1f
+
+    @property
+    def data(self):
+        '''data stage of the request, the view is only created when first accessed'''
+        if self._data is None:
+            raw_bytes = self.raw_bytes
+            self._data = memoryview(raw_bytes)[8:] if len(raw_bytes) > 8 else b''
+        return self._data
 
     def __str__(self):
+        direction = self.get_direction()
         s = 'dir=%#x (%s), type=%#x (%s), rec=%#x (%s), req=%#x, val=%#x, idx=%#x, len=%#x' % (
-            self.get_direction(),
-            'in' if self.get_direction() else 'out',
-            self.get_type(),
-            self.setup_request_types.get(self.get_type(), 'unknown'),
-            self.get_recipient(),
-            self.setup_request_receipients.get(self.get_recipient(), 'unknown'),
+            direction,
+            'in' if direction else 'out',
+            self.type,
+            self.setup_request_types.get(self.type, 'unknown'),
+            self.recipient,
+            self.setup_request_receipients.get(self.recipient, 'unknown'),
             self.request,
             self.value,
             self.get_index(),
@@ -425,33 +696,29 @@ class USBDeviceRequest(object):
         return s
 
     def raw(self):
-        '''returns request as bytes'''
-        b = struct.pack(
-            '<BBHHH',
-            self.request_type,
-            self.request,
-            self.value >> 8,
-            self.index >> 8,
-            self.length >> 8,
-        )
-        return b
+        '''returns the setup packet (without the data stage) as bytes'''
+        if self.raw_bytes is None:
+            return self.setup_struct.pack(
+                self.request_type,
+                self.request,
+                self.value,
+                self.index,
+                self.length,
+            )
+        return bytes(self.raw_bytes[:8])
 
     def get_direction(self):
-        return (self.request_type >> 7) & 0x01
+        return self.request_type >> 7
 
     def get_type(self):
-        return (self.request_type >> 5) & 0x03
+        return self.type
 
     def get_recipient(self):
-        return self.request_type & 0x1f
+        return self.recipient
 
     # meaning of bits in wIndex changes whether we're talking about an
     # interface or an endpoint (see USB 2.0 spec section 9.3.4)
     def get_index(self):
-        rec = self.get_recipient()
-        if rec == 1:                # interface
-            return self.index
-        elif rec == 2:              # endpoint
+        if self.recipient == Request.recipient_endpoint:
             return self.index & 0xf
-        else:
-            return self.index
+        return self.index
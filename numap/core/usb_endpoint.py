@@ -73,12 +73,12 @@ class USBEndpoint(USBBaseActor):
         self.interface.phy.send_on_endpoint(0, b'')
 
     def handle_get_status(self, req):
-        self.info('in GET_STATUS of endpoint %d' % self.number)
+        self.info('in GET_STATUS of endpoint %d', self.number)
         self.phy.send_on_endpoint(0, b'\x00\x00')
 
     def default_handler(self, req):
         self.phy.send_on_endpoint(0, b'')
-        self.debug('Received an unknown USBEndpoint request: %s, returned an empty response' % req)
+        self.debug('Received an unknown USBEndpoint request: %s, returned an empty response', req)
 
     def send(self, data):
         self.phy.send_on_endpoint(self.number, data)
@@ -2,6 +2,7 @@
 #
 # Contains class definition for USBVendor, intended as a base class (in the OO
 # sense) for implementing device vendors.
+from functools import partial
 from numap.core.usb_base import USBBaseActor
 
 
@@ -26,8 +27,24 @@ class USBVendor(USBBaseActor):
     def setup_local_handlers(self):
         self.local_handlers = {}
 
+    def get_request_handlers(self):
+        '''
+        Bind each local handler directly,
+        so routed requests skip the lookup in default_handler
+        '''
+        return {
+            x: partial(self._handle_local_request, handler) for x, handler in self.local_handlers.items()
+        }
+
     def default_handler(self, req):
-        handler = self.local_handlers[req.request]
+        handler = self.local_handlers.get(req.request, None)
+        if handler is None:
+            self.warning('No handler for vendor request %#x, stalling', req.request)
+            self.phy.stall_ep0()
+            return
+        self._handle_local_request(handler, req)
+
+    def _handle_local_request(self, handler, req):
         response = handler(req)
         if response is not None:
             self.phy.send_on_endpoint(0, response)
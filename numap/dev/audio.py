@@ -69,7 +69,7 @@ class USBAudioClass(USBClass):
 
     def set_param_val(self, req, param):
         try:
-            self._settings[(req.value, req.index)][param] = req.data
+            self._settings[(req.value, req.index)][param] = bytes(req.data)
         except:
             raise Exception('Cannot find tuple (%#x, %#x, %#x) in settings' % (req.value, req.index, param))
 
@@ -127,7 +127,7 @@ class AudioStreaming(object):
             self.phy.send_on_endpoint(self.tx_ep, self.txq.get())
 
     def data_available(self, data):
-        self.app.logger.info('[AudioStreaming] Got %#x bytes on streaming endpoint' % (len(data)))
+        self.app.logger.info('[AudioStreaming] Got %#x bytes on streaming endpoint', len(data))
 
 
 class USBAudioStreamingInterface(USBInterface):
@@ -181,7 +181,7 @@ class USBCDCClass(USBClass):
         the best key you can
         '''
         param_id = self.get_param_id_from_request(req.request)
-        self.params[(param_id, req.value, req.index)] = req.data
+        self.params[(param_id, req.value, req.index)] = bytes(req.data)
         return b''
 
     def handle_getter(self, req):
@@ -0,0 +1,178 @@
+'''
+Chunked, zlib compressed disk images.
+
+The image is split in chunks of a fixed size, each one compressed on its own,
+so any sector can be read by decompressing a single chunk.
+
+Format (little endian)::
+
+    header      magic (8 bytes), version (u32), chunk size (u32), image size (u64), number of chunks (u32)
+    index       offset of each chunk in the file (u64), and the end of the last chunk
+    chunks      zlib stream of each chunk, or the raw chunk if it does not compress,
+                or nothing (empty) if the chunk is all zeros
+
+Images are created and extracted by numap-image (see :mod:`numap.apps.image`).
+'''
+import os
+import sys
+import zlib
+import struct
+from array import array
+from collections import OrderedDict
+from numap.dev.mass_storage import DiskBackend, _overlay_sectors, open_image_file
+
+
+class ChunkedImageFormat(object):
+
+    magic = b'NUMAPZIM'
+    version = 1
+    header = struct.Struct('<8sIIQI')
+    #: default chunk size, in bytes
+    chunk_size = 64 * 1024
+
+
+def pack_image(src, dst, chunk_size=ChunkedImageFormat.chunk_size, level=6):
+    '''
+    Compress a raw disk image
+
+    :param src: raw image file
+    :param dst: chunked image file to create
+    :param chunk_size: chunk size, a multiple of 512 (default: 64 KiB)
+    :param level: zlib compression level (default: 6)
+    :return: (raw size, compressed size)
+    '''
+    if chunk_size <= 0 or chunk_size % 512:
+        raise ValueError('The chunk size must be a multiple of 512, not %d' % chunk_size)
+    fmt = ChunkedImageFormat
+    image_size = os.path.getsize(src)
+    num_chunks = (image_size + chunk_size - 1) // chunk_size
+    offsets = array('Q')
+    zero_chunk = bytes(chunk_size)
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        fout.write(fmt.header.pack(fmt.magic, fmt.version, chunk_size, image_size, num_chunks))
+        # the index is written once the offsets are known
+        fout.seek(fmt.header.size + (num_chunks + 1) * 8)
+        for _ in range(num_chunks):
+            offsets.append(fout.tell())
+            chunk = fin.read(chunk_size)
+            if chunk == zero_chunk[:len(chunk)]:
+                continue
+            compressed = zlib.compress(chunk, level)
+            fout.write(compressed if len(compressed) < len(chunk) else chunk)
+        offsets.append(fout.tell())
+        compressed_size = fout.tell()
+        fout.seek(fmt.header.size)
+        fout.write(struct.pack('<%dQ' % len(offsets), *offsets))
+    return image_size, compressed_size
+
+
+class ChunkedDiskImage(DiskBackend):
+    '''
+    Chunked, zlib compressed disk image, with an LRU cache of decompressed chunks.
+    The image file is not modified: the sectors written by the host are kept in memory.
+    '''
+
+    #: default number of decompressed chunks to keep
+    cache_chunks = 64
+
+    def __init__(self, filename, block_size, cache_chunks=None):
+        '''
+        :param filename: chunked image file (see :func:`pack_image`)
+        :param block_size: sector size
+        :param cache_chunks: number of decompressed chunks to keep (default: None, :attr:`cache_chunks`)
+        '''
+        fmt = ChunkedImageFormat
+        self.filename = filename
+        self.file = open_image_file(filename, 'rb')
+        magic, version, chunk_size, image_size, num_chunks = fmt.header.unpack(self.file.read(fmt.header.size))
+        if magic != fmt.magic or version != fmt.version:
+            raise Exception('%s is not a chunked disk image (version %d)' % (filename, fmt.version))
+        if chunk_size % block_size:
+            raise Exception('The chunk size %d of %s is not a multiple of the block size %d' % (chunk_size, filename, block_size))
+        super(ChunkedDiskImage, self).__init__(block_size, image_size)
+        # the size of the raw image, self.size is rounded down to whole blocks
+        self.image_size = image_size
+        self.chunk_size = chunk_size
+        self.num_chunks = num_chunks
+        self.offsets = array('Q')
+        self.offsets.frombytes(self.file.read((num_chunks + 1) * 8))
+        if sys.byteorder != 'little':
+            self.offsets.byteswap()
+        self.cache_size = cache_chunks or self.cache_chunks
+        # chunk number: chunk data, the most recently used last
+        self.cache = OrderedDict()
+        self.zero_chunk = bytes(chunk_size)
+        # sector number: sector data, written by the host
+        self.sectors = {}
+
+    def get_chunk(self, index):
+        '''
+        :param index: chunk number
+        :return: the decompressed chunk
+        '''
+        chunk = self.cache.pop(index, None)
+        if chunk is None:
+            if self.offsets[index] == self.offsets[index + 1]:
+                chunk = self.zero_chunk
+            else:
+                chunk = self._read_chunk(index)
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+        self.cache[index] = chunk
+        return chunk
+
+    def get_sectors_view(self, address, count):
+        self.check_range(address, count)
+        start = address * self.block_size
+        end = start + count * self.block_size
+        first, last = start // self.chunk_size, (end - 1) // self.chunk_size
+        if count and first == last:
+            # in a single chunk, no copy
+            offset = first * self.chunk_size
+            view = memoryview(self.get_chunk(first))[start - offset:end - offset]
+        else:
+            data = bytearray(end - start)
+            pos = start
+            while pos < end:
+                index = pos // self.chunk_size
+                offset = pos - index * self.chunk_size
+                length = min(self.chunk_size - offset, end - pos)
+                data[pos - start:pos - start + length] = memoryview(self.get_chunk(index))[offset:offset + length]
+                pos += length
+            view = memoryview(data)
+        return _overlay_sectors(view, address, count, self.block_size, self.sectors)
+
+    def write_sectors(self, address, data):
+        data = memoryview(data)
+        for i in range(len(data) // self.block_size):
+            self.sectors[address + i] = bytes(data[i * self.block_size:(i + 1) * self.block_size])
+
+    def unpack(self, dst):
+        '''
+        Extract the raw image (all-zero chunks are left as holes)
+
+        :param dst: raw image file to create
+        '''
+        with open(dst, 'wb') as f:
+            for index in range(self.num_chunks):
+                if self.offsets[index] == self.offsets[index + 1]:
+                    continue
+                f.seek(index * self.chunk_size)
+                # not through the cache, it is for the reads of the host
+                f.write(self._read_chunk(index))
+            f.truncate(self.image_size)
+
+    def _read_chunk(self, index):
+        '''
+        :return: the decompressed chunk, read from the file
+        '''
+        raw_length = min(self.chunk_size, self.image_size - index * self.chunk_size)
+        start, end = self.offsets[index], self.offsets[index + 1]
+        self.file.seek(start)
+        chunk = self.file.read(end - start)
+        return zlib.decompress(chunk) if len(chunk) < raw_length else chunk
+
+    def close(self):
+        self.flush()
+        self.cache.clear()
+        self.file.close()
@@ -32,7 +32,7 @@ class USBHubClass(USBClass):
     def handle_get_hub_status(self, req):
         i = req.index
         if i:
-            self.info('GetPortStatus (%d)' % i)
+            self.info('GetPortStatus (%d)', i)
         else:
             self.info('GetHubStatus')
         return b'\x00\x00\x00\x00'
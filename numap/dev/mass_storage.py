@@ -9,14 +9,14 @@
     it seems that our current phy, facedancer, is very slow,
     so we are only able to emulate very small disk images (~3M).
     Take that into consideration before using it ...
+    (large disks can still be reported, without an image file, see :class:`SparseDiskImage`)
 '''
-from mmap import mmap
+from mmap import mmap, ACCESS_DEFAULT, ACCESS_READ
 import os
 import struct
-from threading import Thread, Event
-import time
+from threading import Thread, Lock, current_thread
 
-from six.moves.queue import Queue
+from six.moves.queue import Queue, Empty
 from numap.core.usb_device import USBDevice
 from numap.core.usb_configuration import USBConfiguration
 from numap.core.usb_interface import USBInterface
@@ -24,6 +24,7 @@ from numap.core.usb_endpoint import USBEndpoint
 from numap.core.usb_class import USBClass
 from numap.core.usb_base import USBBaseActor
 from numap.fuzz.helpers import mutable
+from numap.utils.ulogger import HexDump
 
 
 class ScsiCmds(object):
@@ -42,7 +43,11 @@ class ScsiCmds(object):
     VERIFY_10 = 0x2F
     SYNCHRONIZE_CACHE = 0x35
     MODE_SENSE_10 = 0x5A
+    READ_16 = 0x88
+    WRITE_16 = 0x8A
     READ_CAPACITY_16 = 0x9e
+    READ_12 = 0xA8
+    WRITE_12 = 0xAA
 
 
 class ScsiSenseKeys(object):
@@ -91,46 +96,349 @@ class USBMassStorageClass(USBClass):
         return b'\x00'
 
 
-class DiskImage:
-    def __init__(self, filename, block_size):
-        self.filename = filename
-        self.block_size = block_size
-
-        try:
-            statinfo = os.stat(self.filename)
-            self.size = statinfo.st_size
-            self.file = open(self.filename, 'r+b')
-            self.image = mmap(self.file.fileno(), 0)
-        except:
-            print('''
+def open_image_file(filename, mode):
+    try:
+        return open(filename, mode)
+    except:
+        print('''
 ----------------------------------------------------------------------
 No disk image named '%s' was found.
 You can use the disk image from numap/data/fat32.3M.stick.img
 as a small disk image (extract it using `tar xvf fat32.3M.stick.img`)
 ----------------------------------------------------------------------
             ''' % (filename))
-            raise Exception('No file named %s found.' % (filename))
+        raise Exception('No file named %s found.' % (filename))
 
-    def close(self):
-        self.image.flush()
-        self.image.close()
+
+def parse_size(size):
+    '''
+    :param size: size in bytes, int or string with an optional K/M/G/T suffix (e.g. '64G')
+    :return: size in bytes
+    '''
+    if not isinstance(size, str):
+        return int(size)
+    multipliers = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in multipliers:
+        return int(float(size[:-1]) * multipliers[size[-1]])
+    return int(size, 0)
+
+
+def _overlay_sectors(view, address, count, block_size, sectors):
+    '''
+    :return: the view, with the sectors of the dict that are in its range written over it
+    '''
+    if not sectors:
+        return view
+    written = [sector for sector in range(address, address + count) if sector in sectors]
+    if not written:
+        return view
+    data = bytearray(view)
+    for sector in written:
+        offset = (sector - address) * block_size
+        data[offset:offset + block_size] = sectors[sector]
+    return memoryview(data)
+
+
+class DiskBackend(object):
+    '''
+    Storage of the sectors of the emulated disk.
+
+    Backends implement :meth:`get_sectors_view` and :meth:`write_sectors`,
+    and :meth:`flush`/:meth:`close` if they have something to sync or release.
+    '''
+
+    def __init__(self, block_size, size):
+        '''
+        :param block_size: sector size
+        :param size: size of the disk, in bytes
+        '''
+        self.block_size = block_size
+        self.num_blocks = size // block_size
+        self.size = self.num_blocks * block_size
+        # whether the disk was written since the last flush
+        self.dirty = False
+
+    def check_range(self, address, count):
+        if address < 0 or count < 0 or address + count > self.num_blocks:
+            raise ValueError('sectors %#x + %#x are out of the disk image' % (address, count))
 
     def get_sector_count(self):
-        return (self.size // self.block_size) - 1
+        '''
+        :return: number of the last sector
+        '''
+        return self.num_blocks - 1
+
+    def get_sector_data(self, address):
+        return bytes(self.get_sectors_view(address, 1))
+
+    def get_sectors_view(self, address, count):
+        '''
+        :param address: first sector
+        :param count: number of sectors
+        :return: the data of the sectors (bytes-like, a view of the disk when possible)
+        '''
+        raise NotImplementedError()
+
+    def put_sector_data(self, address, data):
+        '''
+        Write sectors, the last one is padded with zeros.
+        The disk is synced by :meth:`flush`.
+
+        :param address: first sector
+        :param data: data of the sectors
+        '''
+        pad_len = (self.block_size - (len(data) % self.block_size)) % self.block_size
+        if pad_len:
+            data = bytes(data) + b'\x00' * pad_len
+        self.check_range(address, len(data) // self.block_size)
+        self.write_sectors(address, data)
+        self.dirty = True
+
+    def write_sectors(self, address, data):
+        '''
+        :param address: first sector
+        :param data: data of whole sectors, in the range of the disk
+        '''
+        raise NotImplementedError()
+
+    def flush(self):
+        '''
+        Sync the written sectors
+        '''
+        self.dirty = False
+
+    def reset(self):
+        '''
+        Called when the host starts a new session (SET_ADDRESS)
+        '''
+        self.flush()
+
+    def close(self):
+        self.flush()
+
+
+class DiskImage(DiskBackend):
+    '''
+    Disk image file, mapped in memory
+    '''
+
+    #: how the image file is opened and mapped
+    file_mode = 'r+b'
+    access = ACCESS_DEFAULT
+
+    def __init__(self, filename, block_size):
+        self.filename = filename
+        self.file = open_image_file(filename, self.file_mode)
+        super(DiskImage, self).__init__(block_size, os.fstat(self.file.fileno()).st_size)
+        self.image = mmap(self.file.fileno(), 0, access=self.access)
+
+    def close(self):
+        self.flush()
+        try:
+            self.image.close()
+        except BufferError:
+            # a view returned by get_sectors_view is still referenced,
+            # the mapping is closed when it is garbage collected
+            pass
 
     def get_sector_data(self, address):
         block_start = address * self.block_size
         block_end = block_start + self.block_size   # slices are NON-inclusive
         return self.image[block_start:block_end]
 
-    def put_sector_data(self, address, data):
+    def get_sectors_view(self, address, count):
+        self.check_range(address, count)
+        return memoryview(self.image)[address * self.block_size:(address + count) * self.block_size]
+
+    def write_sectors(self, address, data):
         block_start = address * self.block_size
-        block_end = (address + 1) * self.block_size   # slices are NON-inclusive
+        self.image[block_start:block_start + len(data)] = data
 
-        pad_len = (self.block_size - (len(data) % self.block_size)) % self.block_size
-        data += b'\x00' * pad_len
-        self.image[block_start:block_end] = data[:self.block_size]
-        self.image.flush()
+    def flush(self):
+        if self.dirty:
+            self.image.flush()
+            self.dirty = False
+
+
+class FileDiskImage(DiskBackend):
+    '''
+    Disk image file (or block device) read and written with file I/O,
+    for images too large to be mapped
+    '''
+
+    def __init__(self, filename, block_size):
+        self.filename = filename
+        self.file = open_image_file(filename, 'r+b')
+        # the size of block devices is not in their stat
+        size = self.file.seek(0, os.SEEK_END)
+        super(FileDiskImage, self).__init__(block_size, size)
+
+    def get_sectors_view(self, address, count):
+        self.check_range(address, count)
+        data = bytearray(count * self.block_size)
+        self.file.seek(address * self.block_size)
+        self.file.readinto(data)
+        return memoryview(data)
+
+    def write_sectors(self, address, data):
+        self.file.seek(address * self.block_size)
+        self.file.write(data)
+
+    def flush(self):
+        if self.dirty:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.dirty = False
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class SparseDiskImage(DiskBackend):
+    '''
+    Disk of any size that reads as zeros, with no image file.
+    The sectors written by the host are kept in memory,
+    sectors written with zeros are dropped.
+    '''
+
+    def __init__(self, size, block_size):
+        '''
+        :param size: size of the disk, in bytes
+        :param block_size: sector size
+        '''
+        super(SparseDiskImage, self).__init__(block_size, size)
+        # sector number: sector data
+        self.sectors = {}
+        # shared by all the reads, as large as the largest read
+        self.zeros = b''
+
+    def get_sectors_view(self, address, count):
+        self.check_range(address, count)
+        length = count * self.block_size
+        if len(self.zeros) < length:
+            self.zeros = bytes(length)
+        return _overlay_sectors(memoryview(self.zeros)[:length], address, count, self.block_size, self.sectors)
+
+    def write_sectors(self, address, data):
+        data = memoryview(data)
+        zero_sector = bytes(self.block_size)
+        for i in range(len(data) // self.block_size):
+            sector = bytes(data[i * self.block_size:(i + 1) * self.block_size])
+            if sector == zero_sector:
+                self.sectors.pop(address + i, None)
+            else:
+                self.sectors[address + i] = sector
+
+
+class OverlayDiskImage(DiskImage):
+    '''
+    Copy-on-write disk image: the base image is mapped read-only,
+    and the sectors written by the host are kept in memory (the delta).
+    The delta is dropped on reset (a new session of the host) and on close,
+    so the base image is never modified.
+
+    The delta can be appended to a file before it is dropped,
+    to see what the host wrote (see :func:`read_delta`).
+    '''
+
+    file_mode = 'rb'
+    access = ACCESS_READ
+
+    #: header of each delta in the delta file: magic, block size, session, number of blocks
+    delta_header = struct.Struct('<8sIIQ')
+    delta_magic = b'NUMAPDLT'
+    #: sector number, before the data of each sector
+    delta_sector = struct.Struct('<Q')
+
+    def __init__(self, filename, block_size, delta_filename=None):
+        '''
+        :param filename: base image
+        :param block_size: sector size
+        :param delta_filename: file to append the delta of each session to (default: None)
+        '''
+        super(OverlayDiskImage, self).__init__(filename, block_size)
+        self.delta_filename = delta_filename
+        # sector number: sector data
+        self.delta = {}
+        self.session = 0
+
+    def get_sector_data(self, address):
+        data = self.delta.get(address)
+        if data is not None:
+            return bytes(data)
+        return super(OverlayDiskImage, self).get_sector_data(address)
+
+    def get_sectors_view(self, address, count):
+        view = super(OverlayDiskImage, self).get_sectors_view(address, count)
+        return _overlay_sectors(view, address, count, self.block_size, self.delta)
+
+    def write_sectors(self, address, data):
+        data = memoryview(data)
+        for i in range(len(data) // self.block_size):
+            self.delta[address + i] = bytes(data[i * self.block_size:(i + 1) * self.block_size])
+
+    def flush(self):
+        self.dirty = False
+
+    def reset(self):
+        '''
+        Drop the delta (after saving it, if there is a delta file)
+        '''
+        if self.delta and self.delta_filename:
+            self.save_delta(self.delta_filename)
+        self.delta = {}
+        self.session += 1
+
+    def save_delta(self, filename):
+        '''
+        Append the delta of the current session to a file
+        '''
+        with open(filename, 'ab') as f:
+            f.write(self.delta_header.pack(self.delta_magic, self.block_size, self.session, len(self.delta)))
+            for sector in sorted(self.delta):
+                f.write(self.delta_sector.pack(sector))
+                f.write(self.delta[sector])
+
+    def close(self):
+        self.reset()
+        super(OverlayDiskImage, self).close()
+
+
+#: disk backends with an image file, by name
+disk_backends = {
+    'mmap': DiskImage,
+    'file': FileDiskImage,
+}
+
+
+def read_delta(filename):
+    '''
+    Read a delta file of :class:`OverlayDiskImage`
+
+    :param filename: delta file
+    :return: list of (session, {sector number: sector data})
+    '''
+    header = OverlayDiskImage.delta_header
+    sector_struct = OverlayDiskImage.delta_sector
+    deltas = []
+    with open(filename, 'rb') as f:
+        data = f.read()
+    offset = 0
+    while offset < len(data):
+        magic, block_size, session, count = header.unpack_from(data, offset)
+        if magic != OverlayDiskImage.delta_magic:
+            raise Exception('Bad delta header at offset %#x of %s' % (offset, filename))
+        offset += header.size
+        sectors = {}
+        for _ in range(count):
+            sector, = sector_struct.unpack_from(data, offset)
+            offset += sector_struct.size
+            sectors[sector] = data[offset:offset + block_size]
+            offset += block_size
+        deltas.append((session, sectors))
+    return deltas
 
 
 def scsi_status(cbw, status):
@@ -141,9 +449,18 @@ def scsi_status(cbw, status):
 class ScsiDevice(USBBaseActor):
     '''
     Implementation of subset of the SCSI protocol
+
+    The commands and the write data are handled by a worker thread,
+    which blocks on the rx queue until data arrives (see :func:`put_data`),
+    and puts the responses and statuses on the tx queue.
     '''
     name = 'ScsiDevice'
 
+    #: put on the rx queue to stop the worker thread
+    stop_marker = object()
+    #: how long stop() waits for the worker thread, in seconds
+    stop_timeout = 1.0
+
     def __init__(self, app, disk_image):
         super(ScsiDevice, self).__init__(app, None)
         self.disk_image = disk_image
@@ -154,11 +471,15 @@ class ScsiDevice(USBBaseActor):
             ScsiCmds.READ_CAPACITY_10: self.handle_read_capacity_10,
             # ScsiCmds.SEND_DIAGNOSTIC: self.handle_send_diagnostic,
             ScsiCmds.PREVENT_ALLOW_MEDIUM_REMOVAL: self.handle_prevent_allow_medium_removal,
+            ScsiCmds.WRITE_6: self.handle_write_6,
             ScsiCmds.WRITE_10: self.handle_write_10,
+            ScsiCmds.WRITE_12: self.handle_write_12,
+            ScsiCmds.WRITE_16: self.handle_write_16,
+            ScsiCmds.READ_6: self.handle_read_6,
             ScsiCmds.READ_10: self.handle_read_10,
-            # ScsiCmds.WRITE_6: self.handle_write_6,
-            # ScsiCmds.READ_6: self.handle_read_6,
-            # ScsiCmds.VERIFY_10: self.handle_verify_10,
+            ScsiCmds.READ_12: self.handle_read_12,
+            ScsiCmds.READ_16: self.handle_read_16,
+            ScsiCmds.VERIFY_10: self.handle_verify_10,
             ScsiCmds.MODE_SENSE_6: self.handle_mode_sense_6,
             ScsiCmds.MODE_SENSE_10: self.handle_mode_sense_10,
             ScsiCmds.READ_FORMAT_CAPACITIES: self.handle_read_format_capacities,
@@ -166,34 +487,115 @@ class ScsiDevice(USBBaseActor):
             ScsiCmds.READ_CAPACITY_16: self.handle_read_capacity_16,
         }
         self.is_write_in_progress = False
+        self.tx = Queue()
+        self.rx = Queue()
+        self.tx_pending = None
+        # held by the worker while it handles data, and by handle_reset
+        self.lock = Lock()
+        # incremented on each reset, data queued before a reset is dropped
+        self.generation = 0
         self.handle_reset()
-        self.stop_event = Event()
         self.thread = Thread(target=self.handle_data_loop)
         self.thread.daemon = True
         self.thread.start()
 
     def handle_reset(self):
+        '''
+        Reset the command state and drop the queued data.
+        Waits for the command that the worker is handling, if any.
+        '''
         self.debug('handling reset')
-        if self.is_write_in_progress and self.write_data:
-            self.disk_image.put_sector_data(self.write_base_lba, self.write_data)
-        self.is_write_in_progress = False
-        self.write_cbw = None
-        self.write_base_lba = 0
-        self.write_length = 0
-        self.write_data = b''
-        self.tx = Queue()
-        self.rx = Queue()
+        with self.lock:
+            self.generation += 1
+            if self.is_write_in_progress and not self.write_verify and not self.write_failed:
+                # keep the blocks that were fully received
+                received = self.write_received - self.write_received % self.disk_image.block_size
+                self.disk_image.put_sector_data(self.write_base_lba, memoryview(self.write_buffer)[:received])
+            self.disk_image.flush()
+            self.is_write_in_progress = False
+            self.write_cbw = None
+            self.write_base_lba = 0
+            self.write_buffer = None
+            self.write_length = 0
+            self.write_received = 0
+            self.write_verify = False
+            self.write_failed = False
+            self._drain(self.rx)
+            self._drain(self.tx)
+            # rest of the response that was being sent
+            self.tx_pending = None
+
+    def _drain(self, queue):
+        try:
+            while True:
+                item = queue.get_nowait()
+                if item is self.stop_marker:
+                    # keep the stop request
+                    queue.put(item)
+                    return
+        except Empty:
+            pass
 
     def stop(self):
-        self.stop_event.set()
+        '''
+        Stop the worker thread, after the data it is handling
+        '''
+        self.rx.put(self.stop_marker)
+        if self.thread.is_alive() and self.thread is not current_thread():
+            self.thread.join(self.stop_timeout)
+        # release the views of the disk image
+        self._drain(self.tx)
+        self.tx_pending = None
+
+    def put_data(self, data):
+        '''
+        Queue data from the host (a CBW or write data) for the worker thread
+
+        :param data: data received on the OUT endpoint
+        '''
+        self.rx.put((self.generation, data))
+
+    def get_data(self):
+        '''
+        :return: the next response or status for the host, None if there is none yet
+        '''
+        try:
+            return self.tx.get_nowait()
+        except Empty:
+            return None
+
+    def get_packet(self, max_packet_size):
+        '''
+        :param max_packet_size: max packet size of the IN endpoint
+        :return: the next packet for the host (a view of the response), None if there is none yet
+        '''
+        data = self.tx_pending
+        if data is None:
+            data = self.get_data()
+            if data is None:
+                return None
+            data = memoryview(data)
+        if len(data) > max_packet_size:
+            self.tx_pending = data[max_packet_size:]
+            return data[:max_packet_size]
+        self.tx_pending = None
+        return data
 
     def handle_data_loop(self):
-        while not self.stop_event.isSet():
-            if not self.rx.empty():
-                data = self.rx.get()
-                self.handle_data(data)
-            else:
-                time.sleep(0.0001)
+        rx = self.rx
+        while True:
+            item = rx.get()
+            if item is self.stop_marker:
+                break
+            generation, data = item
+            with self.lock:
+                if generation != self.generation:
+                    continue
+                try:
+                    self.handle_data(data)
+                except Exception as ex:
+                    # e.g. a malformed CBW, keep serving the next commands
+                    self.error('exception while handling %d bytes of SCSI data: %s', len(data), ex)
 
     def handle_data(self, data):
         if self.is_write_in_progress:
@@ -206,29 +608,73 @@ class ScsiDevice(USBBaseActor):
                     resp = self.handlers[opcode](cbw)
                     if resp is not None:
                         self.tx.put(resp)
-                    self.tx.put(scsi_status(cbw, ScsiCmdStatus.COMMAND_PASSED))
+                    if not self.is_write_in_progress:
+                        # the status of a write is sent once all its data is received
+                        self.tx.put(scsi_status(cbw, ScsiCmdStatus.COMMAND_PASSED))
                 except Exception as ex:
-                    self.warning('exception while processing opcode %#x' % (opcode))
+                    self.warning('exception while processing opcode %#x', opcode)
                     self.warning(ex)
                     self.tx.put(scsi_status(cbw, ScsiCmdStatus.COMMAND_FAILED))
             else:
-                self.error('No handler for opcode %#x, return CSW with ScsiCmdStatus.COMMAND_FAILED' % (opcode))
+                self.error('No handler for opcode %#x, return CSW with ScsiCmdStatus.COMMAND_FAILED', opcode)
                 self.tx.put(scsi_status(cbw, ScsiCmdStatus.COMMAND_FAILED))
 
+    def start_write(self, cbw, base_lba, num_blocks, verify=False):
+        '''
+        Expect the data of a write (or of a verify with byte check),
+        the status is sent once all of it is received
+
+        :param cbw: the command
+        :param base_lba: first block
+        :param num_blocks: number of blocks
+        :param verify: compare the data to the disk image instead of writing it (default: False)
+        '''
+        if num_blocks == 0:
+            return
+        if cbw.data_transfer_length == 0:
+            # the host sends no data, don't take its next CBW for it
+            raise ValueError('no data transfer for a write of %d blocks' % num_blocks)
+        length = num_blocks * self.disk_image.block_size
+        self.write_cbw = cbw
+        self.write_base_lba = base_lba
+        self.write_verify = verify
+        # the data is still received when the blocks are out of the image,
+        # or when the host sends less than the command asks for, then the command fails
+        self.write_failed = base_lba + num_blocks > self.disk_image.num_blocks or length > cbw.data_transfer_length
+        # no more than the host announced
+        self.write_length = min(length, cbw.data_transfer_length)
+        # a failed write is only counted, not stored
+        self.write_buffer = None if self.write_failed else bytearray(self.write_length)
+        self.write_received = 0
+        self.debug('SCSI Write total expected length: %#x', length)
+        self.is_write_in_progress = True
+
     def handle_write_data(self, data):
-        self.write_data += data
-        self.debug('Got %#x bytes of SCSI write data, written so far: %#x' % (len(data), len(self.write_data)))
-        if len(self.write_data) >= self.write_length:
-            self.info('Got all write data')
-            # done writing
-            self.disk_image.put_sector_data(self.write_base_lba, self.write_data)
-            self.is_write_in_progress = False
-            self.write_data = b''
-            self.tx.put(scsi_status(self.write_cbw, ScsiCmdStatus.COMMAND_PASSED))
+        offset = self.write_received
+        length = min(len(data), self.write_length - offset)
+        if self.write_buffer is not None:
+            self.write_buffer[offset:offset + length] = data[:length]
+        self.write_received = offset + length
+        self.debug('Got %#x bytes of SCSI write data, written so far: %#x', len(data), self.write_received)
+        if self.write_received < self.write_length:
+            return
+        self.debug('Got all write data')
+        status = ScsiCmdStatus.COMMAND_PASSED
+        if self.write_failed:
+            status = ScsiCmdStatus.COMMAND_FAILED
+        elif self.write_verify:
+            if self.disk_image.get_sectors_view(self.write_base_lba, self.write_length // self.disk_image.block_size) != self.write_buffer:
+                self.warning('SCSI Verify, miscompare at lba %#x', self.write_base_lba)
+                status = ScsiCmdStatus.COMMAND_FAILED
+        else:
+            self.disk_image.put_sector_data(self.write_base_lba, self.write_buffer)
+        self.is_write_in_progress = False
+        self.write_buffer = None
+        self.tx.put(scsi_status(self.write_cbw, status))
 
     @mutable('scsi_inquiry_response')
     def handle_inquiry(self, cbw):
-        self.debug('SCSI Inquiry, data: %s' % cbw.cb[1:].hex())
+        self.debug('SCSI Inquiry, data: %s', HexDump(cbw.cb[1:]))
         peripheral = 0x00  # SBC
         RMB = 0x80  # Removable
         version = 0x00
@@ -245,7 +691,7 @@ class ScsiDevice(USBBaseActor):
 
     @mutable('scsi_request_sense_response')
     def handle_request_sense(self, cbw):
-        self.debug('SCSI Request Sense, data: %s' % cbw.cb[1:].hex())
+        self.debug('SCSI Request Sense, data: %s', HexDump(cbw.cb[1:]))
         response_code = 0x70
         valid = 0x00
         filemark = 0x06
@@ -271,25 +717,29 @@ class ScsiDevice(USBBaseActor):
 
     @mutable('scsi_test_unit_ready_response')
     def handle_test_unit_ready(self, cbw):
-        self.debug('SCSI Test Unit Ready, logical unit number: %02x' % (cbw.cb[1]))
+        self.debug('SCSI Test Unit Ready, logical unit number: %02x', cbw.cb[1])
 
     @mutable('scsi_read_capacity_10_response')
     def handle_read_capacity_10(self, cbw):
-        # .. todo: is the length correct?
-        self.debug('SCSI Read Capacity(10), data: %s' % cbw.cb[1:].hex())
-        lastlba = self.disk_image.get_sector_count()
+        self.debug('SCSI Read Capacity(10), data: %s', HexDump(cbw.cb[1:]))
+        # 0xffffffff tells the host to use READ CAPACITY(16)
+        lastlba = min(self.disk_image.get_sector_count(), 0xffffffff)
         length = self.disk_image.block_size
         response = struct.pack('>II', lastlba, length)
         return response
 
     @mutable('scsi_read_capacity_16_response')
     def handle_read_capacity_16(self, cbw):
-        # .. todo: is the length correct?
-        self.debug('SCSI Read Capacity(16), data: %s' % cbw.cb[1:].hex())
+        self.debug('SCSI Read Capacity(16), data: %s', HexDump(cbw.cb[1:]))
+        service_action = cbw.cb[1] & 0x1f
+        if service_action != 0x10:
+            raise ValueError('unsupported service action %#x of SERVICE ACTION IN(16)' % service_action)
+        alloc_len = struct.unpack('>I', cbw.cb[10:14])[0]
         lastlba = self.disk_image.get_sector_count()
         length = self.disk_image.block_size
-        response = struct.pack('>BBQIBB', 0x9e, 0x10, lastlba, length, 0x00, 0x00)
-        return response
+        # no protection, one logical block per physical block, no thin provisioning
+        response = struct.pack('>QI', lastlba, length).ljust(32, b'\x00')
+        return response[:alloc_len]
 
     @mutable('scsi_send_diagnostic_response')
     def handle_send_diagnostic(self, cbw):
@@ -301,38 +751,69 @@ class ScsiDevice(USBBaseActor):
 
     @mutable('scsi_write_10_response')
     def handle_write_10(self, cbw):
-        self.debug('SCSI Write (10), data: %s' % cbw.cb[1:].hex())
+        base_lba, group, num_blocks = struct.unpack('>IBH', cbw.cb[2:9])
+        self.debug('SCSI Write (10), lba %#x + %#x block(s)', base_lba, num_blocks)
+        self.start_write(cbw, base_lba, num_blocks)
 
-        base_lba = struct.unpack('>I', cbw.cb[2:6])[0]
-        num_blocks = struct.unpack('>H', cbw.cb[7:9])[0]
+    def handle_write_12(self, cbw):
+        base_lba, num_blocks = struct.unpack('>II', cbw.cb[2:10])
+        self.debug('SCSI Write (12), lba %#x + %#x block(s)', base_lba, num_blocks)
+        self.start_write(cbw, base_lba, num_blocks)
 
-        self.debug('SCSI Write (10), lba %#x + %#x block(s)' % (base_lba, num_blocks))
+    def handle_write_16(self, cbw):
+        base_lba, num_blocks = struct.unpack('>QI', cbw.cb[2:14])
+        self.debug('SCSI Write (16), lba %#x + %#x block(s)', base_lba, num_blocks)
+        self.start_write(cbw, base_lba, num_blocks)
 
-        # save for later
-        self.write_cbw = cbw
-        self.write_base_lba = base_lba
-        self.write_length = num_blocks * self.disk_image.block_size
-        self.debug('SCSI Write (10) total expected length: %#x' % (self.write_length))
-        self.is_write_in_progress = True
+    def read_blocks(self, base_lba, num_blocks):
+        '''
+        :return: the blocks to send, as a single view of the disk image
+        '''
+        if num_blocks == 0:
+            return None
+        return self.disk_image.get_sectors_view(base_lba, num_blocks)
 
     def handle_read_10(self, cbw):
         base_lba, group, num_blocks = struct.unpack('>IBH', cbw.cb[2:9])
-        self.debug('SCSI Read (10), lba %#x + %#x block(s)' % (base_lba, num_blocks))
-        for block_num in range(num_blocks):
-            data = self.disk_image.get_sector_data(base_lba + block_num)
-            self.tx.put(data)
+        self.debug('SCSI Read (10), lba %#x + %#x block(s)', base_lba, num_blocks)
+        return self.read_blocks(base_lba, num_blocks)
+
+    def handle_read_12(self, cbw):
+        base_lba, num_blocks = struct.unpack('>II', cbw.cb[2:10])
+        self.debug('SCSI Read (12), lba %#x + %#x block(s)', base_lba, num_blocks)
+        return self.read_blocks(base_lba, num_blocks)
+
+    def handle_read_16(self, cbw):
+        base_lba, num_blocks = struct.unpack('>QI', cbw.cb[2:14])
+        self.debug('SCSI Read (16), lba %#x + %#x block(s)', base_lba, num_blocks)
+        return self.read_blocks(base_lba, num_blocks)
 
     @mutable('scsi_write_6_response')
     def handle_write_6(self, cbw):
-        raise NotImplementedError('yet...')
+        base_lba = struct.unpack('>I', cbw.cb[0:4])[0] & 0x1fffff
+        # a transfer length of 0 means 256 blocks
+        num_blocks = cbw.cb[4] or 256
+        self.debug('SCSI Write (6), lba %#x + %#x block(s)', base_lba, num_blocks)
+        self.start_write(cbw, base_lba, num_blocks)
 
     @mutable('scsi_read_6_response')
     def handle_read_6(self, cbw):
-        raise NotImplementedError('yet...')
+        base_lba = struct.unpack('>I', cbw.cb[0:4])[0] & 0x1fffff
+        # a transfer length of 0 means 256 blocks
+        num_blocks = cbw.cb[4] or 256
+        self.debug('SCSI Read (6), lba %#x + %#x block(s)', base_lba, num_blocks)
+        return self.read_blocks(base_lba, num_blocks)
 
     @mutable('scsi_verify_10_response')
     def handle_verify_10(self, cbw):
-        raise NotImplementedError('yet...')
+        base_lba, group, num_blocks = struct.unpack('>IBH', cbw.cb[2:9])
+        byte_check = cbw.cb[1] & 0x02
+        self.debug('SCSI Verify (10), lba %#x + %#x block(s), byte check: %s', base_lba, num_blocks, bool(byte_check))
+        if byte_check:
+            # the host sends the data to compare
+            self.start_write(cbw, base_lba, num_blocks, verify=True)
+        else:
+            self.disk_image.check_range(base_lba, num_blocks)
 
     def _build_page0_report(self, page, data):
         report = struct.pack(b'BB', page, len(data))
@@ -367,7 +848,7 @@ class ScsiDevice(USBBaseActor):
 
     def handle_scsi_mode_sense(self, mode_type, page, subpage, alloc_len, ctrl, with_header=True):
         # .. todo: implement response for unsupported pages
-        self.debug('SCSI Mode Sense(%d), page %#x subpage %#x' % (mode_type, page, subpage))
+        self.debug('SCSI Mode Sense(%d), page %#x subpage %#x', mode_type, page, subpage)
         report = None
         # wish there was a switch :(
         if page == 0x1c:
@@ -391,7 +872,7 @@ class ScsiDevice(USBBaseActor):
             # this should probably be changed ...
             report = b'\x07\x00\x00\x00\x00\x00\x00\x00'
         if with_header:
-            self.debug('SCSI mode sense (%d) - adding header' % (mode_type))
+            self.debug('SCSI mode sense (%d) - adding header', mode_type)
             report = self._report_header(mode_type, len(report)) + report
         return report
 
@@ -412,17 +893,20 @@ class ScsiDevice(USBBaseActor):
     @mutable('scsi_read_format_capacities')
     def handle_read_format_capacities(self, cbw):
         self.debug('SCSI Read Format Capacity')
-        # header
+        alloc_len = struct.unpack('>H', cbw.cb[7:9])[0]
+        # header: capacity list length
         response = struct.pack('>I', 8)
-        num_sectors = 0x1000
-        reserved = 0x1000
+        # current capacity descriptor: number of blocks, formatted media, block length (24 bits)
+        num_sectors = min(self.disk_image.num_blocks, 0xffffffff)
+        formatted_media = 0x02
         sector_size = self.disk_image.block_size
-        response += struct.pack('>IHH', num_sectors, reserved, sector_size)
-        return response
+        response += struct.pack('>IB', num_sectors, formatted_media) + struct.pack('>I', sector_size)[1:]
+        return response[:alloc_len]
 
     @mutable('scsi_synchronize_cache_response')
     def handle_synchronize_cache(self, cbw):
         self.debug('Synchronize Cache (10)')
+        self.disk_image.flush()
 
 
 class CommandBlockWrapper:
@@ -454,6 +938,8 @@ class USBMassStorageInterface(USBInterface):
     .. todo:: all handlers - should be more dynamic??
     '''
     name = 'MassStorageInterface'
+    #: max packet size of the bulk endpoints, the responses are sent in packets of this size
+    max_packet_size = 0x40
 
     def __init__(self, app, phy, scsi_device, usbclass, sub, proto):
         super(USBMassStorageInterface, self).__init__(
@@ -474,7 +960,7 @@ class USBMassStorageInterface(USBInterface):
                     transfer_type=USBEndpoint.transfer_type_bulk,
                     sync_type=USBEndpoint.sync_type_none,
                     usage_type=USBEndpoint.usage_type_data,
-                    max_packet_size=0x40,
+                    max_packet_size=self.max_packet_size,
                     interval=0,
                     handler=self.handle_data_available
                 ),
@@ -486,7 +972,7 @@ class USBMassStorageInterface(USBInterface):
                     transfer_type=USBEndpoint.transfer_type_bulk,
                     sync_type=USBEndpoint.sync_type_none,
                     usage_type=USBEndpoint.usage_type_data,
-                    max_packet_size=0x40,
+                    max_packet_size=self.max_packet_size,
                     interval=0,
                     handler=self.handle_buffer_available
                 ),
@@ -496,13 +982,13 @@ class USBMassStorageInterface(USBInterface):
         self.scsi_device = scsi_device
 
     def handle_buffer_available(self):
-        if not self.scsi_device.tx.empty():
-            data = self.scsi_device.tx.get()
+        data = self.scsi_device.get_packet(self.max_packet_size)
+        if data is not None:
             self.send_on_endpoint(3, data)
 
     def handle_data_available(self, data):
-        self.debug('handling %d bytes of SCSI data' % (len(data)))
-        self.scsi_device.rx.put(data)
+        self.debug('handling %d bytes of SCSI data', len(data))
+        self.scsi_device.put_data(data)
 
 
 class USBMassStorageDevice(USBDevice):
@@ -511,9 +997,41 @@ class USBMassStorageDevice(USBDevice):
     def __init__(
         self, app, phy, vid=0x154b, pid=0x6545, rev=0x0002,
         usbclass=USBClass.MassStorage, subclass=0x06, proto=0x50,
-        disk_image_filename='stick.img'
+        disk_image_filename='stick.img', overlay=False, overlay_delta_filename=None,
+        disk_backend='mmap', disk_size=None
     ):
-        self.disk_image = DiskImage(disk_image_filename, 0x200)
+        '''
+        :param disk_image_filename: disk image (default: stick.img)
+        :param overlay: do not modify the disk image, keep the writes of each session
+            in memory (see :class:`OverlayDiskImage`) (default: False)
+        :param overlay_delta_filename: with overlay, file to save the writes of each session to (default: None)
+        :param disk_backend: mmap (:class:`DiskImage`), file (:class:`FileDiskImage`),
+            sparse (:class:`SparseDiskImage`, no image file)
+            vfat (:class:`~numap.dev.vfat.VirtualFatDiskImage`, disk_image_filename is a directory)
+            or chunked (:class:`~numap.dev.chunked_image.ChunkedDiskImage`, compressed image) (default: mmap)
+        :param disk_size: size of the sparse disk (required) or of the vfat disk,
+            in bytes or with a K/M/G/T suffix (default: None)
+        '''
+        # backends that are not built from an image file alone
+        other_backends = ['chunked', 'sparse', 'vfat']
+        if disk_backend not in disk_backends and disk_backend not in other_backends:
+            raise Exception('Unknown disk backend %s, use one of: %s' % (disk_backend, ', '.join(sorted(disk_backends) + other_backends)))
+        if overlay and disk_backend != 'mmap':
+            raise Exception('The overlay is only supported by the mmap disk backend')
+        if disk_backend == 'sparse':
+            if disk_size is None:
+                raise Exception('The size of the sparse disk is required')
+            self.disk_image = SparseDiskImage(parse_size(disk_size), 0x200)
+        elif disk_backend == 'vfat':
+            from numap.dev.vfat import VirtualFatDiskImage
+            self.disk_image = VirtualFatDiskImage(disk_image_filename, 0x200, None if disk_size is None else parse_size(disk_size))
+        elif disk_backend == 'chunked':
+            from numap.dev.chunked_image import ChunkedDiskImage
+            self.disk_image = ChunkedDiskImage(disk_image_filename, 0x200)
+        elif overlay:
+            self.disk_image = OverlayDiskImage(disk_image_filename, 0x200, overlay_delta_filename)
+        else:
+            self.disk_image = disk_backends[disk_backend](disk_image_filename, 0x200)
         self.scsi_device = ScsiDevice(app, self.disk_image)
 
         super(USBMassStorageDevice, self).__init__(
@@ -553,6 +1071,8 @@ class USBMassStorageDevice(USBDevice):
         we should reset some flags in the scsi device ...
         '''
         self.scsi_device.handle_reset()
+        # a new session of the host, an overlay image starts over from the base image
+        self.disk_image.reset()
         super(USBMassStorageDevice, self).handle_set_address_request(req)
 
 usb_device = USBMassStorageDevice
@@ -17,6 +17,7 @@ from numap.core.usb_configuration import USBConfiguration
 from numap.core.usb_interface import USBInterface
 from numap.core.usb_endpoint import USBEndpoint
 from numap.fuzz.helpers import mutable
+from numap.utils.ulogger import HexDump
 
 
 class ClassRequests(object):
@@ -465,7 +466,7 @@ class USBSmartcardInterface(USBInterface):
     def handle_buffer_available(self):
         if not self.int_q.empty():
             buff = self.int_q.get()
-            self.debug('Sending data to host: %s' % (buff.hex())
+            self.debug('Sending data to host: %s', HexDump(buff))
             self.send_on_endpoint(3, buff)
         else:
             self.send_on_endpoint(3, b'')
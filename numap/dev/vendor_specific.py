@@ -20,7 +20,7 @@ class USBVendorSpecificVendor(USBVendor):
         }
 
     def handle_generic(self, req):
-        self.always('Generic handler - req: %s' % req)
+        self.always('Generic handler - req: %s', req)
 
 
 class USBVendorSpecificClass(USBClass):
@@ -32,7 +32,7 @@ class USBVendorSpecificClass(USBClass):
         }
 
     def handle_generic(self, req):
-        self.always('Generic handler - req: %s' % req)
+        self.always('Generic handler - req: %s', req)
 
 
 class USBVendorSpecificInterface(USBInterface):
@@ -112,7 +112,7 @@ class USBVendorSpecificInterface(USBInterface):
         }
 
     def handle_generic(self, req):
-        self.always('Generic handler - req: %s' % req)
+        self.always('Generic handler - req: %s', req)
 
 
 class USBVendorSpecificDevice(USBDevice):
@@ -146,11 +146,12 @@ class USBVendorSpecificDevice(USBDevice):
             ],
         )
 
-    def handle_request(self, buf):
+    def handle_request(self, req):
         '''
         override the handle_request - in case a request is directed to an endpoint - we mark as supported
         '''
-        req = USBDeviceRequest(buf)
+        if not isinstance(req, USBDeviceRequest):
+            req = USBDeviceRequest(req)
 
         # figure out the intended recipient
         req_type = req.get_type()
@@ -162,7 +163,7 @@ class USBVendorSpecificDevice(USBDevice):
                 #self.phy.stall_ep0()
                 return
 
-        return super(USBVendorSpecificDevice, self).handle_request(buf)
+        return super(USBVendorSpecificDevice, self).handle_request(req)
 
     def handle_data_available(self, ep_num, data):
         '''
@@ -0,0 +1,381 @@
+'''
+Virtual FAT32 disk, synthesized from a directory of the host.
+
+The boot sector, the FATs and the directories are computed from the
+directory tree when the disk is created, the clusters of each file are
+allocated contiguously, and the data sectors are read from the source files
+only when the USB host reads them. The startup time and the memory depend
+on the number of files, not on their size.
+
+The disk is read-only for the source files: the sectors written by the USB
+host are kept in memory, like those of :class:`~numap.dev.mass_storage.SparseDiskImage`.
+'''
+import os
+import time
+import struct
+import zlib
+from bisect import bisect_right
+from collections import OrderedDict
+from numap.dev.mass_storage import DiskBackend, _overlay_sectors
+
+
+class _Node(object):
+    '''
+    File or directory of the virtual disk
+    '''
+
+    def __init__(self, name, path, is_dir, size, mtime):
+        self.name = name
+        self.path = path
+        self.is_dir = is_dir
+        self.size = size
+        self.mtime = mtime
+        self.children = []
+        self.short_name = None
+        self.long_name = False
+        self.parent = None
+        self.cluster = 0
+        self.num_clusters = 0
+
+
+class VirtualFatDiskImage(DiskBackend):
+    '''
+    FAT32 disk (no partition table) with the content of a directory
+    '''
+
+    sector_size = 0x200
+    reserved_sectors = 32
+    num_fats = 2
+    fsinfo_sector = 1
+    backup_boot_sector = 6
+    root_cluster = 2
+    #: FAT32 needs at least this many clusters
+    min_clusters = 65525
+    #: free space of the disk when no size is given, in bytes
+    default_free_space = 64 * 1024 * 1024
+    #: largest file size of FAT32
+    max_file_size = 0xffffffff
+    #: how many source files are kept open
+    max_open_files = 16
+
+    end_of_chain = 0x0fffffff
+    media = 0xf8
+    attr_volume_id = 0x08
+    attr_directory = 0x10
+    attr_archive = 0x20
+    attr_long_name = 0x0f
+    last_long_entry = 0x40
+
+    boot_struct = struct.Struct('<3s8sHBHBHHBHHHIIIHHIHH12sBBBI11s8s')
+    dir_entry_struct = struct.Struct('<11sBBBHHHHHHHI')
+    lfn_entry_struct = struct.Struct('<B10sBBB12sH4s')
+    short_name_chars = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!#$%&\'()-@^_`{}~')
+
+    def __init__(self, directory, block_size=0x200, size=None):
+        '''
+        :param directory: directory with the content of the disk
+        :param block_size: sector size, must be 512 (default: 0x200)
+        :param size: size of the disk in bytes (default: None, the size of the files and some free space)
+        '''
+        if block_size != self.sector_size:
+            raise Exception('The virtual FAT disk only supports %d bytes sectors' % self.sector_size)
+        if not os.path.isdir(directory):
+            raise Exception('No directory named %s found.' % directory)
+        self.directory = directory
+        self.skipped = []
+        self.root = self._scan(directory, os.path.basename(os.path.abspath(directory)))
+        self.root.is_dir = True
+        self.label = self._clean(self.root.name)[:11].ljust(11).encode('ascii')
+        directories = self._directories()
+        files = [child for node in directories for child in node.children if not child.is_dir and child.size]
+        # 4 KiB clusters, 32 KiB above 32 GiB of content
+        spc = 8
+        used_clusters = self._allocate(directories, files, spc * self.sector_size)
+        if used_clusters * spc * self.sector_size > 32 * (1 << 30):
+            spc = 64
+            used_clusters = self._allocate(directories, files, spc * self.sector_size)
+        cluster_size = spc * self.sector_size
+        self.sectors_per_cluster = spc
+        self.cluster_size = cluster_size
+        if size is None:
+            num_clusters = max(self.min_clusters, used_clusters + self.default_free_space // cluster_size)
+            self.fat_sectors = self._ceil_div((num_clusters + 2) * 4, self.sector_size)
+        else:
+            total_sectors = size // self.sector_size
+            num_clusters = (total_sectors - self.reserved_sectors) // spc
+            self.fat_sectors = self._ceil_div((num_clusters + 2) * 4, self.sector_size)
+            num_clusters = (total_sectors - self.reserved_sectors - self.num_fats * self.fat_sectors) // spc
+        if num_clusters < max(used_clusters, self.min_clusters):
+            raise Exception('A FAT32 disk with the content of %s needs %d clusters, %d are available' % (
+                directory, max(used_clusters, self.min_clusters), num_clusters))
+        if num_clusters > 0x0ffffff5 - 2:
+            raise Exception('Too many clusters for FAT32: %d' % num_clusters)
+        self.num_clusters = num_clusters
+        self.data_start = self.reserved_sectors + self.num_fats * self.fat_sectors
+        total_sectors = self.data_start + num_clusters * spc
+        if total_sectors > 0xffffffff:
+            raise Exception('The virtual FAT disk can not be larger than 2 TiB')
+        super(VirtualFatDiskImage, self).__init__(self.sector_size, total_sectors * self.sector_size)
+
+        self.next_free_cluster = self.root_cluster + used_clusters
+        # extents of the allocated clusters: (first cluster, number of clusters, directory data or None, node)
+        self.extents = []
+        for node in directories:
+            self.extents.append((node.cluster, node.num_clusters, self._directory_data(node), node))
+        for node in files:
+            self.extents.append((node.cluster, node.num_clusters, None, node))
+        self.extent_starts = [extent[0] for extent in self.extents]
+        self.reserved_data = self._reserved_data()
+        self.open_files = OrderedDict()
+        # sector number: sector data, written by the host
+        self.sectors = {}
+
+    @staticmethod
+    def _ceil_div(value, divisor):
+        return (value + divisor - 1) // divisor
+
+    def _allocate(self, directories, files, cluster_size):
+        '''
+        Allocate the clusters: the directories first, then the files, each one contiguous
+
+        :return: number of allocated clusters
+        '''
+        next_cluster = self.root_cluster
+        for node in directories + files:
+            if node.is_dir:
+                node.num_clusters = max(1, self._ceil_div(self._count_entries(node) * 32, cluster_size))
+            else:
+                node.num_clusters = self._ceil_div(node.size, cluster_size)
+            node.cluster = next_cluster
+            next_cluster += node.num_clusters
+        return next_cluster - self.root_cluster
+
+    # the tree
+
+    def _scan(self, path, name):
+        st = os.stat(path)
+        node = _Node(name, path, False, st.st_size, st.st_mtime)
+        if os.path.isdir(path):
+            node.is_dir = True
+            node.size = 0
+            for child_name in sorted(os.listdir(path)):
+                child_path = os.path.join(path, child_name)
+                if not (os.path.isdir(child_path) or os.path.isfile(child_path)):
+                    continue
+                child = self._scan(child_path, child_name)
+                if child.size > self.max_file_size:
+                    # FAT32 can not hold it
+                    self.skipped.append(child_path)
+                    continue
+                node.children.append(child)
+            self._set_short_names(node)
+        return node
+
+    def _directories(self):
+        '''
+        :return: the directories, breadth first, from the root
+        '''
+        directories = [self.root]
+        for node in directories:
+            directories.extend([child for child in node.children if child.is_dir])
+        return directories
+
+    def _count_entries(self, node):
+        # the root has the volume label, the other directories have . and ..
+        count = 1 if node is self.root else 2
+        for child in node.children:
+            count += 1
+            if child.long_name:
+                count += self._ceil_div(len(child.name.encode('utf-16-le')) // 2 + 1, 13)
+        return count
+
+    def _set_short_names(self, node):
+        used = set()
+        for child in node.children:
+            base, ext = os.path.splitext(child.name)
+            if not base:
+                base, ext = ext, ''
+            short_base = self._clean(base)
+            short_ext = self._clean(ext[1:])[:3]
+            short_name = short_base[:8].ljust(8) + short_ext.ljust(3)
+            exact = (
+                short_base == base and short_ext == ext[1:] and
+                0 < len(base) <= 8 and short_name not in used
+            )
+            if not exact:
+                index = 1
+                while True:
+                    tail = '~%d' % index
+                    short_name = ((short_base or '_')[:8 - len(tail)] + tail).ljust(8) + short_ext.ljust(3)
+                    if short_name not in used:
+                        break
+                    index += 1
+            used.add(short_name)
+            child.short_name = short_name.encode('ascii')
+            child.long_name = not exact
+
+    def _clean(self, text):
+        text = text.upper().replace(' ', '').replace('.', '')
+        return ''.join(c if c in self.short_name_chars else '_' for c in text)
+
+    # the metadata sectors
+
+    def _reserved_data(self):
+        volume_id = zlib.crc32(os.path.abspath(self.directory).encode('utf-8')) & 0xffffffff
+        boot = bytearray(self.sector_size)
+        self.boot_struct.pack_into(
+            boot, 0,
+            b'\xeb\x58\x90', b'NUMAP   ', self.sector_size, self.sectors_per_cluster,
+            self.reserved_sectors, self.num_fats, 0, 0, self.media, 0, 63, 255, 0,
+            self.num_blocks, self.fat_sectors, 0, 0, self.root_cluster,
+            self.fsinfo_sector, self.backup_boot_sector, b'', 0x80, 0, 0x29, volume_id, self.label, b'FAT32   '
+        )
+        boot[510:512] = b'\x55\xaa'
+        fsinfo = bytearray(self.sector_size)
+        struct.pack_into('<I', fsinfo, 0, 0x41615252)
+        struct.pack_into(
+            '<IIII', fsinfo, 484,
+            0x61417272, self.num_clusters + 2 - self.next_free_cluster, self.next_free_cluster, 0
+        )
+        struct.pack_into('<I', fsinfo, 508, 0xaa550000)
+        data = bytearray(self.reserved_sectors * self.sector_size)
+        for sector, content in [(0, boot), (self.fsinfo_sector, fsinfo), (self.backup_boot_sector, boot), (self.backup_boot_sector + 1, fsinfo)]:
+            data[sector * self.sector_size:(sector + 1) * self.sector_size] = content
+        return bytes(data)
+
+    def _directory_data(self, node):
+        entries = []
+        if node is self.root:
+            entries.append(self._short_entry(self.label, self.attr_volume_id, 0, 0, node.mtime))
+        else:
+            parent_cluster = 0 if node.parent is self.root else node.parent.cluster
+            entries.append(self._short_entry(b'.'.ljust(11), self.attr_directory, node.cluster, 0, node.mtime))
+            entries.append(self._short_entry(b'..'.ljust(11), self.attr_directory, parent_cluster, 0, node.mtime))
+        for child in node.children:
+            child.parent = node
+            if child.long_name:
+                entries.extend(self._long_entries(child.name, child.short_name))
+            if child.is_dir:
+                entries.append(self._short_entry(child.short_name, self.attr_directory, child.cluster, 0, child.mtime))
+            else:
+                entries.append(self._short_entry(child.short_name, self.attr_archive, child.cluster, child.size, child.mtime))
+        data = b''.join(entries)
+        return data.ljust(node.num_clusters * self.cluster_size, b'\x00')
+
+    def _short_entry(self, name, attr, cluster, size, mtime):
+        fat_date, fat_time = self._fat_timestamp(mtime)
+        return self.dir_entry_struct.pack(
+            name, attr, 0, 0, fat_time, fat_date, fat_date, cluster >> 16,
+            fat_time, fat_date, cluster & 0xffff, size
+        )
+
+    def _long_entries(self, name, short_name):
+        checksum = 0
+        for c in bytearray(short_name):
+            checksum = (((checksum & 1) << 7) + (checksum >> 1) + c) & 0xff
+        chars = name.encode('utf-16-le')
+        count = self._ceil_div(len(chars) // 2 + 1, 13)
+        chars = (chars + b'\x00\x00').ljust(count * 26, b'\xff')
+        entries = []
+        for i in range(count):
+            part = chars[i * 26:(i + 1) * 26]
+            order = i + 1
+            if i == count - 1:
+                order |= self.last_long_entry
+            entries.append(self.lfn_entry_struct.pack(
+                order, part[0:10], self.attr_long_name, 0, checksum, part[10:22], 0, part[22:26]
+            ))
+        # the entries of the end of the name come first
+        return reversed(entries)
+
+    def _fat_timestamp(self, mtime):
+        t = time.localtime(mtime)
+        if t.tm_year < 1980:
+            return (0 << 9) | (1 << 5) | 1, 0
+        fat_date = ((min(t.tm_year, 2107) - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+        fat_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+        return fat_date, fat_time
+
+    def _fat_sector(self, index, buf, offset):
+        '''
+        Write a sector of the FAT to a buffer (that is zeroed)
+        '''
+        first = index * (self.sector_size // 4)
+        last = first + self.sector_size // 4
+        if first == 0:
+            struct.pack_into('<II', buf, offset, 0x0ffffff8, self.end_of_chain)
+        i = max(bisect_right(self.extent_starts, first) - 1, 0)
+        extents = self.extents
+        while i < len(extents) and extents[i][0] < last:
+            start, count = extents[i][0], extents[i][1]
+            end = start + count
+            for cluster in range(max(start, first), min(end, last)):
+                value = cluster + 1 if cluster + 1 < end else self.end_of_chain
+                struct.pack_into('<I', buf, offset + (cluster - first) * 4, value)
+            i += 1
+
+    # the data sectors
+
+    def _read_file(self, node, offset, view):
+        f = self.open_files.pop(node.path, None)
+        if f is None:
+            f = open(node.path, 'rb')
+            if len(self.open_files) >= self.max_open_files:
+                self.open_files.popitem(last=False)[1].close()
+        self.open_files[node.path] = f
+        f.seek(offset)
+        # the size of the file in the directory entry is the size it had at startup
+        length = min(len(view), max(node.size - offset, 0))
+        received = 0
+        while received < length:
+            n = f.readinto(view[received:length])
+            if not n:
+                break
+            received += n
+
+    def _read_sectors(self, address, count, view):
+        sector = address
+        end = address + count
+        bs = self.sector_size
+        while sector < end:
+            pos = (sector - address) * bs
+            if sector < self.reserved_sectors:
+                n = min(end, self.reserved_sectors) - sector
+                view[pos:pos + n * bs] = self.reserved_data[sector * bs:(sector + n) * bs]
+            elif sector < self.data_start:
+                n = 1
+                self._fat_sector((sector - self.reserved_sectors) % self.fat_sectors, view, pos)
+            else:
+                cluster = (sector - self.data_start) // self.sectors_per_cluster + 2
+                i = bisect_right(self.extent_starts, cluster) - 1
+                if i >= 0 and cluster < self.extents[i][0] + self.extents[i][1]:
+                    start, num_clusters, data, node = self.extents[i]
+                    first_sector = self.data_start + (start - 2) * self.sectors_per_cluster
+                    n = min(end, first_sector + num_clusters * self.sectors_per_cluster) - sector
+                    offset = (sector - first_sector) * bs
+                    if data is not None:
+                        view[pos:pos + n * bs] = data[offset:offset + n * bs]
+                    else:
+                        self._read_file(node, offset, view[pos:pos + n * bs])
+                else:
+                    # free clusters, until the next extent
+                    next_start = self.extents[i + 1][0] if i + 1 < len(self.extents) else self.num_clusters + 2
+                    n = min(end, self.data_start + (next_start - 2) * self.sectors_per_cluster) - sector
+            sector += n
+
+    def get_sectors_view(self, address, count):
+        self.check_range(address, count)
+        data = memoryview(bytearray(count * self.block_size))
+        self._read_sectors(address, count, data)
+        return _overlay_sectors(data, address, count, self.block_size, self.sectors)
+
+    def write_sectors(self, address, data):
+        data = memoryview(data)
+        for i in range(len(data) // self.block_size):
+            self.sectors[address + i] = bytes(data[i * self.block_size:(i + 1) * self.block_size])
+
+    def close(self):
+        self.flush()
+        for f in self.open_files.values():
+            f.close()
+        self.open_files.clear()
@@ -1,77 +1,73 @@
 '''
 Kitty Controller for the Umap stack
 '''
-import os
 import time
 
 from kitty.controllers import ClientController
+from numap.fuzz.triggers import Command, DEFAULT_TRIGGER_DIR, trigger_senders
 
 
 class UmapController(ClientController):
     '''
     Trigger a USB reconnection -
-    Signal the Umap to disconnect / reconnect using files.
+    Signal the Umap to disconnect / reconnect,
+    over a unix domain socket or using files.
     '''
 
-    def __init__(self, pre_disconnect_delay=0.0, post_disconnect_delay=0.0):
+    #: delay between the disconnection and the reconnection in trigger(), per trigger mode
+    reconnect_delays = {
+        'socket': 0.0,
+        'file': 0.2,
+        'local': 0.0,
+    }
+
+    def __init__(self, pre_disconnect_delay=0.0, post_disconnect_delay=0.0, trigger_mode='socket', trigger_dir=DEFAULT_TRIGGER_DIR):
+        '''
+        :param pre_disconnect_delay: seconds to wait in post_test before disconnecting (default: 0.0)
+        :param post_disconnect_delay: seconds to wait in post_test after disconnecting (default: 0.0)
+        :param trigger_mode: how to signal the stack, 'socket', 'file' or 'local' (default: 'socket')
+        :param trigger_dir: directory of the socket or trigger files (default: /tmp/umap_kitty)
+        '''
         super(UmapController, self).__init__('UmapController')
-        self.trigger_dir = '/tmp/umap_kitty'
-        self.connect_file = 'trigger_reconnect'
-        self.disconnect_file = 'trigger_disconnect'
-        self.heartbeat_file = 'heartbeat'
+        self.trigger_mode = trigger_mode
+        self.triggers = trigger_senders[trigger_mode](trigger_dir, self.logger)
+        self.reconnect_delay = self.reconnect_delays[trigger_mode]
         self.pre_disconnect_delay = pre_disconnect_delay
         self.post_disconnect_delay = post_disconnect_delay
 
-    def del_file(self, filename):
-        path = os.path.join(self.trigger_dir, filename)
-        if os.path.isfile(path):
-            os.remove(path)
-
-    def cleanup_triggers(self):
-        if not os.path.isdir(self.trigger_dir):
-            if not os.path.exists(self.trigger_dir):
-                os.mkdir(self.trigger_dir)
-        self.del_file(self.connect_file)
-        self.del_file(self.disconnect_file)
-        self.del_file(self.heartbeat_file)
-
     def setup(self):
         super(UmapController, self).setup()
-        self.cleanup_triggers()
+        self.triggers.setup()
+
+    def teardown(self):
+        self.triggers.teardown()
+        super(UmapController, self).teardown()
 
     def trigger_connect(self):
         self.logger.info('trigger reconnection')
-        self.do(self.connect_file)
+        self.triggers.send(Command.connect)
 
     def trigger_disconnect(self):
         self.logger.info('trigger disconnection')
-        self.do(self.disconnect_file)
+        self.triggers.send(Command.disconnect)
+
+    def trigger_stop(self):
+        self.logger.info('trigger stop')
+        self.triggers.send(Command.stop)
 
     def trigger(self):
         self.trigger_disconnect()
-        time.sleep(0.2)
+        if self.reconnect_delay:
+            time.sleep(self.reconnect_delay)
         self.trigger_connect()
 
-    def do(self, filename):
-        count = 0
-        path = os.path.join(self.trigger_dir, filename)
-        open(path, 'a').close()
-        while os.path.isfile(path):
-            time.sleep(0.01)
-            count += 1
-            if count % 1000 == 0:
-                self.logger.warning('still waiting for umap_stack to remove the file %s' % path)
-
     def get_last_heartbeat(self):
         '''
         Return the time of the latest heartbeat received from the victim stack
         (via umap_stack).
         If no responses have ever been received from the victim, returns 0.
         '''
-        heartbeat_file = os.path.join(self.trigger_dir, self.heartbeat_file)
-        if not os.path.exists(heartbeat_file):
-            return 0
-        return os.path.getmtime(heartbeat_file)
+        return self.triggers.get_last_heartbeat()
 
     def pre_test(self, test_number):
         self.trigger_disconnect()
@@ -85,4 +81,3 @@ class UmapController(ClientController):
         if self.post_disconnect_delay:
             time.sleep(self.post_disconnect_delay)
         # reconnection will be handled when trigger() is called by the base class after pre_test
-
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+'''
+Pre-rendered mutation corpus of the fuzzing templates.
+
+Every mutation of every template is rendered once to a single file,
+so the fuzzer looks up mutation N of a template in a view of the mapped file
+instead of rendering it, and the payloads are the same for every kitty version.
+
+Usage:
+    numap-corpus build -o <corpus-file> [-s <stage-file>]
+    numap-corpus info <corpus-file>
+    numap-corpus show <corpus-file> <template> <index>
+
+Options:
+    -o --output <corpus-file>       corpus file to create
+    -s --stage-file <stage-file>    only render the templates of the stages in a stage file
+                                    (generated by numap-stages)
+
+File layout (little endian):
+
+    header  magic (8 bytes), version (uint32), template count (uint32), table offset (uint64)
+    payloads of all the mutations
+    indices one per template: (mutation count + 1) uint64 payload offsets
+    table   one entry per template: name length (uint16), mutation count (uint32),
+            index offset (uint64), name
+'''
+import mmap
+import struct
+import logging
+import binascii
+import docopt
+
+
+class CorpusWriter(object):
+    '''
+    Renders the mutations of templates to a corpus file
+    '''
+
+    magic = b'NUMAPCRP'
+    version = 1
+    header_struct = struct.Struct('<8sIIQ')
+    entry_struct = struct.Struct('<HIQ')
+
+    def __init__(self, filename):
+        '''
+        :param filename: corpus file to create
+        '''
+        self.filename = filename
+        self.fd = None
+        self.offsets = {}
+
+    def start(self):
+        self.fd = open(self.filename, 'wb')
+        self.fd.write(b'\x00' * self.header_struct.size)
+        self.offsets = {}
+
+    def add_template(self, template):
+        '''
+        Render all the mutations of a template
+
+        :param template: kitty template
+        :return: number of mutations
+        '''
+        offsets = [self.fd.tell()]
+        template.reset()
+        while template.mutate():
+            self.fd.write(template.render().tobytes())
+            offsets.append(self.fd.tell())
+        template.reset()
+        self.offsets[template.get_name()] = offsets
+        return len(offsets) - 1
+
+    def stop(self):
+        index_offsets = {}
+        for name, offsets in self.offsets.items():
+            index_offsets[name] = self.fd.tell()
+            self.fd.write(struct.pack('<%dQ' % len(offsets), *offsets))
+        table_offset = self.fd.tell()
+        for name, offsets in self.offsets.items():
+            encoded = name.encode()
+            self.fd.write(self.entry_struct.pack(len(encoded), len(offsets) - 1, index_offsets[name]))
+            self.fd.write(encoded)
+        self.fd.seek(0)
+        self.fd.write(self.header_struct.pack(self.magic, self.version, len(self.offsets), table_offset))
+        self.fd.close()
+        self.fd = None
+
+
+class Corpus(object):
+    '''
+    Read only view of a corpus file
+    '''
+
+    magic = CorpusWriter.magic
+    version = CorpusWriter.version
+    header_struct = CorpusWriter.header_struct
+    entry_struct = CorpusWriter.entry_struct
+    offset_struct = struct.Struct('<QQ')
+
+    def __init__(self, filename):
+        '''
+        :param filename: corpus file (created by numap-corpus build)
+        '''
+        self.filename = filename
+        self.logger = logging.getLogger('numap')
+        with open(filename, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mm)
+        magic, version, count, table_offset = self.header_struct.unpack_from(self.mm, 0)
+        if magic != self.magic or version != self.version:
+            self.view.release()
+            self.mm.close()
+            raise Exception('%s is not a numap corpus file (version %d)' % (filename, self.version))
+        # maps template name to (mutation count, index offset)
+        self.templates = {}
+        offset = table_offset
+        for _ in range(count):
+            name_len, mutations, index_offset = self.entry_struct.unpack_from(self.mm, offset)
+            offset += self.entry_struct.size
+            name = self.mm[offset:offset + name_len].decode()
+            offset += name_len
+            self.templates[name] = (mutations, index_offset)
+
+    def close(self):
+        self.view.release()
+        try:
+            self.mm.close()
+        except BufferError:
+            # payloads are still in use, the file is unmapped when the last one is released
+            pass
+
+    def num_mutations(self, name):
+        '''
+        :param name: template name
+        :return: number of mutations of the template, 0 if it is not in the corpus
+        '''
+        if name not in self.templates:
+            return 0
+        return self.templates[name][0]
+
+    def get_payload(self, name, index):
+        '''
+        :param name: template name
+        :param index: mutation index
+        :return: the rendered mutation, as a read only view of the corpus file
+            (copy it to keep it after :meth:`close`), None if it is not in the corpus
+        '''
+        entry = self.templates.get(name)
+        if entry is None or not 0 <= index < entry[0]:
+            return None
+        start, end = self.offset_struct.unpack_from(self.mm, entry[1] + index * 8)
+        return self.view[start:end]
+
+    def verify(self, templates):
+        '''
+        Drop the templates that do not match the templates in use,
+        their mutations will be rendered by the fuzzer.
+
+        :param templates: list of kitty templates
+        '''
+        for template in templates:
+            name = template.get_name()
+            if name in self.templates and self.templates[name][0] != template.num_mutations():
+                self.logger.warning(
+                    'corpus %s: template %s has %d mutations instead of %d, not using it' % (
+                        self.filename, name, self.templates[name][0], template.num_mutations()))
+                del self.templates[name]
+
+
+def build(options):
+    # the templates are only needed (and loaded) when building the corpus
+    from numap.fuzz.fuzz_engine import get_stages, get_templates
+    stages = None
+    if options['--stage-file']:
+        stages = get_stages(options['--stage-file'])
+    templates = get_templates(stages)
+    writer = CorpusWriter(options['--output'])
+    writer.start()
+    for name in sorted(templates):
+        count = writer.add_template(templates[name])
+        print('%s: %d mutations' % (name, count))
+    writer.stop()
+
+
+def info(options):
+    corpus = Corpus(options['<corpus-file>'])
+    for name in sorted(corpus.templates):
+        print('%s: %d mutations' % (name, corpus.num_mutations(name)))
+    corpus.close()
+
+
+def show(options):
+    corpus = Corpus(options['<corpus-file>'])
+    payload = corpus.get_payload(options['<template>'], int(options['<index>']))
+    if payload is None:
+        print('no such mutation')
+    else:
+        print(binascii.hexlify(payload).decode())
+    corpus.close()
+
+
+def main():
+    options = docopt.docopt(__doc__)
+    if options['build']:
+        build(options)
+    elif options['info']:
+        info(options)
+    elif options['show']:
+        show(options)
+
+
+if __name__ == '__main__':
+    main()
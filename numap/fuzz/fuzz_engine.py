@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 '''
 Usage:
-    numapkitty -s <stage-file> [-d <pre,post>] [-c <count>] [-k <options>]
+    numapkitty -s <stage-file> [-d <pre,post>] [-c <count>] [-t <mode>] [-k <options>] [--corpus <corpus-file>]
 
 Options:
     -c --count <count>                  stage count (e.g. how many times a stage might repeat
@@ -11,8 +11,13 @@ Options:
                                         failures to be matched with the correct test) [default: 0.0,0.0]
     -k --kitty-options <options>        options for the kitty fuzzer, use -k -h to get a full list
     -s --stage-file <stage-file>        path to stage trace from umap emulation run
+    -t --trigger <mode>                 how to signal numapfuzz to disconnect/reconnect,
+                                        socket or file [default: socket]
+    --corpus <corpus-file>              serve the mutations from a pre-rendered corpus
+                                        (created by numap-corpus build)
 '''
 import docopt
+from collections import OrderedDict
 from kitty.remote.rpc import RpcServer
 from kitty.fuzzers import ClientFuzzer
 from kitty.targets import ClientTarget
@@ -20,45 +25,143 @@ from kitty.interfaces import WebInterface
 from kitty.model import GraphModel
 from kitty.model import Template, Meta, String, UInt32
 
-from numap.fuzz.templates import audio, cdc, enum, generic, hid, hub, mass_storage
-from numap.fuzz.templates import smart_card
+from numap.fuzz.templates.registry import get_templates
 
 from numap.fuzz.controller import UmapController
+from numap.fuzz.stage_trace import read_stage_trace
+from numap.fuzz.corpus import Corpus
+from numap.fuzz.triggers import trigger_receivers
 
 
-def enumerate_templates(module):
+def _stage_name(stage):
     '''
-    :return: a list of templates that are in a module
+    Stage names are hex encoded by the RPC layer and arrive as bytes
     '''
-    member_names = sorted(dir(module))
-    templates = {}
-    for name in member_names:
-        member = getattr(module, name)
-        if isinstance(member, Template):
-            templates[member.name] = member
-        elif isinstance(member, dict):
-            for k, item in member.items():
-                if isinstance(item, Template):
-                    templates[item.name] = item
-        elif isinstance(member, list):
-            for item in member:
-                if isinstance(item, Template):
-                    templates[item.name] = item
-    return templates
+    if isinstance(stage, bytes):
+        return stage.decode()
+    return stage
+
+
+class NumapClientFuzzer(ClientFuzzer):
+    '''
+    Client fuzzer that also lets the stack fetch the mutation of the current
+    test at once (see :func:`get_test_mutations`), instead of asking for it
+    on each stage.
+    '''
+
+    def __init__(self, name='NumapClientFuzzer', logger=None, option_line=None):
+        super(NumapClientFuzzer, self).__init__(name, logger, option_line)
+        self._test_payload = None
+        self._corpus = None
+
+    def set_corpus(self, corpus):
+        '''
+        :param corpus: :class:`~numap.fuzz.corpus.Corpus` to serve the mutations from
+        '''
+        self._corpus = corpus
+
+    def _render_mutation(self, fuzz_node):
+        '''
+        :return: the current mutation of the node, from the corpus if it has it
+        '''
+        if self._corpus is not None:
+            payload = self._corpus.get_payload(fuzz_node.get_name(), fuzz_node._current_index)
+            if payload is not None:
+                # copied once, as the payload leaves the fuzzer: the RPC server only
+                # encodes bytes, and the devices build their responses from the payloads
+                return payload.tobytes()
+        return fuzz_node.render().tobytes()
+
+    def _pre_test(self):
+        self._test_payload = None
+        super(NumapClientFuzzer, self)._pre_test()
+
+    def get_mutation(self, stage, data):
+        stage = _stage_name(stage)
+        if data:
+            # session data changes the rendering, the corpus does not have it
+            return super(NumapClientFuzzer, self).get_mutation(stage, data)
+        payload = None
+        if self._keep_running():
+            fuzz_node = self._fuzz_path[self._index_in_path].dst
+            if self._should_fuzz_node(fuzz_node, stage):
+                payload = self._render_mutation(fuzz_node)
+                self._last_payload = payload
+            else:
+                self._update_path_index(stage)
+        if payload:
+            self._notify_mutated()
+        self._requested_stages.append((stage, payload))
+        return payload
+
+    def get_test_mutations(self):
+        '''
+        Get the mutations of the current test.
+        Only the last node in the test path is mutated, the preceding
+        (pseudo) nodes of the same stage are the hits that should not be mutated.
+
+        :return: dictionary of {stage: {'skip': hits to skip, 'payload': mutated payload}},
+            empty if not fuzzing
+        '''
+        mutations = {}
+        if self._keep_running() and self._fuzz_path:
+            fuzz_node = self._fuzz_path[-1].dst
+            if self._test_payload is None:
+                self._test_payload = self._render_mutation(fuzz_node)
+            mutations[fuzz_node.name] = {
+                'skip': len(self._fuzz_path) - 1,
+                'payload': self._test_payload,
+            }
+        return mutations
+
+    def signal_test_mutation_served(self):
+        '''
+        Called by the stack when it served the mutation fetched with :func:`get_test_mutations`
+        '''
+        self._notify_mutated()
+        return True
+
+    def report_stages(self, stages):
+        '''
+        Record the stages served by the stack from the fetched mutations,
+        in the order they were hit, as :func:`get_mutation` would have.
+
+        :param stages: list of stage names
+        '''
+        for stage in stages:
+            stage = _stage_name(stage)
+            payload = None
+            if self._keep_running():
+                fuzz_node = self._fuzz_path[self._index_in_path].dst
+                if self._should_fuzz_node(fuzz_node, stage):
+                    payload = self._test_payload
+                    self._last_payload = payload
+                else:
+                    self._update_path_index(stage)
+            self._requested_stages.append((stage, payload))
+        return True
 
 
 def get_stages(stage_file):
     '''
-    Get a dictionary (stage:count) from a stage file
+    Get a dictionary (stage:count) from a stage file.
+    The stages are ordered by their first hit, the count of a stage is
+    the number of times it repeats within a single enumeration cycle.
 
-    :param stage_file: filename with stage list (generated by numapstages)
-    :return: dictionary of stage:count
+    :param stage_file: filename with stage trace (generated by numapstages)
+    :return: ordered dictionary of stage:count
     '''
-    with open(stage_file, 'r') as f:
-        stages = [l.rstrip() for l in f.readlines()]
-    stage_count = {}
-    for stage in stages:
-        stage_count[stage] = stages.count(stage)
+    stage_count = OrderedDict()
+    cycle = None
+    cycle_count = {}
+    for hit in read_stage_trace(stage_file):
+        if hit.cycle != cycle:
+            cycle = hit.cycle
+            cycle_count = {}
+        count = cycle_count.get(hit.stage, 0) + 1
+        cycle_count[hit.stage] = count
+        if count > stage_count.get(hit.stage, 0):
+            stage_count[hit.stage] = count
     return stage_count
 
 
@@ -113,15 +216,7 @@ def get_model(options):
     '''
     stage_file = options['--stage-file']
     stages = get_stages(stage_file)
-    templates = {}
-    templates.update(enumerate_templates(audio))
-    templates.update(enumerate_templates(cdc))
-    templates.update(enumerate_templates(enum))
-    templates.update(enumerate_templates(generic))
-    templates.update(enumerate_templates(hid))
-    templates.update(enumerate_templates(hub))
-    templates.update(enumerate_templates(mass_storage))
-    templates.update(enumerate_templates(smart_card))
+    templates = get_templates(stages)
     g = GraphModel('usb model (%s)' % (stage_file))
     for stage in stages:
         if stage in templates:
@@ -144,32 +239,44 @@ def get_controller(options):
     except ValueError:
         msg = 'Please specify the --disconnect_delays as two comma-separated floats'
         raise Exception(msg)
-    return UmapController(pre_disconnect_delay, post_disconnect_delay)
+    trigger_mode = options['--trigger']
+    if trigger_mode not in trigger_receivers:
+        raise Exception('Unknown trigger mode %s, use one of: %s' % (trigger_mode, ', '.join(sorted(trigger_receivers))))
+    return UmapController(pre_disconnect_delay, post_disconnect_delay, trigger_mode)
 
 
-def get_fuzzer(options=None):
+def get_fuzzer(options=None, controller=None):
     '''
     Get fuzzer (non-remote)
 
     :param options: options
+    :param controller: controller of the target (default: None, build it from the options)
     :return: fuzzer
     '''
     local_options = {
         '--kitty-options': None,
         '--stage-file': None,
         '--count': '2',
-        '--disconnect-delays': '0.0,0.0'
+        '--disconnect-delays': '0.0,0.0',
+        '--trigger': 'socket',
+        '--corpus': None,
     }
     local_options.update(options)
-    fuzzer = ClientFuzzer(name='numap', option_line=local_options['--kitty-options'])
+    fuzzer = NumapClientFuzzer(name='numap', option_line=local_options['--kitty-options'])
     fuzzer.set_interface(WebInterface())
 
     target = ClientTarget(name='USBTarget')
-    target.set_controller(get_controller(local_options))
+    if controller is None:
+        controller = get_controller(local_options)
+    target.set_controller(controller)
     target.set_mutation_server_timeout(10)
 
     model = get_model(local_options)
     fuzzer.set_model(model)
+    if local_options['--corpus']:
+        corpus = Corpus(local_options['--corpus'])
+        corpus.verify(get_templates(get_stages(local_options['--stage-file'])).values())
+        fuzzer.set_corpus(corpus)
     fuzzer.set_target(target)
     return fuzzer
 
@@ -2,31 +2,32 @@
 This module contains helpers for fuzzing
 '''
 
+import logging
 import traceback
 import binascii
 import inspect
+import functools
+from numap.utils.ulogger import HexDump
+from numap.fuzz.stage_trace import StageLogger
+from numap.utils import latency
 
 
-class StageLogger(object):
-
-    def __init__(self, filename):
-        self.filename = filename
-        self.fd = None
-
-    def start(self):
-        self.fd = open(self.filename, 'wb')
+stage_logger = StageLogger('dummy')
 
-    def stop(self):
-        if self.fd:
-            self.fd.close()
 
-    def log_stage(self, stage):
-        if self.fd:
-            self.fd.write(stage + '\n')
-            self.fd.flush()
+class AppMode(object):
+    '''
+    How the running application uses the @mutable stages
+    '''
+    #: stages are called directly, no fuzzer is attached
+    emulate = 'emulate'
+    #: stages are logged to the stage logger, no fuzzer is attached
+    record_stages = 'record-stages'
+    #: stages are logged and mutations are requested from the fuzzer
+    fuzz = 'fuzz'
 
 
-stage_logger = StageLogger('dummy')
+app_mode = AppMode.fuzz
 
 
 def set_stage_logger(logger):
@@ -37,20 +38,88 @@ def set_stage_logger(logger):
     stage_logger = logger
 
 
-def log_stage(stage):
+def set_app_mode(mode):
+    '''
+    Set the mode of the running application.
+    It is checked by every @mutable stage before doing any fuzzing work.
+
+    :param mode: one of the :class:`AppMode` values
+    '''
+    global app_mode
+    app_mode = mode
+
+
+def log_stage(stage, request=None):
     global stage_logger
-    stage_logger.log_stage(stage)
+    stage_logger.log_stage(stage, request)
+
+
+def set_stage_request(request):
+    '''
+    Set the setup request being handled by the device,
+    recorded with the stages that do not get it as an argument (e.g. the descriptor stages).
+    Only kept when recording stages.
+
+    :param request: the setup request, None once it is handled
+    '''
+    global stage_logger
+    if app_mode is AppMode.record_stages:
+        stage_logger.request = request
+
+
+def flush_stage_log():
+    '''
+    Write the buffered stage hits to the stage trace
+    '''
+    global stage_logger
+    stage_logger.flush()
+
+
+def new_stage_cycle():
+    '''
+    Start a new enumeration cycle in the stage trace
+    '''
+    global stage_logger
+    stage_logger.new_cycle()
+
+
+def _stage_request(args):
+    '''
+    :return: the setup request in the arguments of a stage, None if there is none
+    '''
+    for arg in args:
+        if hasattr(arg, 'request_type'):
+            return arg
+    return None
 
 
 def mutable(stage, silent=False):
     def wrap_f(func):
         func_self = None
+        direct = func
+        log_level = logging.DEBUG if silent else logging.INFO
+        latency_stage = 'stage:%s' % stage
 
         if inspect.ismethod(func):
             func_self = func.__self__
             func = func.__func__
 
+        @functools.wraps(func)
         def wrapper(*args, **kwargs):
+            if latency.recorder is None:
+                if app_mode is AppMode.emulate:
+                    return direct(*args, **kwargs)
+                return call_stage(*args, **kwargs)
+            actor = func_self if func_self is not None else args[0]
+            return latency.recorder.timed_stage(actor, latency_stage, call_stage, *args, **kwargs)
+
+        def call_stage(*args, **kwargs):
+            if app_mode is AppMode.emulate:
+                return direct(*args, **kwargs)
+            if app_mode is AppMode.record_stages:
+                if not kwargs.get('valid', False):
+                    log_stage(stage, _stage_request(args))
+                return direct(*args, **kwargs)
             if func_self is None:
                 self = args[0]
                 args = tuple(args[1:])
@@ -59,6 +128,7 @@ def mutable(stage, silent=False):
             response = None
             valid_req = kwargs.get('valid', False)
             info = self.info if not silent else self.debug
+            logging_enabled = self.is_logging(log_level)
             if not valid_req:
                 log_stage(stage)
                 session_data = self.get_session_data(stage)
@@ -67,20 +137,21 @@ def mutable(stage, silent=False):
                 response = self.get_mutation(stage=stage, data=data)
             try:
                 if response is not None:
-                    if not silent:
-                        info('Got mutation for stage %s' % stage)
+                    if logging_enabled and not silent:
+                        info('Got mutation for stage %s', stage)
                 else:
-                    if valid_req:
-                        info('Calling %s' % (func.__name__))
-                    else:
-                        info('Calling %s (stage: "%s")' % (func.__name__, stage))
+                    if logging_enabled:
+                        if valid_req:
+                            info('Calling %s', func.__name__)
+                        else:
+                            info('Calling %s (stage: "%s")', func.__name__, stage)
                     response = func(self, *args, **kwargs)
             except Exception as e:
                 self.logger.error(traceback.format_exc())
                 self.logger.error(''.join(traceback.format_stack()))
                 raise e
-            if response is not None:
-                info('Response: %s' % response.hex())
+            if logging_enabled and response is not None:
+                info('Response: %s', HexDump(response))
             return response
         return wrapper
     return wrap_f
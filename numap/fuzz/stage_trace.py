@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+'''
+Stage traces, the stages hit by the host while emulating a device (recorded by numapstages).
+
+numapstages writes a binary trace: a header, then one fixed size record per stage hit
+with the stage id, enumeration cycle, monotonic timestamp and a summary of the
+setup request. A stage name is written once, after the first record that uses it.
+An enumeration cycle starts on each SET_ADDRESS request.
+
+numapkitty reads both the binary trace and the text trace,
+which has a header line and one "seq timestamp cycle stage" line per stage hit.
+Older text traces, with only the stage names, are read as a single cycle.
+
+Usage:
+    numap-stagetrace <trace-file> [-o <text-file>] [-r]
+
+Options:
+    -o --output <text-file>     write the text trace to a file instead of printing it
+    -r --requests               print the request of each stage hit (not readable by numapkitty)
+'''
+import sys
+import time
+import atexit
+import struct
+from collections import namedtuple
+import docopt
+
+
+#: a stage hit in a stage trace, request is (bmRequestType, bRequest, wValue, wIndex, wLength) or None
+StageHit = namedtuple('StageHit', ['seq', 'timestamp', 'cycle', 'stage', 'request'])
+
+TEXT_HEADER = '# numap stage trace v1'
+
+
+class StageLogger(object):
+    '''
+    Writes the stages hit by the host to a binary stage trace.
+    The records are buffered, and only written on :func:`flush`
+    (on disconnection), when the buffer is full and on :func:`stop` or exit.
+    '''
+
+    magic = b'NUMAPSTG'
+    version = 1
+    #: magic, version, wall clock and monotonic time at start
+    header_struct = struct.Struct('<8sIdd')
+    #: stage id, cycle, monotonic timestamp, request summary
+    record_struct = struct.Struct('<HIdBBHHH')
+    name_struct = struct.Struct('<B')
+    no_request = (0, 0, 0, 0, 0)
+    buffer_size = 1024 * 1024
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = None
+        self.cycle = 0
+        # maps stage name to stage id
+        self.stage_ids = {}
+        #: setup request being handled by the device (see :func:`~numap.fuzz.helpers.set_stage_request`)
+        self.request = None
+
+    def start(self):
+        self.fd = open(self.filename, 'wb', self.buffer_size)
+        self.fd.write(self.header_struct.pack(self.magic, self.version, time.time(), time.monotonic()))
+        atexit.register(self.stop)
+
+    def stop(self):
+        if self.fd:
+            self.fd.close()
+            self.fd = None
+
+    def flush(self):
+        if self.fd:
+            self.fd.flush()
+
+    def new_cycle(self):
+        self.cycle += 1
+
+    def log_stage(self, stage, request=None):
+        '''
+        :param stage: stage name
+        :param request: setup request of the stage (default: None, the request being handled)
+        '''
+        if self.fd:
+            if request is None:
+                request = self.request
+            stage_id = self.stage_ids.get(stage)
+            new_stage = stage_id is None
+            if new_stage:
+                stage_id = self.stage_ids[stage] = len(self.stage_ids)
+            if request is None:
+                summary = self.no_request
+            else:
+                summary = (request.request_type, request.request, request.value, request.index, request.length)
+            self.fd.write(self.record_struct.pack(stage_id, self.cycle, time.monotonic(), *summary))
+            if new_stage:
+                name = stage.encode()
+                self.fd.write(self.name_struct.pack(len(name)) + name)
+
+
+def _read_binary_trace(f):
+    header = StageLogger.header_struct
+    record = StageLogger.record_struct
+    name_struct = StageLogger.name_struct
+    magic, version, wall_start, monotonic_start = header.unpack(f.read(header.size))
+    if version != StageLogger.version:
+        raise Exception('Unsupported stage trace version %d' % version)
+    names = []
+    seq = 0
+    data = f.read(record.size)
+    while len(data) == record.size:
+        fields = record.unpack(data)
+        stage_id = fields[0]
+        if stage_id == len(names):
+            name_len, = name_struct.unpack(f.read(name_struct.size))
+            names.append(f.read(name_len).decode())
+        request = fields[3:] if any(fields[3:]) else None
+        yield StageHit(seq, wall_start + fields[2] - monotonic_start, fields[1], names[stage_id], request)
+        seq += 1
+        data = f.read(record.size)
+
+
+def _read_text_trace(f):
+    first = f.readline().decode().rstrip('\n')
+    if first == TEXT_HEADER:
+        for line in f:
+            seq, timestamp, cycle, stage = line.decode().rstrip('\n').split(' ', 3)
+            yield StageHit(int(seq), float(timestamp), int(cycle), stage, None)
+    else:
+        seq = 0
+        line = first
+        while True:
+            stage = line.rstrip()
+            if stage:
+                yield StageHit(seq, None, 0, stage, None)
+                seq += 1
+            line = f.readline()
+            if not line:
+                break
+            line = line.decode()
+
+
+def read_stage_trace(filename):
+    '''
+    Parse a stage trace (binary or text), one record at a time
+
+    :param filename: stage trace (generated by numapstages)
+    :return: generator of :class:`StageHit`
+    '''
+    with open(filename, 'rb') as f:
+        is_binary = f.read(len(StageLogger.magic)) == StageLogger.magic
+        f.seek(0)
+        reader = _read_binary_trace if is_binary else _read_text_trace
+        for hit in reader(f):
+            yield hit
+
+
+def write_text_trace(hits, f):
+    '''
+    Write stage hits in the text format
+
+    :param hits: iterable of :class:`StageHit`
+    :param f: text file to write to
+    '''
+    f.write(TEXT_HEADER + '\n')
+    for hit in hits:
+        f.write('%d %.6f %d %s\n' % (hit.seq, hit.timestamp or 0, hit.cycle, hit.stage))
+
+
+def main():
+    options = docopt.docopt(__doc__)
+    hits = read_stage_trace(options['<trace-file>'])
+    if options['--requests']:
+        for hit in hits:
+            request = ''
+            if hit.request:
+                request = 'bmRequestType=%#04x bRequest=%#04x wValue=%#06x wIndex=%#06x wLength=%d' % hit.request
+            print('%d %.6f %d %s %s' % (hit.seq, hit.timestamp or 0, hit.cycle, hit.stage, request))
+    elif options['--output']:
+        with open(options['--output'], 'w') as f:
+            write_text_trace(hits, f)
+    else:
+        write_text_trace(hits, sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+'''
+Registry of the fuzzing templates.
+
+Maps each stage name to the module and attribute of its template,
+so only the template modules of the fuzzed stages are imported
+(importing a module builds all of its templates).
+
+The registry is generated by importing all the template modules once,
+and is cached in ~/.cache/numap until one of the modules changes.
+'''
+import os
+import json
+import importlib
+import logging
+
+
+#: template modules, a template in a later module overrides one with the same name
+TEMPLATE_MODULES = ['audio', 'cdc', 'enum', 'generic', 'hid', 'hub', 'mass_storage', 'smart_card']
+
+REGISTRY_VERSION = 1
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'numap', 'template_registry.json')
+
+registry = None
+
+
+def _module_name(module):
+    return 'numap.fuzz.templates.%s' % module
+
+
+def _stamp():
+    '''
+    :return: size and modification time of the template modules
+    '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    stamp = {}
+    for module in TEMPLATE_MODULES:
+        st = os.stat(os.path.join(here, '%s.py' % module))
+        stamp[module] = [st.st_size, st.st_mtime]
+    return stamp
+
+
+def build_registry():
+    '''
+    Import all the template modules and find their templates
+
+    :return: dictionary of stage name: [module, attribute]
+    '''
+    from kitty.model import Template
+    templates = {}
+    for module in TEMPLATE_MODULES:
+        mod = importlib.import_module(_module_name(module))
+        for attribute in sorted(dir(mod)):
+            member = getattr(mod, attribute)
+            if isinstance(member, Template):
+                templates[member.get_name()] = [module, attribute]
+    return templates
+
+
+def load_registry(cache_file=DEFAULT_CACHE_FILE):
+    '''
+    Load the registry from the cache file, build (and cache) it if the cache is stale
+
+    :param cache_file: path of the cache file (default: ~/.cache/numap/template_registry.json)
+    :return: dictionary of stage name: [module, attribute]
+    '''
+    global registry
+    if registry is not None:
+        return registry
+    stamp = _stamp()
+    try:
+        with open(cache_file, 'r') as f:
+            cached = json.load(f)
+        if cached['version'] == REGISTRY_VERSION and cached['stamp'] == stamp:
+            registry = cached['templates']
+            return registry
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    registry = build_registry()
+    try:
+        cache_dir = os.path.dirname(cache_file)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(cache_file, 'w') as f:
+            json.dump({'version': REGISTRY_VERSION, 'stamp': stamp, 'templates': registry}, f)
+    except (IOError, OSError):
+        logging.getLogger('numap').warning('cannot write the template registry cache %s' % cache_file)
+    return registry
+
+
+def get_templates(names=None):
+    '''
+    Get templates by their stage names, importing only the modules that define them
+
+    :param names: stage names, stages without a template are ignored (default: None, all templates)
+    :return: dictionary of stage name: template
+    '''
+    entries = load_registry()
+    if names is None:
+        names = entries.keys()
+    templates = {}
+    for name in names:
+        if name in entries:
+            module, attribute = entries[name]
+            templates[name] = getattr(importlib.import_module(_module_name(module)), attribute)
+    return templates
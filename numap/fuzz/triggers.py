@@ -0,0 +1,504 @@
+'''
+Command channel between the kitty controller (:class:`~numap.fuzz.controller.UmapController`)
+and the fuzzed USB stack (numapfuzz).
+
+The controller sends connect/disconnect/stop commands and waits for the stack to
+acknowledge them, the stack sends heartbeats.
+Three transports are available:
+
+- socket: a unix domain socket in the trigger directory (default)
+- file: trigger files in the trigger directory, polled by both sides
+- local: queues, when the fuzzer runs inside numapfuzz (numapfuzz --local)
+'''
+import os
+import time
+import errno
+import socket
+import logging
+from threading import Thread, Event, Lock
+from collections import deque
+from six.moves.queue import Queue, Empty
+
+
+DEFAULT_TRIGGER_DIR = '/tmp/umap_kitty'
+
+
+class Command(object):
+    '''
+    Commands sent by the controller to the stack
+    '''
+    connect = 'connect'
+    disconnect = 'disconnect'
+    #: stop serving, the fuzzing session is over
+    stop = 'stop'
+
+
+class FileTriggerSender(object):
+    '''
+    Controller side of the file transport.
+    A command is sent by creating a file,
+    the stack acknowledges it by removing the file.
+    '''
+
+    trigger_files = {
+        Command.connect: 'trigger_reconnect',
+        Command.disconnect: 'trigger_disconnect',
+        Command.stop: 'trigger_stop',
+    }
+    heartbeat_file = 'heartbeat'
+
+    def __init__(self, trigger_dir=DEFAULT_TRIGGER_DIR, logger=None):
+        '''
+        :param trigger_dir: directory of the trigger files (default: /tmp/umap_kitty)
+        :param logger: logger (default: None)
+        '''
+        self.trigger_dir = trigger_dir
+        self.logger = logger or logging.getLogger('numap')
+
+    def _path(self, filename):
+        return os.path.join(self.trigger_dir, filename)
+
+    def _del_file(self, filename):
+        path = self._path(filename)
+        if os.path.isfile(path):
+            os.remove(path)
+
+    def setup(self):
+        if not os.path.exists(self.trigger_dir):
+            os.mkdir(self.trigger_dir)
+        for filename in self.trigger_files.values():
+            self._del_file(filename)
+        self._del_file(self.heartbeat_file)
+
+    def teardown(self):
+        pass
+
+    def send(self, command):
+        '''
+        Send a command and wait for the stack to acknowledge it
+
+        :param command: the command (one of :class:`Command`)
+        '''
+        count = 0
+        path = self._path(self.trigger_files[command])
+        open(path, 'a').close()
+        while os.path.isfile(path):
+            time.sleep(0.01)
+            count += 1
+            if count % 1000 == 0:
+                self.logger.warning('still waiting for umap_stack to remove the file %s' % path)
+
+    def get_last_heartbeat(self):
+        '''
+        :return: time of the latest heartbeat, 0 if none was received
+        '''
+        path = self._path(self.heartbeat_file)
+        if not os.path.exists(path):
+            return 0
+        return os.path.getmtime(path)
+
+
+class FileTriggerReceiver(object):
+    '''
+    Stack side of the file transport
+    '''
+
+    trigger_files = FileTriggerSender.trigger_files
+    heartbeat_file = FileTriggerSender.heartbeat_file
+
+    def __init__(self, trigger_dir=DEFAULT_TRIGGER_DIR):
+        '''
+        :param trigger_dir: directory of the trigger files (default: /tmp/umap_kitty)
+        '''
+        self.trigger_dir = trigger_dir
+
+    def _path(self, filename):
+        return os.path.join(self.trigger_dir, filename)
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def poll(self):
+        '''
+        :return: the pending command, None if there is no command
+        '''
+        if os.path.isfile(self._path(self.trigger_files[Command.disconnect])):
+            return Command.disconnect
+        if os.path.isfile(self._path(self.trigger_files[Command.connect])):
+            return Command.connect
+        if os.path.isfile(self._path(self.trigger_files[Command.stop])):
+            return Command.stop
+        return None
+
+    def wait(self):
+        '''
+        :return: the next command, blocks until one is received
+        '''
+        command = self.poll()
+        while command is None:
+            time.sleep(0.1)
+            command = self.poll()
+        return command
+
+    def ack(self, command):
+        '''
+        Acknowledge a command
+
+        :param command: the command
+        '''
+        path = self._path(self.trigger_files[command])
+        if os.path.isfile(path):
+            os.remove(path)
+
+    def heartbeat(self):
+        path = self._path(self.heartbeat_file)
+        if os.path.isdir(self.trigger_dir):
+            with open(path, 'a'):
+                os.utime(path, None)
+
+
+class SocketTriggerSender(object):
+    '''
+    Controller side of the socket transport.
+    Listens on a unix domain socket for the stack to connect.
+    Messages are newline terminated:
+    the controller sends commands, the stack sends "ack <command>" and "heartbeat".
+    '''
+
+    socket_file = 'trigger.sock'
+    ack_timeout = 10
+
+    def __init__(self, trigger_dir=DEFAULT_TRIGGER_DIR, logger=None):
+        '''
+        :param trigger_dir: directory of the socket file (default: /tmp/umap_kitty)
+        :param logger: logger (default: None)
+        '''
+        self.trigger_dir = trigger_dir
+        self.path = os.path.join(trigger_dir, self.socket_file)
+        self.logger = logger or logging.getLogger('numap')
+        self.server = None
+        self.conn = None
+        self.conn_lock = Lock()
+        self.connected = Event()
+        self.acks = Queue()
+        self.last_heartbeat = 0
+        self.thread = None
+
+    def setup(self):
+        if not os.path.exists(self.trigger_dir):
+            os.mkdir(self.trigger_dir)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen(1)
+        self.thread = Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def teardown(self):
+        server = self.server
+        self.server = None
+        if server:
+            try:
+                server.shutdown(socket.SHUT_RDWR)
+            except (OSError, socket.error):
+                pass
+            server.close()
+        with self.conn_lock:
+            if self.conn:
+                # wake up the thread reading it, and let the stack see the disconnection
+                try:
+                    self.conn.shutdown(socket.SHUT_RDWR)
+                except (OSError, socket.error):
+                    pass
+                self.conn.close()
+                self.conn = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _serve(self):
+        '''
+        Accept the stack connections and read their messages,
+        one connection at a time (e.g. after numapfuzz is restarted)
+        '''
+        server = self.server
+        while self.server is server:
+            try:
+                conn, _ = server.accept()
+            except (OSError, socket.error):
+                break
+            with self.conn_lock:
+                self.conn = conn
+            self.connected.set()
+            self._read_messages(conn)
+            with self.conn_lock:
+                if self.conn is conn:
+                    self.conn = None
+                    self.connected.clear()
+
+    def _read_messages(self, conn):
+        buff = b''
+        while True:
+            try:
+                data = conn.recv(4096)
+            except (OSError, socket.error):
+                return
+            if not data:
+                return
+            buff += data
+            while b'\n' in buff:
+                line, buff = buff.split(b'\n', 1)
+                line = line.decode()
+                if line == 'heartbeat':
+                    self.last_heartbeat = time.time()
+                elif line.startswith('ack '):
+                    self.acks.put(line[4:])
+
+    def send(self, command):
+        '''
+        Send a command and wait for the stack to acknowledge it.
+        If the stack reconnects meanwhile, the command is sent again.
+
+        :param command: the command (one of :class:`Command`)
+        '''
+        waited = 0
+        while True:
+            while not self.connected.wait(self.ack_timeout):
+                waited += self.ack_timeout
+                self.logger.warning('still waiting for umap_stack to connect to %s (%ds)' % (self.path, waited))
+            with self.conn_lock:
+                conn = self.conn
+            if conn is None:
+                continue
+            while not self.acks.empty():
+                self.acks.get_nowait()
+            try:
+                conn.sendall(('%s\n' % command).encode())
+            except (OSError, socket.error):
+                continue
+            while conn is self.conn:
+                try:
+                    if self.acks.get(timeout=self.ack_timeout) == command:
+                        return
+                except Empty:
+                    waited += self.ack_timeout
+                    self.logger.warning('still waiting for umap_stack to ack %s (%ds)' % (command, waited))
+
+    def get_last_heartbeat(self):
+        '''
+        :return: time of the latest heartbeat, 0 if none was received
+        '''
+        return self.last_heartbeat
+
+
+class SocketTriggerReceiver(object):
+    '''
+    Stack side of the socket transport.
+    Connects to the controller socket, retrying while it does not exist.
+    '''
+
+    socket_file = SocketTriggerSender.socket_file
+    retry_interval = 1.0
+
+    def __init__(self, trigger_dir=DEFAULT_TRIGGER_DIR):
+        '''
+        :param trigger_dir: directory of the socket file (default: /tmp/umap_kitty)
+        '''
+        self.path = os.path.join(trigger_dir, self.socket_file)
+        self.sock = None
+        self.next_retry = 0
+        self.buff = b''
+        self.commands = deque()
+
+    def open(self):
+        self._connect()
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def _connect(self):
+        self.next_retry = time.time() + self.retry_interval
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except (OSError, socket.error):
+            sock.close()
+            return False
+        self.sock = sock
+        self.buff = b''
+        return True
+
+    def _receive(self, blocking):
+        '''
+        Receive pending data and queue the complete commands
+
+        :param blocking: whether to wait for data
+        '''
+        try:
+            data = self.sock.recv(4096, 0 if blocking else socket.MSG_DONTWAIT)
+        except (OSError, socket.error) as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = b''
+        if not data:
+            # controller is gone, reconnect later
+            self.close()
+            return
+        self.buff += data
+        while b'\n' in self.buff:
+            line, self.buff = self.buff.split(b'\n', 1)
+            self.commands.append(line.decode())
+
+    def poll(self):
+        '''
+        :return: the pending command, None if there is no command
+        '''
+        if not self.commands:
+            if self.sock is None:
+                if time.time() < self.next_retry or not self._connect():
+                    return None
+            self._receive(False)
+            if not self.commands:
+                return None
+        return self.commands.popleft()
+
+    def wait(self):
+        '''
+        :return: the next command, blocks until one is received
+        '''
+        while not self.commands:
+            if self.sock is None:
+                if not self._connect():
+                    time.sleep(self.retry_interval)
+                    continue
+            self._receive(True)
+        return self.commands.popleft()
+
+    def _send(self, msg):
+        if self.sock:
+            try:
+                self.sock.sendall(msg)
+            except (OSError, socket.error):
+                self.close()
+
+    def ack(self, command):
+        '''
+        Acknowledge a command
+
+        :param command: the command
+        '''
+        self._send(('ack %s\n' % command).encode())
+
+    def heartbeat(self):
+        self._send(b'heartbeat\n')
+
+
+class QueueTriggerSender(object):
+    '''
+    Controller side of the in-process transport, used when the fuzzer runs
+    inside numapfuzz (numapfuzz --local)
+    '''
+
+    ack_timeout = 10
+
+    def __init__(self, trigger_dir=None, logger=None):
+        '''
+        :param trigger_dir: unused
+        :param logger: logger (default: None)
+        '''
+        self.logger = logger or logging.getLogger('numap')
+        self.commands = Queue()
+        self.acks = Queue()
+        self.last_heartbeat = 0
+
+    def setup(self):
+        pass
+
+    def teardown(self):
+        pass
+
+    def send(self, command):
+        '''
+        Send a command and wait for the stack to acknowledge it
+
+        :param command: the command (one of :class:`Command`)
+        '''
+        waited = 0
+        self.commands.put(command)
+        while True:
+            try:
+                if self.acks.get(timeout=self.ack_timeout) == command:
+                    return
+            except Empty:
+                waited += self.ack_timeout
+                self.logger.warning('still waiting for umap_stack to ack %s (%ds)' % (command, waited))
+
+    def get_last_heartbeat(self):
+        '''
+        :return: time of the latest heartbeat, 0 if none was received
+        '''
+        return self.last_heartbeat
+
+
+class QueueTriggerReceiver(object):
+    '''
+    Stack side of the in-process transport
+    '''
+
+    def __init__(self, sender):
+        '''
+        :param sender: the :class:`QueueTriggerSender` of the controller
+        '''
+        self.sender = sender
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def poll(self):
+        '''
+        :return: the pending command, None if there is no command
+        '''
+        try:
+            return self.sender.commands.get_nowait()
+        except Empty:
+            return None
+
+    def wait(self):
+        '''
+        :return: the next command, blocks until one is received
+        '''
+        return self.sender.commands.get()
+
+    def ack(self, command):
+        '''
+        Acknowledge a command
+
+        :param command: the command
+        '''
+        self.sender.acks.put(command)
+
+    def heartbeat(self):
+        self.sender.last_heartbeat = time.time()
+
+
+trigger_senders = {
+    'socket': SocketTriggerSender,
+    'file': FileTriggerSender,
+    'local': QueueTriggerSender,
+}
+
+# the in-process receiver is created from its sender (see QueueTriggerReceiver)
+
+trigger_receivers = {
+    'socket': SocketTriggerReceiver,
+    'file': FileTriggerReceiver,
+}
@@ -0,0 +1,319 @@
+'''
+Host personalities of the virtual host (see :class:`~numap.phy.vhost.VirtualHostPhy`).
+
+A personality drives a full session against the emulated device:
+enumeration (descriptors, SET_ADDRESS, SET_CONFIGURATION),
+the class requests of the drivers it has for the interfaces,
+and polling of the IN endpoints.
+The personalities differ in the order and the lengths of their requests,
+like the hosts they are named after.
+'''
+import struct
+import logging
+from collections import namedtuple
+from numap.core.usb import DescriptorType
+from numap.core.usb_class import USBClass
+
+
+# bmRequestType values
+STANDARD_IN = 0x80
+STANDARD_OUT = 0x00
+CLASS_INTERFACE_IN = 0xa1
+CLASS_INTERFACE_OUT = 0x21
+CLASS_DEVICE_IN = 0xa0
+STANDARD_INTERFACE_IN = 0x81
+
+GET_STATUS = 0x00
+SET_ADDRESS = 0x05
+GET_DESCRIPTOR = 0x06
+SET_CONFIGURATION = 0x09
+
+Endpoint = namedtuple('Endpoint', ['address', 'attributes', 'max_packet_size'])
+
+
+class Interface(object):
+    '''
+    Interface, as parsed from a configuration descriptor
+    '''
+
+    def __init__(self, number, alternate, interface_class, subclass, protocol):
+        self.number = number
+        self.alternate = alternate
+        self.interface_class = interface_class
+        self.subclass = subclass
+        self.protocol = protocol
+        self.endpoints = []
+        # class specific descriptors, as (type, descriptor) tuples
+        self.descriptors = []
+
+    def get_endpoint(self, direction_in, transfer_type):
+        '''
+        :param direction_in: whether to look for an IN endpoint
+        :param transfer_type: endpoint transfer type (2: bulk, 3: interrupt)
+        :return: the first matching endpoint number, None if there is none
+        '''
+        for ep in self.endpoints:
+            if bool(ep.address & 0x80) == direction_in and ep.attributes & 0x3 == transfer_type:
+                return ep.address & 0x7f
+        return None
+
+
+def parse_configuration(data):
+    '''
+    Parse the interfaces of a configuration descriptor.
+    Parsing stops at the first malformed descriptor.
+
+    :param data: the configuration descriptor
+    :return: list of :class:`Interface`
+    '''
+    interfaces = []
+    offset = 0
+    while offset + 2 <= len(data):
+        length, dtype = struct.unpack_from('<BB', data, offset)
+        if length < 2 or offset + length > len(data):
+            break
+        if dtype == DescriptorType.interface and length >= 9:
+            number, alternate, _, iclass, subclass, protocol = struct.unpack_from('<BBBBBB', data, offset + 2)
+            interfaces.append(Interface(number, alternate, iclass, subclass, protocol))
+        elif dtype == DescriptorType.endpoint and length >= 7 and interfaces:
+            address, attributes, max_packet_size = struct.unpack_from('<BBH', data, offset + 2)
+            interfaces[-1].endpoints.append(Endpoint(address, attributes, max_packet_size))
+        elif interfaces:
+            interfaces[-1].descriptors.append((dtype, bytes(data[offset:offset + length])))
+        offset += length
+    return interfaces
+
+
+class VirtualHost(object):
+    '''
+    Base host personality, enumerates the device like Linux does
+    '''
+
+    name = 'linux'
+    #: length of the first GET_DESCRIPTOR(device) request, before SET_ADDRESS
+    first_descriptor_length = 64
+    #: length of the first GET_DESCRIPTOR(configuration) request
+    configuration_probe_length = 9
+    #: length of the string descriptor requests, 0 to request the length first
+    string_length = 255
+    language_id = 0x0409
+    #: number of times each IN endpoint is polled at the end of the session
+    poll_rounds = 4
+    #: how long to wait for the data of a bulk transfer, in seconds
+    bulk_timeout = 1.0
+
+    def __init__(self):
+        self.logger = logging.getLogger('numap')
+        self.address = 0
+        self.device_descriptor = None
+        self.interfaces = []
+        self.tag = 0
+        # class drivers, by interface class
+        self.class_drivers = {
+            USBClass.CDC: self.cdc_driver,
+            USBClass.HID: self.hid_driver,
+            USBClass.Printer: self.printer_driver,
+            USBClass.MassStorage: self.mass_storage_driver,
+            USBClass.Hub: self.hub_driver,
+        }
+
+    def run_session(self, phy):
+        '''
+        Enumerate the device, let the class drivers talk to it, then poll it
+
+        :param phy: the :class:`~numap.phy.vhost.VirtualHostPhy`
+        :return: whether the device was configured
+        '''
+        if not self.enumerate(phy):
+            self.logger.warning('virtual host (%s): enumeration failed' % self.name)
+            return False
+        for interface in self.interfaces:
+            driver = self.class_drivers.get(interface.interface_class)
+            if driver is not None:
+                driver(phy, interface)
+        for _ in range(self.poll_rounds):
+            self.poll(phy)
+        return True
+
+    def poll(self, phy):
+        '''
+        Poll each interrupt and bulk IN endpoint of the configuration once
+        '''
+        for interface in self.interfaces:
+            for ep in interface.endpoints:
+                if ep.address & 0x80 and ep.attributes & 0x3 in (2, 3):
+                    phy.bulk_in(ep.address & 0x7f)
+
+    def get_descriptor(self, phy, dtype, dindex, length, index=0):
+        return phy.control_transfer(STANDARD_IN, GET_DESCRIPTOR, (dtype << 8) | dindex, index, length)
+
+    def next_address(self):
+        self.address = self.address % 127 + 1
+        return self.address
+
+    def get_device_descriptor(self, phy):
+        if self.get_descriptor(phy, DescriptorType.device, 0, self.first_descriptor_length) is None:
+            return False
+        phy.control_transfer(STANDARD_OUT, SET_ADDRESS, self.next_address(), 0, 0)
+        self.device_descriptor = self.get_descriptor(phy, DescriptorType.device, 0, 18)
+        return self.device_descriptor is not None and len(self.device_descriptor) >= 18
+
+    def get_configuration_descriptor(self, phy, index):
+        '''
+        :return: the full configuration descriptor, None if the device stalled
+        '''
+        probe = self.get_descriptor(phy, DescriptorType.configuration, index, self.configuration_probe_length)
+        if probe is None or len(probe) < 4:
+            return None
+        total_length, = struct.unpack_from('<H', probe, 2)
+        if total_length <= len(probe):
+            return probe
+        return self.get_descriptor(phy, DescriptorType.configuration, index, total_length)
+
+    def get_string(self, phy, index):
+        language_id = self.language_id if index else 0
+        if self.string_length:
+            return self.get_descriptor(phy, DescriptorType.string, index, self.string_length, language_id)
+        probe = self.get_descriptor(phy, DescriptorType.string, index, 2, language_id)
+        if not probe:
+            return None
+        return self.get_descriptor(phy, DescriptorType.string, index, bytearray(probe)[0], language_id)
+
+    def get_strings(self, phy):
+        self.get_string(phy, 0)
+        for index in bytearray(self.device_descriptor[14:17]):
+            if index:
+                self.get_string(phy, index)
+
+    def get_extra_descriptors(self, phy):
+        '''
+        Descriptors requested after the device descriptor, by the specific host
+        '''
+        bcd_usb, = struct.unpack_from('<H', self.device_descriptor, 2)
+        if bcd_usb >= 0x0201:
+            bos = self.get_descriptor(phy, DescriptorType.bos, 0, 5)
+            if bos and len(bos) >= 4:
+                self.get_descriptor(phy, DescriptorType.bos, 0, struct.unpack_from('<H', bos, 2)[0])
+
+    def enumerate(self, phy):
+        '''
+        :return: whether the device was configured
+        '''
+        self.interfaces = []
+        if not self.get_device_descriptor(phy):
+            return False
+        self.get_extra_descriptors(phy)
+        configuration = self.get_configuration_descriptor(phy, 0)
+        if configuration is None:
+            return False
+        self.get_strings(phy)
+        self.interfaces = parse_configuration(configuration)
+        configuration_value = bytearray(configuration)[5] if len(configuration) > 5 else 1
+        if phy.control_transfer(STANDARD_OUT, SET_CONFIGURATION, configuration_value, 0, 0) is None:
+            return False
+        return True
+
+    # class drivers
+
+    def cdc_driver(self, phy, interface):
+        if interface.subclass != 0x02:
+            return
+        line_coding = struct.pack('<IBBB', 115200, 0, 0, 8)
+        phy.control_transfer(CLASS_INTERFACE_OUT, 0x20, 0, interface.number, len(line_coding), line_coding)
+        phy.control_transfer(CLASS_INTERFACE_IN, 0x21, 0, interface.number, 7)
+        phy.control_transfer(CLASS_INTERFACE_OUT, 0x22, 0x0003, interface.number, 0)
+
+    def hid_driver(self, phy, interface):
+        phy.control_transfer(CLASS_INTERFACE_OUT, 0x0a, 0, interface.number, 0)
+        report_length = 256
+        for dtype, descriptor in interface.descriptors:
+            if dtype == DescriptorType.hid and len(descriptor) >= 9:
+                report_length, = struct.unpack_from('<H', descriptor, 7)
+        phy.control_transfer(STANDARD_INTERFACE_IN, GET_DESCRIPTOR, DescriptorType.report << 8, interface.number, report_length)
+
+    def printer_driver(self, phy, interface):
+        phy.control_transfer(CLASS_INTERFACE_IN, 0x00, 0, (interface.number << 8) | interface.alternate, 1024)
+        phy.control_transfer(CLASS_INTERFACE_IN, 0x01, 0, interface.number, 1)
+
+    def hub_driver(self, phy, interface):
+        phy.control_transfer(CLASS_DEVICE_IN, GET_DESCRIPTOR, DescriptorType.hub << 8, 0, 71)
+        phy.control_transfer(CLASS_DEVICE_IN, GET_STATUS, 0, 0, 4)
+
+    def mass_storage_driver(self, phy, interface):
+        if interface.protocol != 0x50:
+            return
+        ep_out = interface.get_endpoint(False, 2)
+        ep_in = interface.get_endpoint(True, 2)
+        if ep_out is None or ep_in is None:
+            return
+        phy.control_transfer(CLASS_INTERFACE_IN, 0xfe, 0, interface.number, 1)
+        commands = [
+            (b'\x12\x00\x00\x00\x24\x00', 36),                      # INQUIRY
+            (b'\x00\x00\x00\x00\x00\x00', 0),                       # TEST UNIT READY
+            (b'\x25' + b'\x00' * 9, 8),                             # READ CAPACITY(10)
+            (b'\x1a\x00\x3f\x00\xc0\x00', 192),                     # MODE SENSE(6)
+            (b'\x28\x00\x00\x00\x00\x00\x00\x00\x01\x00', 512),     # READ(10), first block
+        ]
+        max_packet_size = [ep.max_packet_size for ep in interface.endpoints if ep.address == ep_in | 0x80][0]
+        for cdb, length in commands:
+            self.scsi_command(phy, ep_out, ep_in, cdb, length, max_packet_size)
+
+    def scsi_command(self, phy, ep_out, ep_in, cdb, length, max_packet_size=64):
+        '''
+        Run a SCSI command over the bulk only transport
+
+        :param max_packet_size: max packet size of the IN endpoint,
+            a shorter packet ends the data stage (default: 64)
+        :return: the CSW status, None if the device did not send one
+        '''
+        self.tag = (self.tag + 1) & 0xffffffff
+        flags = 0x80 if length else 0x00
+        cbw = struct.pack('<4sIIBBB', b'USBC', self.tag, length, flags, 0, len(cdb)) + cdb.ljust(16, b'\x00')
+        phy.bulk_out(ep_out, cbw)
+        received = 0
+        response = phy.bulk_in(ep_in, self.bulk_timeout)
+        while length and response is not None and not self._is_csw(response):
+            # data stage, until all the data or a short packet is received
+            received += len(response)
+            done = received >= length or len(response) < max_packet_size
+            response = phy.bulk_in(ep_in, self.bulk_timeout)
+            if done:
+                break
+        if response is None or not self._is_csw(response):
+            return None
+        return bytearray(response)[12]
+
+    def _is_csw(self, data):
+        return len(data) == 13 and data[:4] == b'USBS'
+
+
+class WindowsHost(VirtualHost):
+    '''
+    Reads 255 bytes of the configuration descriptor at once,
+    and asks for the device qualifier and the Microsoft OS string descriptor
+    '''
+
+    name = 'windows'
+    configuration_probe_length = 255
+
+    def get_extra_descriptors(self, phy):
+        self.get_descriptor(phy, DescriptorType.device_qualifier, 0, 10)
+        self.get_descriptor(phy, DescriptorType.string, 0xee, 0x12)
+
+
+class MacHost(VirtualHost):
+    '''
+    Reads only the first 8 bytes of the device descriptor before SET_ADDRESS,
+    and the length of each string descriptor before the string itself
+    '''
+
+    name = 'macos'
+    first_descriptor_length = 8
+    string_length = 0
+
+
+hosts = {
+    VirtualHost.name: VirtualHost,
+    WindowsHost.name: WindowsHost,
+    MacHost.name: MacHost,
+}
@@ -0,0 +1,374 @@
+'''
+Transfer trace of the emulated traffic, in the pcap format of Linux usbmon
+(link type LINKTYPE_USB_LINUX_MMAPPED), so it can be opened with Wireshark.
+
+:class:`TracingPhy` wraps the phy of the application and records, from the host point of view,
+the SETUP and OUT transfers handed to the device and the data, empty responses and stalls
+it sends back. Each transfer is written as a submission ('S') and a completion ('C') event.
+
+The events are packed into a preallocated ring buffer and written to the file
+by a background thread, so tracing does not wait for the disk.
+If the ring buffer fills up, new events are dropped (and counted) instead.
+
+Enable it with ``--pcap <file>`` on the numap applications.
+'''
+import time
+import atexit
+import struct
+import logging
+import threading
+import itertools
+from collections import namedtuple
+from numap.core.usb_device import USBDeviceRequest
+
+
+class Usbmon(object):
+    '''
+    Constants of the usbmon binary format
+    '''
+    linktype = 220
+    # event types
+    submit = ord('S')
+    complete = ord('C')
+    # transfer types, indexed by the USB endpoint transfer type
+    # (control, isochronous, bulk, interrupt)
+    xfer_types = (2, 0, 3, 1)
+    xfer_control = 2
+    xfer_bulk = 3
+    # flags
+    setup_present = 0
+    setup_absent = ord('-')
+    data_present = 0
+    data_in = ord('<')
+    data_out = ord('>')
+    # statuses
+    status_ok = 0
+    status_in_progress = -115
+    status_stall = -32
+    busnum = 1
+    no_setup = b'\x00' * 8
+
+
+#: a usbmon event read from a pcap file
+UsbmonEvent = namedtuple('UsbmonEvent', [
+    'timestamp', 'urb_id', 'event_type', 'xfer_type', 'epnum', 'devnum', 'flag_setup', 'status', 'length', 'setup', 'data'
+])
+
+
+class PcapRingWriter(object):
+    '''
+    Writes usbmon events to a pcap file through a ring buffer
+    '''
+
+    #: magic, version major/minor, thiszone, sigfigs, snaplen, linktype
+    file_header = struct.Struct('<IHHiIII')
+    #: ts_sec, ts_usec, incl_len, orig_len
+    pcap_record_header = struct.Struct('<IIII')
+    #: id, type, xfer_type, epnum, devnum, busnum, flag_setup, flag_data, ts_sec, ts_usec,
+    #: status, length, len_cap, setup, interval, start_frame, xfer_flags, ndesc
+    usbmon_header = struct.Struct('<QBBBBHBBqiiII8siiII')
+    #: both headers, packed at once
+    record_header = struct.Struct(pcap_record_header.format + usbmon_header.format[1:])
+    snaplen = 0x40000
+
+    def __init__(self, filename, buffer_size=4 * 1024 * 1024, flush_interval=0.1):
+        '''
+        :param filename: pcap file to write
+        :param buffer_size: size of the ring buffer, in bytes (default: 4MB)
+        :param flush_interval: how often the background thread writes the buffer, in seconds (default: 0.1)
+        '''
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.size = buffer_size
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        # total bytes written to / read from the ring buffer
+        self.head = 0
+        self.tail = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+        # serializes the flushes of the background thread and of the callers
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = False
+        self.thread = None
+        self.fd = None
+        self.logger = logging.getLogger('numap')
+
+    def start(self):
+        self.fd = open(self.filename, 'wb')
+        self.fd.write(self.file_header.pack(0xa1b2c3d4, 2, 4, 0, 0, self.snaplen, Usbmon.linktype))
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='pcap-writer')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+        self.fd.close()
+        if self.dropped:
+            self.logger.warning('pcap trace: %d events dropped, the ring buffer was full' % self.dropped)
+
+    def _run(self):
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        '''
+        Write the buffered events to the file
+        '''
+        with self.flush_lock:
+            head = self.head
+            tail = self.tail
+            if head == tail:
+                return
+            start = tail % self.size
+            end = start + head - tail
+            if end <= self.size:
+                self.fd.write(self.view[start:end])
+            else:
+                self.fd.write(self.view[start:])
+                self.fd.write(self.view[:end - self.size])
+            self.fd.flush()
+            with self.lock:
+                self.tail = head
+
+    def write(self, urb_id, event_type, xfer_type, epnum, devnum, flag_setup, status, length, setup, data):
+        '''
+        Add a usbmon event to the ring buffer
+
+        :param urb_id: id of the transfer, shared by its submission and completion
+        :param event_type: Usbmon.submit or Usbmon.complete
+        :param xfer_type: usbmon transfer type
+        :param epnum: endpoint address (with the direction bit)
+        :param devnum: device address
+        :param flag_setup: Usbmon.setup_present or Usbmon.setup_absent
+        :param status: transfer status
+        :param length: length of the transfer
+        :param setup: setup packet (8 bytes)
+        :param data: captured data
+        '''
+        now = time.time()
+        sec = int(now)
+        usec = int((now - sec) * 1000000)
+        data_len = len(data)
+        if data_len:
+            flag_data = Usbmon.data_present
+        else:
+            flag_data = Usbmon.data_in if epnum & 0x80 else Usbmon.data_out
+        header = self.record_header
+        record_len = header.size + data_len
+        captured_len = self.usbmon_header.size + data_len
+        fields = (
+            sec, usec, captured_len, captured_len,
+            urb_id, event_type, xfer_type, epnum, devnum, Usbmon.busnum, flag_setup, flag_data,
+            sec, usec, status, length, data_len, setup, 0, 0, 0, 0
+        )
+        with self.lock:
+            if record_len > self.size - (self.head - self.tail):
+                self.dropped += 1
+                return
+            pos = self.head % self.size
+            if pos + record_len <= self.size:
+                header.pack_into(self.buffer, pos, *fields)
+                self.buffer[pos + header.size:pos + record_len] = data
+            else:
+                record = header.pack(*fields) + bytes(data)
+                first = self.size - pos
+                self.buffer[pos:] = record[:first]
+                self.buffer[:record_len - first] = record[first:]
+            self.head += record_len
+            pending = self.head - self.tail
+        if pending > self.size // 2:
+            self.wakeup.set()
+
+
+class _TracedDevice(object):
+    '''
+    The device as seen by the wrapped phy, traces the transfers from the host
+    '''
+
+    def __init__(self, device, tracer):
+        self.device = device
+        self.tracer = tracer
+
+    def __getattr__(self, name):
+        return getattr(self.device, name)
+
+    def handle_request(self, req):
+        self.tracer.trace_control(req)
+
+    def handle_data_available(self, ep_num, data):
+        self.tracer.trace_out(ep_num, data)
+
+
+class TracingPhy(object):
+    '''
+    Wraps a phy and traces the transfers that cross it
+    '''
+
+    def __init__(self, phy, writer):
+        '''
+        :param phy: the phy to trace
+        :param writer: a started :class:`PcapRingWriter`
+        '''
+        self.phy = phy
+        self.writer = writer
+        self.device = None
+        self.traced_device = None
+        self.urb_ids = itertools.count(1)
+        # response of the control request being handled, None when not in a control request
+        self.ep0_response = None
+        self.ep0_stalled = False
+
+    def __getattr__(self, name):
+        return getattr(self.phy, name)
+
+    def next_urb_id(self):
+        return next(self.urb_ids)
+
+    def get_xfer_type(self, ep_num):
+        endpoint = self.device.endpoints.get(ep_num) if self.device is not None else None
+        if endpoint is None:
+            return Usbmon.xfer_bulk
+        return Usbmon.xfer_types[endpoint.transfer_type & 0x3]
+
+    # device side
+
+    def connect(self, device):
+        if self.traced_device is None or self.device is not device:
+            self.device = device
+            self.traced_device = _TracedDevice(device, self)
+        self.phy.connect(self.traced_device)
+
+    def send_on_endpoint(self, ep_num, data):
+        if ep_num == 0 and self.ep0_response is not None:
+            self.ep0_response.append(data)
+        else:
+            self.trace_in(ep_num, data)
+        self.phy.send_on_endpoint(ep_num, data)
+
+    def stall_ep0(self):
+        if self.ep0_response is not None:
+            self.ep0_stalled = True
+        else:
+            self.writer.write(
+                self.next_urb_id(), Usbmon.complete, Usbmon.xfer_control, 0x80, self.device.address,
+                Usbmon.setup_absent, Usbmon.status_stall, 0, Usbmon.no_setup, b''
+            )
+        self.phy.stall_ep0()
+
+    # transfers
+
+    def trace_control(self, req):
+        if not isinstance(req, USBDeviceRequest):
+            req = USBDeviceRequest(req)
+        setup = req.setup_struct.pack(req.request_type, req.request, req.value, req.index, req.length)
+        epnum = req.request_type & 0x80
+        out_data = b'' if epnum else req.data
+        urb_id = self.next_urb_id()
+        devnum = self.device.address
+        write = self.writer.write
+        write(
+            urb_id, Usbmon.submit, Usbmon.xfer_control, epnum, devnum, Usbmon.setup_present,
+            Usbmon.status_in_progress, req.length, setup, out_data
+        )
+        self.ep0_response = []
+        self.ep0_stalled = False
+        try:
+            self.device.handle_request(req)
+        finally:
+            response = b''.join(self.ep0_response) if epnum else b''
+            self.ep0_response = None
+        if self.ep0_stalled:
+            status = Usbmon.status_stall
+        else:
+            status = Usbmon.status_ok
+        write(
+            urb_id, Usbmon.complete, Usbmon.xfer_control, epnum, devnum, Usbmon.setup_absent,
+            status, len(response) if epnum else len(out_data), Usbmon.no_setup, response
+        )
+
+    def trace_out(self, ep_num, data):
+        urb_id = self.next_urb_id()
+        xfer_type = self.get_xfer_type(ep_num)
+        devnum = self.device.address
+        self.writer.write(
+            urb_id, Usbmon.submit, xfer_type, ep_num, devnum, Usbmon.setup_absent,
+            Usbmon.status_in_progress, len(data), Usbmon.no_setup, data
+        )
+        self.device.handle_data_available(ep_num, data)
+        self.writer.write(
+            urb_id, Usbmon.complete, xfer_type, ep_num, devnum, Usbmon.setup_absent,
+            Usbmon.status_ok, len(data), Usbmon.no_setup, b''
+        )
+
+    def trace_in(self, ep_num, data):
+        urb_id = self.next_urb_id()
+        xfer_type = self.get_xfer_type(ep_num) if ep_num else Usbmon.xfer_control
+        epnum = ep_num | 0x80
+        devnum = self.device.address if self.device is not None else 0
+        self.writer.write(
+            urb_id, Usbmon.submit, xfer_type, epnum, devnum, Usbmon.setup_absent,
+            Usbmon.status_in_progress, len(data), Usbmon.no_setup, b''
+        )
+        self.writer.write(
+            urb_id, Usbmon.complete, xfer_type, epnum, devnum, Usbmon.setup_absent,
+            Usbmon.status_ok, len(data), Usbmon.no_setup, data
+        )
+
+
+def read_pcap(filename):
+    '''
+    Parse a usbmon pcap file (as written by the tracer, or captured from Linux usbmon)
+
+    :param filename: pcap file
+    :return: generator of :class:`UsbmonEvent`
+    '''
+    file_header = PcapRingWriter.file_header
+    record_header = PcapRingWriter.pcap_record_header
+    usbmon_header = PcapRingWriter.usbmon_header
+    with open(filename, 'rb') as f:
+        magic, _, _, _, _, _, linktype = file_header.unpack(f.read(file_header.size))
+        if magic == 0xa1b2c3d4:
+            usec_divisor = 1e6
+        elif magic == 0xa1b23c4d:
+            usec_divisor = 1e9
+        else:
+            raise Exception('%s is not a little endian pcap file' % filename)
+        # LINKTYPE_USB_LINUX (189) has the same header without the last 16 bytes
+        header_size = 64 if linktype == Usbmon.linktype else 48
+        if linktype not in (Usbmon.linktype, 189):
+            raise Exception('%s is not a usbmon capture (link type %d)' % (filename, linktype))
+        while True:
+            data = f.read(record_header.size)
+            if len(data) < record_header.size:
+                break
+            ts_sec, ts_frac, incl_len, _ = record_header.unpack(data)
+            record = f.read(incl_len)
+            if len(record) < incl_len:
+                break
+            fields = usbmon_header.unpack_from(record.ljust(usbmon_header.size, b'\x00'))
+            yield UsbmonEvent(
+                ts_sec + ts_frac / usec_divisor, fields[0], fields[1], fields[2], fields[3], fields[4],
+                fields[6], fields[10], fields[11], fields[13], record[header_size:]
+            )
+
+
+def trace_phy(phy, filename):
+    '''
+    :param phy: phy to trace
+    :param filename: pcap file to write
+    :return: a :class:`TracingPhy` that wraps the phy
+    '''
+    writer = PcapRingWriter(filename)
+    writer.start()
+    return TracingPhy(phy, writer)
@@ -0,0 +1,173 @@
+'''
+Virtual USB host, a phy that runs the host side in the same process.
+
+The emulated device is served by its scheduler as with a Facedancer,
+but the requests come from a host personality (see :mod:`numap.phy.hosts`)
+instead of a real host, so no USB hardware is needed.
+Each connection of the device starts a session of the host,
+between sessions the host keeps polling the IN endpoints.
+
+Use it with ``-P vhost[:<host>[:<sessions>]]``:
+host is one of linux (default), windows and macos,
+and the device is stopped after the given number of sessions (default: 1, 0 to never stop).
+'''
+import time
+import struct
+import logging
+from collections import deque
+from numap.phy.hosts import hosts
+
+
+class VirtualHostPhy(object):
+    '''
+    Phy of the virtual host
+    '''
+
+    name = 'VirtualHost'
+    setup_struct = struct.Struct('<BBHHH')
+
+    def __init__(self, app, host=None, sessions=1):
+        '''
+        :param app: numap application
+        :param host: host personality (default: None, linux host)
+        :param sessions: stop the device after this number of sessions, 0 to never stop (default: 1)
+        '''
+        self.app = app
+        self.host = host if host is not None else hosts['linux']()
+        self.sessions = sessions
+        self.logger = logging.getLogger('numap')
+        self.verbose = 0
+        self.device = None
+        self.address = 0
+        self.connected = False
+        self.session_pending = False
+        self.completed_sessions = 0
+        self.ep0_response = None
+        self.ep0_stalled = False
+        # transfers sent by the device on each IN endpoint
+        self.in_transfers = {}
+
+    # device side
+
+    def connect(self, device):
+        '''
+        Connect a device, a host session starts on the next service_irqs
+
+        :param device: the USB device
+        '''
+        if device is not self.device:
+            self.completed_sessions = 0
+        self.device = device
+        self.address = 0
+        self.in_transfers = {}
+        self.connected = True
+        self.session_pending = True
+
+    def disconnect(self):
+        self.connected = False
+        self.session_pending = False
+
+    def set_address(self, address, defer=False):
+        self.address = address
+
+    def ack_status_stage(self, blocking=False):
+        pass
+
+    def configured(self, configuration):
+        pass
+
+    def send_on_endpoint(self, ep_num, data):
+        '''
+        Data sent by the device, a control response on endpoint 0 or an IN transfer
+
+        :param ep_num: number of endpoint
+        :param data: data to send
+        '''
+        if ep_num == 0:
+            self.ep0_response = bytes(data)
+        else:
+            self.in_transfers.setdefault(ep_num, deque()).append(bytes(data))
+
+    def stall_ep0(self):
+        self.ep0_stalled = True
+
+    def service_irqs(self):
+        '''
+        Scheduler task of the device, runs a host session after each connection
+        and polls the IN endpoints otherwise
+        '''
+        if not self.connected:
+            return
+        if self.session_pending:
+            self.session_pending = False
+            self.host.run_session(self)
+            self.completed_sessions += 1
+            if self.sessions and self.completed_sessions >= self.sessions:
+                self.device.stop()
+        else:
+            self.host.poll(self)
+
+    # host side
+
+    def control_transfer(self, request_type, request, value, index, length, data=b''):
+        '''
+        Send a control request to the device
+
+        :param request_type: bmRequestType
+        :param request: bRequest
+        :param value: wValue
+        :param index: wIndex
+        :param length: wLength
+        :param data: data stage of an OUT request (default: b'')
+        :return: the data stage of an IN request, b'' for an OUT request, None if the device stalled
+        '''
+        self.ep0_response = None
+        self.ep0_stalled = False
+        self.device.handle_request(self.setup_struct.pack(request_type, request, value, index, length) + data)
+        if self.ep0_stalled:
+            self.logger.debug('virtual host: request %02x:%02x %04x %04x %d stalled', request_type, request, value, index, length)
+            return None
+        if request_type & 0x80:
+            return (self.ep0_response or b'')[:length]
+        return b''
+
+    def bulk_out(self, ep_num, data):
+        '''
+        Send data to an OUT endpoint (bulk or interrupt)
+        '''
+        self.device.handle_data_available(ep_num, data)
+
+    def bulk_in(self, ep_num, timeout=0):
+        '''
+        Receive a transfer from an IN endpoint (bulk or interrupt)
+
+        :param ep_num: number of endpoint
+        :param timeout: how long to keep polling for a transfer, in seconds (default: 0, poll once)
+        :return: the transfer, None if the device did not send any
+        '''
+        deadline = time.time() + timeout
+        while True:
+            transfers = self.in_transfers.get(ep_num)
+            if not transfers:
+                self.device.handle_buffer_available(ep_num)
+                transfers = self.in_transfers.get(ep_num)
+            if transfers:
+                return transfers.popleft()
+            if time.time() >= deadline:
+                return None
+            # let device worker threads run
+            time.sleep(0)
+
+
+def get_virtual_host_phy(app, phy_string):
+    '''
+    :param app: numap application
+    :param phy_string: vhost[:<host>[:<sessions>]]
+    :return: a :class:`VirtualHostPhy`
+    '''
+    parts = phy_string.split(':')
+    host_name = parts[1] if len(parts) > 1 and parts[1] else 'linux'
+    if host_name not in hosts:
+        raise Exception('Unknown virtual host %s, use one of: %s' % (host_name, ', '.join(sorted(hosts))))
+    sessions = int(parts[2]) if len(parts) > 2 else 1
+    return VirtualHostPhy(app, hosts[host_name](), sessions)
@@ -0,0 +1,223 @@
+'''
+Latency instrumentation of the device handlers.
+
+When a :class:`LatencyRecorder` is installed (see :func:`set_latency_recorder`),
+the device times each control request handler, each endpoint handler
+and each @mutable stage, and keeps a latency histogram per (device, stage).
+When no recorder is installed, the handlers are called directly.
+
+The histograms are written as JSON, or in the Prometheus text format
+when the file name ends with .prom (for the node exporter text file collector),
+at exit and on SIGUSR1.
+'''
+import os
+import json
+import time
+import atexit
+import signal
+import bisect
+import threading
+from functools import partial
+
+
+#: the installed recorder, None when the instrumentation is disabled
+recorder = None
+
+
+def set_latency_recorder(new_recorder):
+    '''
+    Install a latency recorder, or remove it (pass None)
+    '''
+    global recorder
+    recorder = new_recorder
+
+
+def handler_name(handler):
+    '''
+    :param handler: request or endpoint handler (function, bound method or partial)
+    :return: name of the handler
+    '''
+    while isinstance(handler, partial):
+        # routed class/vendor handlers are partial(_handle_local_request, handler)
+        handler = handler.args[0] if handler.args and callable(handler.args[0]) else handler.func
+    return getattr(handler, '__name__', type(handler).__name__)
+
+
+class Histogram(object):
+    '''
+    Latency histogram, with fixed bucket bounds
+    '''
+
+    #: upper bounds of the buckets, in seconds
+    bounds = (
+        1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4,
+        1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+    )
+
+    def __init__(self):
+        # the last bucket counts the values above the last bound
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        '''
+        :param fraction: percentile, between 0 and 1
+        :return: upper bound of the bucket of the percentile (max for the last bucket)
+        '''
+        target = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= target:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return 0.0
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'max': self.max,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'buckets': dict(
+                [('%g' % bound, count) for bound, count in zip(self.bounds, self.buckets)] +
+                [('+Inf', self.buckets[-1])]
+            ),
+        }
+
+
+class LatencyRecorder(object):
+    '''
+    Keeps the latency histograms of the handlers, per (device, stage).
+    Stages are named by kind: ``request:<handler>``, ``ep<num>:<handler>`` and ``stage:<@mutable stage>``.
+    '''
+
+    metric_name = 'numap_handler_latency_seconds'
+
+    def __init__(self, filename=None):
+        '''
+        :param filename: file to dump the histograms to (default: None)
+        '''
+        self.filename = filename
+        self.histograms = {}
+        # reentrant, the SIGUSR1 dump may interrupt a record in the same thread
+        self.lock = threading.RLock()
+        # device whose handler is running in each thread, @mutable stages are accounted to it
+        self.current = threading.local()
+
+    def record(self, device, stage, seconds):
+        key = (device, stage)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.add(seconds)
+
+    def timed(self, device, stage, func, *args, **kwargs):
+        '''
+        Call a function and record its latency
+
+        :param device: device name
+        :param stage: stage name
+        :param func: the function to call
+        :return: the return value of the function
+        '''
+        current = self.current
+        outer_device = getattr(current, 'device', None)
+        current.device = device
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.record(device, stage, time.perf_counter() - start)
+            current.device = outer_device
+
+    def timed_stage(self, actor, stage, func, *args, **kwargs):
+        '''
+        Call a @mutable stage and record its latency,
+        accounted to the device whose handler is running (or to the actor)
+
+        :param actor: the actor of the stage
+        :param stage: stage name, as recorded (i.e. stage:<name>)
+        :param func: the stage function
+        '''
+        device = getattr(self.current, 'device', None) or getattr(actor, 'name', None)
+        return self.timed(device, stage, func, *args, **kwargs)
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+    def to_json(self):
+        '''
+        :return: the histograms as a JSON string
+        '''
+        with self.lock:
+            devices = {}
+            for (device, stage), histogram in sorted(self.histograms.items(), key=lambda x: (str(x[0][0]), x[0][1])):
+                devices.setdefault(str(device), {})[stage] = histogram.to_dict()
+        return json.dumps({'time': time.time(), 'unit': 'seconds', 'devices': devices}, indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        '''
+        :return: the histograms in the Prometheus text format
+        '''
+        lines = [
+            '# HELP %s Latency of the numap device handlers' % self.metric_name,
+            '# TYPE %s histogram' % self.metric_name,
+        ]
+        with self.lock:
+            for (device, stage), histogram in sorted(self.histograms.items(), key=lambda x: (str(x[0][0]), x[0][1])):
+                labels = 'device="%s",stage="%s"' % (_escape_label(device), _escape_label(stage))
+                cumulative = 0
+                for bound, count in zip(histogram.bounds, histogram.buckets):
+                    cumulative += count
+                    lines.append('%s_bucket{%s,le="%g"} %d' % (self.metric_name, labels, bound, cumulative))
+                lines.append('%s_bucket{%s,le="+Inf"} %d' % (self.metric_name, labels, histogram.count))
+                lines.append('%s_sum{%s} %.9f' % (self.metric_name, labels, histogram.total))
+                lines.append('%s_count{%s} %d' % (self.metric_name, labels, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, filename=None):
+        '''
+        Write the histograms, in the Prometheus text format if the file name ends with .prom,
+        as JSON otherwise. The file is replaced atomically, so it can be collected at any time.
+
+        :param filename: file to write (default: None, the recorder file)
+        '''
+        filename = filename or self.filename
+        if not filename:
+            return
+        data = self.to_prometheus() if filename.endswith('.prom') else self.to_json()
+        tmp_filename = '%s.tmp' % filename
+        with open(tmp_filename, 'w') as f:
+            f.write(data)
+        os.rename(tmp_filename, filename)
+
+    def start(self):
+        '''
+        Install the recorder, and dump it at exit and on SIGUSR1
+        '''
+        set_latency_recorder(self)
+        atexit.register(self.dump)
+        if hasattr(signal, 'SIGUSR1') and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.dump())
+
+    def stop(self):
+        if recorder is self:
+            set_latency_recorder(None)
+        self.dump()
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
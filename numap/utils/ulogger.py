@@ -1,7 +1,44 @@
+import struct
+import atexit
 import logging
+import logging.handlers
+import docopt
+from collections import deque
+from six.moves.queue import Queue
 
 stdio_handler = None
 numap_logger = None
+queue_handler = None
+queue_listener = None
+ring_handler = None
+
+FORMAT = '[%(levelname)-6s] %(message)s'
+
+#: maximal number of bytes shown by :class:`HexDump`
+hexdump_max_bytes = 64
+
+
+class HexDump(object):
+    '''
+    Hex representation of a buffer, rendered only if the log record is emitted.
+    Buffers longer than max_bytes are truncated.
+    '''
+
+    __slots__ = ('data', 'max_bytes')
+
+    def __init__(self, data, max_bytes=None):
+        '''
+        :param data: bytes-like object to dump
+        :param max_bytes: maximal number of bytes to show (default: hexdump_max_bytes)
+        '''
+        self.data = data
+        self.max_bytes = hexdump_max_bytes if max_bytes is None else max_bytes
+
+    def __str__(self):
+        data = self.data
+        if len(data) > self.max_bytes:
+            return '%s... (%d bytes)' % (bytes(data[:self.max_bytes]).hex(), len(data))
+        return bytes(data).hex()
 
 
 def prepare_logging():
@@ -19,7 +56,6 @@ def prepare_logging():
         logging.Logger.verbose = add_debug_level(5, 'VERBOSE')
         logging.Logger.always = add_debug_level(100, 'ALWAYS')
 
-        FORMAT = '[%(levelname)-6s] %(message)s'
         stdio_handler = logging.StreamHandler()
         stdio_handler.setLevel(logging.INFO)
         formatter = logging.Formatter(FORMAT)
@@ -30,6 +66,181 @@ def prepare_logging():
     return numap_logger
 
 
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    '''
+    Queue handler that defers the output of the records to the listener thread.
+    The message is rendered here, while the buffers in its arguments
+    (e.g. :class:`HexDump` of a received packet) still hold the logged data,
+    the formatting by the handlers is left to the listener thread.
+    '''
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class RingBufferHandler(logging.Handler):
+    '''
+    Keep the most recent records in memory in a compact binary form,
+    and write them to a file when flushed (i.e. at exit).
+
+    File format: the magic, then for each record, oldest first,
+    a header (creation time, level, message length) followed by the utf-8 message.
+    Records are dropped from the front once the capacity is exceeded.
+    '''
+
+    magic = b'NUMAPLOG'
+    record_header = struct.Struct('<dBI')
+
+    def __init__(self, filename, capacity=0x400000, level=logging.NOTSET):
+        '''
+        :param filename: file to write the records to
+        :param capacity: maximal size in bytes of the kept records (default: 4MB)
+        :param level: handler level (default: NOTSET)
+        '''
+        super(RingBufferHandler, self).__init__(level)
+        self.filename = filename
+        self.capacity = capacity
+        self.records = deque()
+        self.size = 0
+
+    def emit(self, record):
+        try:
+            msg = self.format(record).encode('utf-8', 'replace')
+            entry = self.record_header.pack(record.created, min(record.levelno, 0xff), len(msg)) + msg
+            self.records.append(entry)
+            self.size += len(entry)
+            while self.size > self.capacity and len(self.records) > 1:
+                self.size -= len(self.records.popleft())
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self.acquire()
+        try:
+            with open(self.filename, 'wb') as f:
+                f.write(self.magic)
+                f.writelines(self.records)
+        finally:
+            self.release()
+
+
+def read_ring_buffer(filename):
+    '''
+    Read the records written by a :class:`RingBufferHandler`
+
+    :param filename: ring buffer file
+    :return: generator of (creation time, level, message) tuples
+    '''
+    header = RingBufferHandler.record_header
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if not data.startswith(RingBufferHandler.magic):
+        raise ValueError('%s is not a numap log ring buffer' % filename)
+    offset = len(RingBufferHandler.magic)
+    while offset + header.size <= len(data):
+        created, levelno, length = header.unpack_from(data, offset)
+        offset += header.size
+        yield created, levelno, data[offset:offset + length].decode('utf-8', 'replace')
+        offset += length
+
+
+def get_output_handlers():
+    '''
+    :return: list of the handlers that output the numap records
+    '''
+    handlers = [h for h in numap_logger.handlers if h is not queue_handler]
+    if queue_listener is not None:
+        handlers.extend(queue_listener.handlers)
+    return handlers
+
+
+def update_logger_level():
+    '''
+    Set the level of the numap logger to the lowest level of its handlers,
+    so records that no handler would emit are dropped before being formatted
+    '''
+    levels = [h.level or logging.VERBOSE for h in get_output_handlers()]
+    numap_logger.setLevel(min(levels) if levels else logging.VERBOSE)
+
+
+def start_queue_logging():
+    '''
+    Move the formatting and output of the numap records to a background thread.
+    The calling threads only put the records on a queue.
+    The queue is drained at exit.
+    '''
+    global queue_handler
+    global queue_listener
+    if queue_listener is not None:
+        return
+    handlers = get_output_handlers()
+    for handler in handlers:
+        numap_logger.removeHandler(handler)
+    queue = Queue()
+    queue_handler = DeferredQueueHandler(queue)
+    queue_listener = logging.handlers.QueueListener(queue, *handlers, respect_handler_level=True)
+    queue_listener.start()
+    numap_logger.addHandler(queue_handler)
+    atexit.register(stop_queue_logging)
+
+
+def stop_queue_logging():
+    '''
+    Drain the queue and output the records from the calling thread again
+    '''
+    global queue_handler
+    global queue_listener
+    if queue_listener is None:
+        return
+    numap_logger.removeHandler(queue_handler)
+    queue_listener.stop()
+    for handler in queue_listener.handlers:
+        numap_logger.addHandler(handler)
+    queue_handler = None
+    queue_listener = None
+
+
+def add_ring_buffer(filename, capacity=0x400000, level=None):
+    '''
+    Keep the most recent numap records in a binary ring buffer,
+    written to a file at exit (see :func:`read_ring_buffer`)
+
+    :param filename: file to write the records to
+    :param capacity: maximal size in bytes of the kept records (default: 4MB)
+    :param level: lowest level of the kept records (default: VERBOSE)
+    '''
+    global ring_handler
+    if ring_handler is not None:
+        return
+    if level is None:
+        level = logging.VERBOSE
+    ring_handler = RingBufferHandler(filename, capacity, level)
+    ring_handler.setFormatter(logging.Formatter(FORMAT))
+    if queue_listener is not None:
+        queue_listener.handlers = queue_listener.handlers + (ring_handler,)
+    else:
+        numap_logger.addHandler(ring_handler)
+    update_logger_level()
+
+
 def set_default_handler_level(level):
     global stdio_handler
     stdio_handler.setLevel(level)
+    update_logger_level()
+
+
+def main():
+    '''
+    Print the records of a ring buffer file
+
+    Usage:
+        numap-logring FILE
+    '''
+    options = docopt.docopt(main.__doc__)
+    for _, levelno, msg in read_ring_buffer(options['FILE']):
+        print(msg)
@@ -25,14 +25,20 @@ setup(
     keywords='security,usb,fuzzing,kitty',
     entry_points={
         'console_scripts': [
+            'numap-bench=numap.apps.bench:main',
+            'numap-corpus=numap.fuzz.corpus:main',
             'numap-detect=numap.apps.detect_os:main',
             'numap-emulate=numap.apps.emulate:main',
             'numap-fuzz=numap.apps.fuzz:main',
+            'numap-image=numap.apps.image:main',
             'numap-list=numap.apps.list_classes:main',
+            'numap-logring=numap.utils.ulogger:main',
             'numap-kitty=numap.fuzz.fuzz_engine:main',
+            'numap-replay=numap.apps.replay:main',
             'numap-scan=numap.apps.scan:main',
             'numap-vsscan=numap.apps.vsscan:main',
             'numap-stages=numap.apps.makestages:main',
+            'numap-stagetrace=numap.fuzz.stage_trace:main',
         ]
     },
     package_data={}
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+'''
+Benchmark the per-request overhead of the @mutable stages on the TestPhy harness
+
+Usage:
+    bench_mutable.py [-n=COUNT] [-C=DEVICE_CLASS ...]
+
+Options:
+    -n --count COUNT            number of iterations over the request set [default: 2000]
+    -C --class DEVICE_CLASS     device class to benchmark (default: keyboard, printer, ftdi)
+
+The "fuzz" mode runs the full @mutable path with no fuzzer attached
+(the behaviour of every app before app modes existed),
+the "emulate" mode takes the direct call fast path.
+Descriptor caching is disabled in both modes, so only the stage overhead differs.
+'''
+import time
+import docopt
+from infra_event_handler import EventHandler
+from infra_app import TestApp
+from numap.fuzz.helpers import AppMode, set_app_mode
+from test_devices import build_get_device_descriptor, build_get_configuration_descriptor, build_get_string_descriptor
+
+
+class BenchApp(TestApp):
+
+    def should_cache_descriptors(self):
+        return False
+
+
+def get_requests(device):
+    configuration = device.get_configuration_descriptor(0)
+    return [
+        build_get_device_descriptor(),
+        build_get_configuration_descriptor(0),
+        build_get_configuration_descriptor(0, len(configuration)),
+        build_get_string_descriptor(0),
+        build_get_string_descriptor(1, 0x0409),
+    ]
+
+
+def run_requests(device, requests, count):
+    start = time.time()
+    for _ in range(count):
+        for req in requests:
+            device.handle_request(req)
+    return (time.time() - start) / (count * len(requests))
+
+
+def bench_device(dev_name, count):
+    events = EventHandler()
+    app = BenchApp(event_handler=events)
+    device = app.load_device(dev_name, app.load_phy('test'))
+    requests = get_requests(device)
+    results = {}
+    for mode in (AppMode.fuzz, AppMode.emulate):
+        set_app_mode(mode)
+        run_requests(device, requests, 10)
+        results[mode] = run_requests(device, requests, count)
+        events.reset()
+    return results
+
+
+def main():
+    options = docopt.docopt(__doc__)
+    count = int(options['--count'])
+    dev_names = options['--class'] or ['keyboard', 'printer', 'ftdi']
+    print('%-12s %14s %16s %8s' % ('device', 'fuzz (us/req)', 'emulate (us/req)', 'speedup'))
+    for dev_name in dev_names:
+        results = bench_device(dev_name, count)
+        before = results[AppMode.fuzz] * 1e6
+        after = results[AppMode.emulate] * 1e6
+        print('%-12s %14.2f %16.2f %7.2fx' % (dev_name, before, after, before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+'''
+Benchmark the SCSI worker thread of the mass storage device:
+the CPU it uses while idle, and the round trip of a command through it
+(CBW queued on the OUT endpoint, to CSW read from the IN endpoint)
+
+Usage:
+    bench_scsi_worker.py [-n=COUNT] [-i=SECONDS]
+
+Options:
+    -n --count COUNT            number of TEST UNIT READY commands [default: 5000]
+    -i --idle SECONDS           how long to measure the idle CPU usage [default: 2]
+'''
+import os
+import time
+import shutil
+import struct
+import tempfile
+import docopt
+from infra_event_handler import EventHandler
+from infra_app import TestApp
+from numap.dev.mass_storage import ScsiDevice, DiskImage
+
+
+def build_cbw(tag, cdb, length=0, direction_in=False):
+    return struct.pack(
+        '<4sIIBBB', b'USBC', tag, length, 0x80 if direction_in else 0x00, 0, len(cdb)
+    ) + cdb.ljust(16, b'\x00')
+
+
+def wait_for_data(scsi):
+    while True:
+        data = scsi.get_data()
+        if data is not None:
+            return data
+        # the phy loop polls the IN endpoint
+        time.sleep(0)
+
+
+def bench_idle(scsi, seconds):
+    '''
+    :return: CPU time used by the process while the worker is idle, as a fraction of a core
+    '''
+    cpu_start = time.process_time()
+    time.sleep(seconds)
+    return (time.process_time() - cpu_start) / seconds
+
+
+def bench_round_trip(scsi, count):
+    '''
+    :return: average round trip of a TEST UNIT READY command, in seconds
+    '''
+    cbw = build_cbw(1, b'\x00' * 6)
+    start = time.time()
+    for _ in range(count):
+        scsi.put_data(cbw)
+        wait_for_data(scsi)
+    return (time.time() - start) / count
+
+
+def main():
+    options = docopt.docopt(__doc__)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        image = os.path.join(tmp_dir, 'bench.img')
+        with open(image, 'wb') as f:
+            f.truncate(1024 * 1024)
+        app = TestApp(event_handler=EventHandler())
+        disk_image = DiskImage(image, 0x200)
+        scsi = ScsiDevice(app, disk_image)
+        idle = bench_idle(scsi, float(options['--idle']))
+        round_trip = bench_round_trip(scsi, int(options['--count']))
+        print('idle CPU:          %6.1f%% of a core' % (idle * 100))
+        print('command round trip: %6.1f us' % (round_trip * 1e6))
+        scsi.stop()
+        disk_image.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+'''
+Benchmark the fuzz test rate for each trigger mode (controller <-> numapfuzz)
+
+Usage:
+    bench_triggers.py [-n=COUNT] [-i=IRQ_TIME]
+
+Options:
+    -n --count COUNT        number of tests per mode [default: 50]
+    -i --irq-time IRQ_TIME  seconds spent servicing the phy between two should_stop_phy calls [default: 0.001]
+
+The controller runs the kitty test sequence (pre_test, trigger, post_test),
+the stack runs the should_stop_phy loop of numapfuzz against a phy that does nothing.
+'''
+import time
+import shutil
+import tempfile
+from threading import Thread
+import docopt
+from numap.apps.fuzz import NumapFuzzApp
+from numap.fuzz.controller import UmapController
+from numap.fuzz.triggers import trigger_receivers
+
+
+class NullPhy(object):
+
+    def connect(self, device):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+class BenchFuzzApp(NumapFuzzApp):
+    '''
+    numapfuzz stack without a fuzzer or a device
+    '''
+
+    def __init__(self, trigger_mode, trigger_dir, irq_time):
+        self.count = 0
+        self.fuzzer = True
+        self.phy = NullPhy()
+        self.dev = None
+        self.irq_time = irq_time
+        self.running = True
+        self.triggers = trigger_receivers[trigger_mode](trigger_dir)
+
+    def run(self):
+        self.triggers.open()
+        while self.running:
+            time.sleep(self.irq_time)
+            self.should_stop_phy()
+        self.triggers.close()
+
+
+def bench_mode(trigger_mode, count, irq_time):
+    trigger_dir = tempfile.mkdtemp()
+    controller = UmapController(trigger_mode=trigger_mode, trigger_dir=trigger_dir)
+    controller.setup()
+    stack = BenchFuzzApp(trigger_mode, trigger_dir, irq_time)
+    thread = Thread(target=stack.run)
+    thread.daemon = True
+    thread.start()
+    start = time.time()
+    for i in range(count):
+        controller.pre_test(i)
+        controller.trigger()
+        controller.post_test()
+    elapsed = time.time() - start
+    stack.running = False
+    # unblock a stack waiting for a reconnection
+    controller.trigger_connect()
+    thread.join()
+    controller.teardown()
+    shutil.rmtree(trigger_dir)
+    return count / elapsed
+
+
+def main():
+    options = docopt.docopt(__doc__)
+    count = int(options['--count'])
+    irq_time = float(options['--irq-time'])
+    print('%-8s %12s' % ('mode', 'tests/sec'))
+    for trigger_mode in ('file', 'socket'):
+        print('%-8s %12.1f' % (trigger_mode, bench_mode(trigger_mode, count, irq_time)))
+
+
+if __name__ == '__main__':
+    main()
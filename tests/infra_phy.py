@@ -1,7 +1,6 @@
 '''
 Physical layer for testing numap core and devices
 '''
-from numap.phy.iphy import PhyInterface
 from infra_event_handler import TestEvent
 
 
@@ -19,7 +18,7 @@ class StallEp0Event(TestEvent):
     pass
 
 
-class TestPhy(PhyInterface):
+class TestPhy(object):
     '''
     Test physical interface
     '''
@@ -28,7 +27,41 @@ class TestPhy(PhyInterface):
         :type app: :class:`~numap.app.base.NumapApp`
         :param app: application instance
         '''
-        super(TestPhy, self).__init__(app, 'Test')
+        self.app = app
+        self.name = 'Test'
+        self.device = None
+        self.address = 0
+
+    def connect(self, device):
+        '''
+        Connect a device
+
+        :param device: the USB device
+        '''
+        self.device = device
+
+    def disconnect(self):
+        '''
+        Disconnect the current device
+        '''
+        self.device = None
+
+    def set_address(self, address, defer=False):
+        '''
+        Set the device address
+
+        :param address: the address
+        :param defer: whether to defer setting the address (ignored)
+        '''
+        self.address = address
+
+    def ack_status_stage(self, blocking=False):
+        '''
+        Acknowledge the status stage of a control transfer
+
+        :param blocking: whether to wait for the ack (ignored)
+        '''
+        self.app.event_handler.handle_event(SendDataEvent(0, b''))
 
     def send_on_endpoint(self, ep_num, data):
         '''
@@ -2,6 +2,20 @@
 import os
 import unittest
 from test_devices import *
+from test_usb_device_request import *
+from test_corpus import *
+from test_stages import *
+from test_vhost import *
+from test_latency import *
+from test_usbmon import *
+from test_replay import *
+from test_mass_storage import *
+from test_vfat import *
+from test_chunked_image import *
+from test_ulogger import *
+from test_triggers import *
+from test_fuzz import *
+from test_registry import *
 
 
 if __name__ == '__main__':
@@ -0,0 +1,71 @@
+'''
+Tests for the chunked, compressed disk images
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+from numap.apps.image import NumapImageApp, __doc__ as image_doc
+from numap.dev.chunked_image import ChunkedDiskImage, pack_image
+
+
+class ChunkedDiskImageTests(unittest.TestCase):
+
+    block_size = 0x200
+    chunk_size = 0x1000
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.raw_file = os.path.join(self.tmp_dir, 'disk.img')
+        self.image_file = os.path.join(self.tmp_dir, 'disk.nzi')
+        # compressible, all zeros, incompressible chunks, and a partial last chunk
+        self.raw = (
+            b'numap' * (self.chunk_size // 5 + 1)
+        )[:self.chunk_size] + bytes(self.chunk_size) + os.urandom(self.chunk_size) + b'\x42' * 0x300
+        with open(self.raw_file, 'wb') as f:
+            f.write(self.raw)
+        pack_image(self.raw_file, self.image_file, self.chunk_size)
+        self.disk_image = ChunkedDiskImage(self.image_file, self.block_size, cache_chunks=2)
+
+    def tearDown(self):
+        self.disk_image.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def testSize(self):
+        self.assertEqual(self.disk_image.image_size, len(self.raw))
+        self.assertEqual(self.disk_image.num_blocks, len(self.raw) // self.block_size)
+        self.assertLess(os.path.getsize(self.image_file), len(self.raw))
+
+    def testReadAll(self):
+        data = bytes(self.disk_image.get_sectors_view(0, self.disk_image.num_blocks))
+        self.assertEqual(data, self.raw[:len(data)])
+
+    def testReadInChunkIsView(self):
+        view = self.disk_image.get_sectors_view(9, 2)
+        self.assertEqual(bytes(view), self.raw[9 * self.block_size:11 * self.block_size])
+        self.assertIs(view.obj, self.disk_image.get_chunk(1))
+
+    def testCacheIsBounded(self):
+        for index in range(self.disk_image.num_chunks):
+            self.disk_image.get_chunk(index)
+        self.assertEqual(list(self.disk_image.cache), [2, 3])
+
+    def testWritesStayInMemory(self):
+        self.disk_image.put_sector_data(3, b'\x99' * self.block_size)
+        self.assertEqual(self.disk_image.get_sector_data(3), b'\x99' * self.block_size)
+        self.assertEqual(bytes(self.disk_image.get_sectors_view(2, 1)), self.raw[2 * self.block_size:3 * self.block_size])
+
+    def testPackUnpack(self):
+        pack_argv = ['numapimage', 'pack', '-c', '8K', '-l', '9', self.raw_file, self.image_file]
+        with patch('sys.argv', pack_argv):
+            NumapImageApp(image_doc).run()
+        unpacked = os.path.join(self.tmp_dir, 'unpacked.img')
+        with patch('sys.argv', ['numapimage', 'unpack', self.image_file, unpacked]):
+            NumapImageApp(image_doc).run()
+        with open(unpacked, 'rb') as f:
+            self.assertEqual(f.read(), self.raw)
+
+    def testBadChunkSize(self):
+        self.assertRaises(ValueError, pack_image, self.raw_file, self.image_file, 1000)
@@ -0,0 +1,137 @@
+'''
+Tests for the pre-rendered mutation corpus
+'''
+
+import os
+import logging
+import unittest
+import tempfile
+from unittest.mock import patch
+from kitty.model import Template, UInt8, LE16
+from numap.fuzz.corpus import Corpus, CorpusWriter
+from numap.fuzz.fuzz_engine import NumapClientFuzzer
+
+
+class Rendered(bytes):
+
+    def tobytes(self):
+        return bytes(self)
+
+
+class ListTemplate(object):
+    '''
+    Template-like object that mutates over a list of payloads
+    '''
+    def __init__(self, name, payloads):
+        self.name = name
+        self.payloads = payloads
+        self._current_index = -1
+
+    def get_name(self):
+        return self.name
+
+    def num_mutations(self):
+        return len(self.payloads)
+
+    def reset(self):
+        self._current_index = -1
+
+    def mutate(self):
+        if self._current_index + 1 >= len(self.payloads):
+            return False
+        self._current_index += 1
+        return True
+
+    def render(self):
+        return Rendered(self.payloads[self._current_index])
+
+
+class CorpusTests(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.corpus')
+        os.close(fd)
+        self.templates = [
+            ListTemplate('device_descriptor', [b'\x12\x01', b'', b'\xff' * 300]),
+            ListTemplate('string_descriptor', [b'\x04\x03a\x00']),
+        ]
+        writer = CorpusWriter(self.filename)
+        writer.start()
+        for template in self.templates:
+            writer.add_template(template)
+        writer.stop()
+        self.corpus = Corpus(self.filename)
+
+    def tearDown(self):
+        self.corpus.close()
+        os.remove(self.filename)
+
+    def testPayloads(self):
+        for template in self.templates:
+            self.assertEqual(self.corpus.num_mutations(template.name), len(template.payloads))
+            for i, payload in enumerate(template.payloads):
+                self.assertEqual(self.corpus.get_payload(template.name, i), payload)
+
+    def testMissingMutation(self):
+        self.assertIsNone(self.corpus.get_payload('device_descriptor', 3))
+        self.assertIsNone(self.corpus.get_payload('device_descriptor', -1))
+        self.assertIsNone(self.corpus.get_payload('hub_descriptor', 0))
+
+    def testVerifyDropsChangedTemplates(self):
+        self.corpus.verify([ListTemplate('device_descriptor', [b'\x12\x01'])])
+        self.assertIsNone(self.corpus.get_payload('device_descriptor', 0))
+        self.assertEqual(self.corpus.get_payload('string_descriptor', 0), b'\x04\x03a\x00')
+
+    def testPayloadIsView(self):
+        payload = self.corpus.get_payload('device_descriptor', 2)
+        self.assertIsInstance(payload, memoryview)
+        self.assertTrue(payload.readonly)
+        self.assertEqual(payload.tobytes(), b'\xff' * 300)
+
+    def testCloseWithPayloadInUse(self):
+        payload = self.corpus.get_payload('string_descriptor', 0)
+        self.corpus.close()
+        self.assertEqual(payload.tobytes(), b'\x04\x03a\x00')
+        self.assertRaises(ValueError, self.corpus.get_payload, 'string_descriptor', 0)
+
+
+class KittyTemplateCorpusTests(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.corpus')
+        os.close(fd)
+        self.template = Template(name='device_descriptor', fields=[
+            UInt8(value=18, name='bLength'),
+            UInt8(value=1, name='bDescriptorType'),
+            LE16(value=0x0200, name='bcdUSB'),
+        ])
+        writer = CorpusWriter(self.filename)
+        writer.start()
+        self.num_mutations = writer.add_template(self.template)
+        writer.stop()
+        self.corpus = Corpus(self.filename)
+
+    def tearDown(self):
+        self.corpus.close()
+        os.remove(self.filename)
+
+    def testPayloadOfEachMutation(self):
+        self.assertEqual(self.num_mutations, self.template.num_mutations())
+        self.assertEqual(self.corpus.num_mutations('device_descriptor'), self.num_mutations)
+        # the fuzzer looks the payloads up by the index of the current mutation
+        index = 0
+        while self.template.mutate():
+            self.assertEqual(self.template._current_index, index)
+            payload = self.corpus.get_payload('device_descriptor', self.template._current_index)
+            self.assertEqual(payload.tobytes(), self.template.render().tobytes())
+            index += 1
+        self.assertEqual(index, self.num_mutations)
+
+    def testFuzzerServesCorpus(self):
+        fuzzer = NumapClientFuzzer(logger=logging.getLogger('numap.test_corpus'))
+        fuzzer.set_corpus(self.corpus)
+        for _ in range(5):
+            self.template.mutate()
+        expected = self.template.render().tobytes()
+        with patch.object(self.template, 'render', side_effect=AssertionError('rendered')):
+            self.assertEqual(fuzzer._render_mutation(self.template), expected)
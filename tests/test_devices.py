@@ -4,11 +4,15 @@ Tests for emulated USB devices
 
 import unittest
 import struct
+from facedancer.USBDevice import USBDeviceRequest as FacedancerRequest
 from common import get_test_logger
 from infra_event_handler import EventHandler
 from infra_app import TestApp
 from infra_phy import SendDataEvent, StallEp0Event
 from numap.dev.cdc import USBCDCClass
+from numap.dev.keyboard import Requests as HidRequests
+from numap.core.usb import Request
+from numap.core.usb_device import USBDeviceRequest
 
 DIR_OUT = 0x00
 DIR_IN = 0x80
@@ -260,3 +264,159 @@ class BillboardDeviceTests(unittest.TestCase, BaseDeviceTests):
             0, DESCRIPTOR_TYPE_BOS, 0, DESCRIPTOR_LENGTH_BOS
         )
         self._testGetDescriptorConsistent(bos_descriptor_request, DESCRIPTOR_LENGTH_BOS)
+
+
+class DescriptorCacheTests(unittest.TestCase, BaseDeviceTests):
+
+    __dev_name__ = 'keyboard'
+
+    def setUp(self):
+        self._setUp()
+
+    def testKeyedByLanguage(self):
+        for language_id in (0x0409, 0x0407):
+            self.device.handle_request(build_get_string_descriptor(1, language_id))
+            self.assertTrue(isinstance(self.events.events.pop(), SendDataEvent))
+        cache = self.device._descriptor_cache
+        self.assertIn((DESCRIPTOR_TYPE_STRING, 1, 0x0409, 'fullspeed'), cache)
+        self.assertIn((DESCRIPTOR_TYPE_STRING, 1, 0x0407, 'fullspeed'), cache)
+
+    def testLanguageIgnoredForOtherDescriptors(self):
+        for index in (0, 0x0409, 0xffff):
+            self.device.handle_request(setup_request(
+                DIR_IN, TYPE_STANDARD, RECIPIENT_DEVICE, DEVICE_REQUEST_GET_DESCRIPTOR,
+                0, DESCRIPTOR_TYPE_DEVICE, index, DESCRIPTOR_LENGTH_DEVICE
+            ))
+            self.get_single_response(0, DESCRIPTOR_LENGTH_DEVICE)
+        self.assertEqual(list(self.device._descriptor_cache), [(DESCRIPTOR_TYPE_DEVICE, 0, 0, 'fullspeed')])
+
+    def testDroppedOnSetConfiguration(self):
+        self.device.handle_request(build_get_device_descriptor())
+        self.get_single_response(0, DESCRIPTOR_LENGTH_DEVICE)
+        self.assertTrue(self.device._descriptor_cache)
+        self.device.handle_request(setup_request(
+            DIR_OUT, TYPE_STANDARD, RECIPIENT_DEVICE, DEVICE_REQUEST_SET_CONFIGURATION, 1, 0, 0, 0
+        ))
+        self.assertFalse(self.device._descriptor_cache)
+
+    def testDroppedOnSpeedChange(self):
+        self.device.handle_request(build_get_configuration_descriptor(0))
+        self.get_single_response(0, DESCRIPTOR_LENGTH_CONFIGURATION)
+        self.device.usb_type = 'highspeed'
+        self.assertFalse(self.device._descriptor_cache)
+        self.device.handle_request(build_get_configuration_descriptor(0))
+        self.get_single_response(0, DESCRIPTOR_LENGTH_CONFIGURATION)
+        self.assertEqual(list(self.device._descriptor_cache), [(DESCRIPTOR_TYPE_CONFIGURATION, 0, 0, 'highspeed')])
+
+
+class FacedancerRequestTests(unittest.TestCase, BaseDeviceTests):
+
+    __dev_name__ = 'keyboard'
+
+    def setUp(self):
+        self._setUp()
+
+    def testConvertedToDeviceRequest(self):
+        requests = []
+        handle_get_descriptor_request = self.device.request_handlers[DEVICE_REQUEST_GET_DESCRIPTOR]
+
+        def handler(req):
+            requests.append(req)
+            handle_get_descriptor_request(req)
+
+        self.device.request_handlers[DEVICE_REQUEST_GET_DESCRIPTOR] = handler
+        # routes are bound to the handlers when built
+        self.device.request_routes = None
+        self.device.handle_request(FacedancerRequest(build_get_device_descriptor()))
+        ev = self.get_single_response(0, DESCRIPTOR_LENGTH_DEVICE)
+        self.assertEqual(len(requests), 1)
+        self.assertIsInstance(requests[0], USBDeviceRequest)
+        self.assertEqual(requests[0].raw(), build_get_device_descriptor())
+        self.device.handle_request(build_get_device_descriptor())
+        self.assertEqual(self.get_single_response(0, DESCRIPTOR_LENGTH_DEVICE).data, ev.data)
+
+
+class RequestRoutesTests(unittest.TestCase, BaseDeviceTests):
+
+    __dev_name__ = 'keyboard'
+
+    def setUp(self):
+        self._setUp()
+        self.configure()
+
+    def configure(self):
+        # the interface routes are added when the device is configured
+        self.device.handle_request(setup_request(
+            DIR_OUT, TYPE_STANDARD, RECIPIENT_DEVICE, DEVICE_REQUEST_SET_CONFIGURATION, 1, 0, 0, 0
+        ))
+        self.events.events = []
+
+    def load_device(self, dev_name):
+        self.device = self.app.load_device(dev_name, self.phy)
+        self.configure()
+
+    def get_route(self, req_type, recipient, request, target=0):
+        routes = self.device.request_routes
+        if routes is None:
+            routes = self.device.build_request_routes()
+        return routes.get((req_type, recipient, request, target))
+
+    def testClassRoute(self):
+        usb_class = self.device.configuration.interfaces[0].usb_class
+        route = self.get_route(Request.type_class, Request.recipient_interface, HidRequests.SET_IDLE)
+        self.assertEqual(route.func, usb_class._handle_local_request)
+        self.assertEqual(route.args, (usb_class.local_handlers[HidRequests.SET_IDLE],))
+        self.assertIsNone(self.get_route(Request.type_class, Request.recipient_interface, HidRequests.SET_IDLE, 1))
+        self.device.handle_request(setup_request(
+            DIR_OUT, TYPE_CLASS, RECIPIENT_INTERFACE, HidRequests.SET_IDLE, 0, 0, 0, 0
+        ))
+        self.get_single_response(0, 0)
+
+    def testVendorRoute(self):
+        self.load_device('ftdi')
+        usb_vendor = self.device.usb_vendor
+        get_latency_timer = 0x0a
+        route = self.get_route(Request.type_vendor, Request.recipient_device, get_latency_timer)
+        self.assertEqual(route.func, usb_vendor._handle_local_request)
+        self.assertEqual(route.args, (usb_vendor.local_handlers[get_latency_timer],))
+        self.device.handle_request(setup_request(
+            DIR_IN, TYPE_VENDOR, RECIPIENT_DEVICE, get_latency_timer, 0, 0, 0, 1
+        ))
+        self.get_single_response(0, 1)
+
+    def testUnknownRequestStalls(self):
+        requests = [
+            # no handler in the class of the interface
+            (TYPE_CLASS, RECIPIENT_INTERFACE, 0x55, 0),
+            # no such interface
+            (TYPE_CLASS, RECIPIENT_INTERFACE, HidRequests.SET_IDLE, 5),
+            # no vendor requests
+            (TYPE_VENDOR, RECIPIENT_DEVICE, 0x0a, 0),
+        ]
+        for req_type, recipient, request, index in requests:
+            self.device.handle_request(setup_request(DIR_OUT, req_type, recipient, request, 0, 0, index, 0))
+            self.assertEqual(len(self.events.events), 1)
+            self.assertIsInstance(self.events.events.pop(), StallEp0Event)
+
+    def testRebuiltWhenReset(self):
+        usb_class = self.device.configuration.interfaces[0].usb_class
+        set_idle = setup_request(DIR_OUT, TYPE_CLASS, RECIPIENT_INTERFACE, HidRequests.SET_IDLE, 0, 0, 0, 0)
+        self.device.handle_request(set_idle)
+        self.get_single_response(0, 0)
+        routes = self.device.request_routes
+        requests = []
+
+        def handle_set_idle(req):
+            requests.append(req)
+            return b'\x01'
+
+        usb_class.local_handlers[HidRequests.SET_IDLE] = handle_set_idle
+        # the routes are bound to the handlers when built
+        self.device.handle_request(set_idle)
+        self.get_single_response(0, 0)
+        self.assertEqual(requests, [])
+        self.device.request_routes = None
+        self.device.handle_request(set_idle)
+        self.get_single_response(0, 1)
+        self.assertEqual(len(requests), 1)
+        self.assertIsNot(self.device.request_routes, routes)
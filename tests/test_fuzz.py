@@ -0,0 +1,306 @@
+'''
+Tests for the mutations served to numapfuzz by the fuzzer,
+and for the fuzzer running inside numapfuzz (--local)
+'''
+
+import copy
+import time
+import unittest
+from threading import Thread, Event
+from unittest.mock import patch
+from numap.apps import fuzz
+from numap.apps.fuzz import NumapFuzzApp
+from numap.fuzz.controller import UmapController
+from numap.fuzz.fuzz_engine import NumapClientFuzzer
+from numap.fuzz.triggers import QueueTriggerReceiver
+
+
+class Rendered(bytes):
+
+    def tobytes(self):
+        return bytes(self)
+
+
+class StubNode(object):
+    '''
+    Template-like node of the fuzz path
+    '''
+
+    def __init__(self, name, payload=b''):
+        self.name = name
+        self.payload = payload
+        self.renders = 0
+        self._current_index = 0
+
+    def get_name(self):
+        return self.name
+
+    def render(self):
+        self.renders += 1
+        return Rendered(self.payload)
+
+
+class StubEdge(object):
+
+    def __init__(self, dst):
+        self.dst = dst
+
+
+class StubTarget(object):
+
+    def __init__(self):
+        self.mutated = 0
+
+    def signal_mutated(self):
+        self.mutated += 1
+
+
+class StubClientFuzzer(NumapClientFuzzer):
+    '''
+    Client fuzzer in the middle of a test, without a model or a session
+    '''
+
+    def __init__(self, fuzz_path):
+        super(StubClientFuzzer, self).__init__()
+        self.running = True
+        self.target = StubTarget()
+        self._fuzz_path = [StubEdge(node) for node in fuzz_path]
+        self._index_in_path = 0
+
+    def _keep_running(self):
+        return self.running
+
+
+class NumapClientFuzzerTests(unittest.TestCase):
+
+    def get_fuzzer(self):
+        # the second hit of device_descriptor is mutated (see fuzz_engine.add_stage)
+        return StubClientFuzzer([StubNode('device_descriptor'), StubNode('device_descriptor', b'\x12\x01mutated')])
+
+    def testTestMutations(self):
+        fuzzer = self.get_fuzzer()
+        expected = {'device_descriptor': {'skip': 1, 'payload': b'\x12\x01mutated'}}
+        self.assertEqual(fuzzer.get_test_mutations(), expected)
+        # rendered once per test
+        self.assertEqual(fuzzer.get_test_mutations(), expected)
+        self.assertEqual(fuzzer._fuzz_path[-1].dst.renders, 1)
+        self.assertEqual(fuzzer.target.mutated, 0)
+        fuzzer.signal_test_mutation_served()
+        self.assertEqual(fuzzer.target.mutated, 1)
+
+    def testNoMutationsWhenDone(self):
+        fuzzer = self.get_fuzzer()
+        fuzzer.running = False
+        self.assertEqual(fuzzer.get_test_mutations(), {})
+
+    def testReportStagesLikeGetMutation(self):
+        stages = ['device_descriptor', 'device_descriptor', 'configuration_descriptor', 'device_descriptor']
+        requested = self.get_fuzzer()
+        for stage in stages:
+            requested.get_mutation(stage, None)
+        reported = self.get_fuzzer()
+        reported.get_test_mutations()
+        # the RPC layer sends the stage names as bytes
+        reported.report_stages([stage.encode() for stage in stages])
+        self.assertEqual(reported._requested_stages, requested._requested_stages)
+        self.assertEqual(reported._requested_stages, [
+            ('device_descriptor', None),
+            ('device_descriptor', b'\x12\x01mutated'),
+            ('configuration_descriptor', None),
+            ('device_descriptor', b'\x12\x01mutated'),
+        ])
+        self.assertEqual(reported._last_payload, b'\x12\x01mutated')
+
+
+class StubRpcClient(object):
+    '''
+    Records the calls numapfuzz makes to the fuzzer
+    '''
+
+    def __init__(self, test_mutations):
+        self.test_mutations = test_mutations
+        self.calls = []
+
+    def get_test_mutations(self):
+        self.calls.append(('get_test_mutations',))
+        if isinstance(self.test_mutations, Exception):
+            raise self.test_mutations
+        # decoded anew on each call, like over RPC
+        return copy.deepcopy(self.test_mutations)
+
+    def signal_test_mutation_served(self):
+        self.calls.append(('signal_test_mutation_served',))
+        return True
+
+    def report_stages(self, stages):
+        self.calls.append(('report_stages', list(stages)))
+        return True
+
+    def get_mutation(self, stage, data):
+        self.calls.append(('get_mutation', stage, data))
+        return b'rendered %s' % stage.encode()
+
+
+class PrefetchTests(unittest.TestCase):
+
+    def get_app(self, test_mutations):
+        with patch('sys.argv', ['numapfuzz', '-C', 'keyboard', '-q']):
+            app = NumapFuzzApp(fuzz.__doc__)
+        app.fuzzer = StubRpcClient(test_mutations)
+        return app
+
+    def get_test_mutations(self):
+        return {'device_descriptor': {'skip': 1, 'payload': b'\x12\x01mutated'}}
+
+    def testSkipCount(self):
+        app = self.get_app(self.get_test_mutations())
+        self.assertIsNone(app.get_mutation('device_descriptor'))
+        self.assertEqual(app.get_mutation('device_descriptor'), b'\x12\x01mutated')
+        self.assertEqual(app.get_mutation('device_descriptor'), b'\x12\x01mutated')
+        self.assertEqual(app.fuzzer.calls, [('get_test_mutations',), ('signal_test_mutation_served',)])
+
+    def testStageNotPrefetched(self):
+        app = self.get_app(self.get_test_mutations())
+        self.assertIsNone(app.get_mutation('configuration_descriptor'))
+        self.assertEqual(app.fuzzer.calls, [('get_test_mutations',)])
+
+    def testEndTestReportsStages(self):
+        app = self.get_app(self.get_test_mutations())
+        for stage in ('device_descriptor', 'configuration_descriptor', 'device_descriptor'):
+            app.get_mutation(stage)
+        app.end_test()
+        self.assertEqual(app.fuzzer.calls[-1], (
+            'report_stages', ['device_descriptor', 'configuration_descriptor', 'device_descriptor']
+        ))
+        # the next test fetches its own mutations
+        app.fuzzer.calls = []
+        app.end_test()
+        self.assertEqual(app.fuzzer.calls, [])
+        self.assertIsNone(app.get_mutation('device_descriptor'))
+        self.assertEqual(app.get_mutation('device_descriptor'), b'\x12\x01mutated')
+        self.assertEqual(app.fuzzer.calls, [('get_test_mutations',), ('signal_test_mutation_served',)])
+
+    def testSessionDataReportsStagesFirst(self):
+        app = self.get_app(self.get_test_mutations())
+        app.get_mutation('device_descriptor')
+        self.assertEqual(app.get_mutation('scsi_inquiry_response', {'lun': 0}), b'rendered scsi_inquiry_response')
+        self.assertEqual(app.fuzzer.calls, [
+            ('get_test_mutations',),
+            ('report_stages', ['device_descriptor']),
+            ('get_mutation', 'scsi_inquiry_response', {'lun': 0}),
+        ])
+        app.end_test()
+        self.assertEqual(len(app.fuzzer.calls), 3)
+
+    def testFallbackWithoutPrefetch(self):
+        app = self.get_app(AttributeError('get_test_mutations'))
+        with self.assertLogs(app.logger, 'WARNING'):
+            self.assertEqual(app.get_mutation('device_descriptor'), b'rendered device_descriptor')
+        self.assertFalse(app.prefetch)
+        self.assertEqual(app.get_mutation('device_descriptor'), b'rendered device_descriptor')
+        self.assertEqual(app.fuzzer.calls, [
+            ('get_test_mutations',),
+            ('get_mutation', 'device_descriptor', {}),
+            ('get_mutation', 'device_descriptor', {}),
+        ])
+        app.end_test()
+        self.assertEqual(len(app.fuzzer.calls), 3)
+
+
+class NullPhy(object):
+
+    def __init__(self):
+        self.events = []
+
+    def connect(self, device):
+        self.events.append('connect')
+
+    def disconnect(self):
+        self.events.append('disconnect')
+
+
+class StubLocalFuzzer(object):
+    '''
+    Kitty fuzzer that is done once told so
+    '''
+
+    def __init__(self, options, controller):
+        self.options = options
+        self.controller = controller
+        self.started = False
+        self.done = Event()
+
+    def start(self):
+        self.started = True
+
+    def wait_until_done(self):
+        self.done.wait()
+
+
+class LocalFuzzerTests(unittest.TestCase):
+
+    def setUp(self):
+        with patch('sys.argv', ['numapfuzz', '--local', '-C', 'keyboard', '-s', 'keyboard.stages', '-q']):
+            self.app = NumapFuzzApp(fuzz.__doc__)
+        self.app.phy = NullPhy()
+        self.app.dev = None
+        self.stack = None
+
+    def tearDown(self):
+        if self.stack is not None:
+            self.app.stop_requested = True
+            self.stack.join(5)
+
+    def start_stack(self):
+        '''
+        Run the should_stop_phy loop of the phy in a thread
+        '''
+        def serve():
+            while not self.app.should_stop_phy():
+                time.sleep(0.001)
+
+        self.stack = Thread(target=serve)
+        self.stack.daemon = True
+        self.stack.start()
+
+    def testQueueTransport(self):
+        controller = UmapController(trigger_mode='local')
+        controller.setup()
+        self.app.triggers = QueueTriggerReceiver(controller.triggers)
+        self.app.fuzzer = StubRpcClient({})
+        self.app.get_mutation('device_descriptor')
+        self.start_stack()
+        controller.trigger()
+        self.assertEqual(self.app.phy.events, ['disconnect', 'connect'])
+        # the stages of the test are reported when disconnecting
+        self.assertEqual(self.app.fuzzer.calls[-1], ('report_stages', ['device_descriptor']))
+        end = time.time() + 5
+        while not controller.get_last_heartbeat():
+            self.assertLess(time.time(), end)
+            time.sleep(0.01)
+        controller.trigger_disconnect()
+        controller.trigger_stop()
+        self.stack.join(5)
+        self.assertFalse(self.stack.is_alive())
+        self.assertTrue(self.app.stop_requested)
+        self.assertEqual(self.app.phy.events, ['disconnect', 'connect', 'disconnect'])
+        controller.teardown()
+
+    def testStopWhenDone(self):
+        with patch('numap.fuzz.fuzz_engine.get_fuzzer', StubLocalFuzzer):
+            fuzzer = self.app.get_fuzzer()
+        self.app.fuzzer = fuzzer
+        self.assertTrue(fuzzer.started)
+        self.assertEqual(fuzzer.options['--stage-file'], 'keyboard.stages')
+        self.assertEqual(fuzzer.options['--count'], '2')
+        self.assertEqual(fuzzer.controller.trigger_mode, 'local')
+        self.assertIsInstance(self.app.triggers, QueueTriggerReceiver)
+        self.assertIs(self.app.triggers.sender, fuzzer.controller.triggers)
+        self.start_stack()
+        time.sleep(0.05)
+        self.assertTrue(self.stack.is_alive())
+        fuzzer.done.set()
+        self.stack.join(5)
+        self.assertFalse(self.stack.is_alive())
+        self.assertTrue(self.app.stop_requested)
+        self.assertEqual(self.app.phy.events, [])
@@ -0,0 +1,51 @@
+'''
+Tests for the handler latency instrumentation
+'''
+
+import unittest
+from infra_event_handler import EventHandler
+from infra_app import TestApp
+from numap.phy.vhost import VirtualHostPhy
+from numap.utils.latency import LatencyRecorder, Histogram, set_latency_recorder
+
+
+class LatencyTests(unittest.TestCase):
+
+    def tearDown(self):
+        set_latency_recorder(None)
+
+    def testHistogram(self):
+        histogram = Histogram()
+        for seconds in [2e-6, 2e-6, 3e-3, 20.0]:
+            histogram.add(seconds)
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.max, 20.0)
+        self.assertEqual(histogram.percentile(0.5), 2.5e-6)
+        self.assertEqual(histogram.percentile(0.75), 5e-3)
+        self.assertEqual(histogram.percentile(1.0), 20.0)
+
+    def testEnumerationIsTimed(self):
+        recorder = LatencyRecorder()
+        set_latency_recorder(recorder)
+        app = TestApp(event_handler=EventHandler())
+        phy = VirtualHostPhy(app)
+        dev = app.load_device('keyboard', phy)
+        dev.connect()
+        dev.run()
+        set_latency_recorder(None)
+        stages = set(stage for device, stage in recorder.histograms if device == dev.name)
+        self.assertIn('request:handle_get_descriptor_request', stages)
+        self.assertIn('request:handle_set_idle', stages)
+        self.assertIn('stage:device_descriptor', stages)
+        self.assertTrue(any(stage.startswith('ep') for stage in stages))
+
+    def testPrometheusFormat(self):
+        recorder = LatencyRecorder()
+        recorder.record('Dev"ice', 'request:handler', 3e-6)
+        lines = recorder.to_prometheus().splitlines()
+        self.assertIn('# TYPE numap_handler_latency_seconds histogram', lines)
+        labels = 'device="Dev\\"ice",stage="request:handler"'
+        self.assertIn('numap_handler_latency_seconds_bucket{%s,le="2.5e-06"} 0' % labels, lines)
+        self.assertIn('numap_handler_latency_seconds_bucket{%s,le="5e-06"} 1' % labels, lines)
+        self.assertIn('numap_handler_latency_seconds_bucket{%s,le="+Inf"} 1' % labels, lines)
+        self.assertIn('numap_handler_latency_seconds_count{%s} 1' % labels, lines)
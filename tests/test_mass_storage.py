@@ -0,0 +1,387 @@
+'''
+Tests for the SCSI device of the mass storage emulation
+'''
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from infra_event_handler import EventHandler
+from infra_app import TestApp
+from numap.dev.mass_storage import ScsiDevice, DiskImage, OverlayDiskImage, FileDiskImage, SparseDiskImage
+from numap.dev.mass_storage import ScsiCmdStatus, USBMassStorageDevice, read_delta, parse_size
+
+
+def build_cbw(tag, cdb, length=0, direction_in=False):
+    return struct.pack(
+        '<4sIIBBB', b'USBC', tag, length, 0x80 if direction_in else 0x00, 0, len(cdb)
+    ) + cdb.ljust(16, b'\x00')
+
+
+class ScsiDeviceTests(unittest.TestCase):
+
+    block_size = 0x200
+    num_blocks = 64
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.image_file = os.path.join(self.tmp_dir, 'disk.img')
+        with open(self.image_file, 'wb') as f:
+            for i in range(self.num_blocks):
+                f.write(struct.pack('>I', i) * (self.block_size // 4))
+        self.app = TestApp(event_handler=EventHandler())
+        self.disk_image = DiskImage(self.image_file, self.block_size)
+        self.scsi = ScsiDevice(self.app, self.disk_image)
+
+    def tearDown(self):
+        self.scsi.stop()
+        self.disk_image.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def get_data(self, timeout=1.0):
+        item = self.scsi.tx.get(timeout=timeout)
+        return item
+
+    def command(self, tag, cdb, length=0, direction_in=False, data=None):
+        '''
+        Send a command through the worker thread
+
+        :return: (data sent by the device, CSW status)
+        '''
+        self.scsi.put_data(build_cbw(tag, cdb, length, direction_in))
+        if data is not None:
+            self.scsi.put_data(data)
+        received = b''
+        while True:
+            item = bytes(self.get_data())
+            if len(item) == 13 and item[:4] == b'USBS':
+                self.assertEqual(struct.unpack('<I', item[4:8])[0], tag)
+                return received, item[12]
+            received += item
+
+    def testWorkerStops(self):
+        self.scsi.stop()
+        self.assertFalse(self.scsi.thread.is_alive())
+
+    def testTestUnitReady(self):
+        self.assertEqual(self.command(1, b'\x00' * 6), (b'', ScsiCmdStatus.COMMAND_PASSED))
+
+    def testResetDropsPendingData(self):
+        self.scsi.tx.put(b'stale response')
+        self.scsi.handle_reset()
+        self.assertIsNone(self.scsi.get_data())
+        # and the device still serves commands
+        self.assertEqual(self.command(2, b'\x00' * 6), (b'', ScsiCmdStatus.COMMAND_PASSED))
+
+    def testMalformedCbwKeepsWorker(self):
+        self.scsi.put_data(b'USBC')
+        self.assertEqual(self.command(3, b'\x00' * 6), (b'', ScsiCmdStatus.COMMAND_PASSED))
+
+    def testRead10(self):
+        cdb = struct.pack('>BBIBHB', 0x28, 0, 3, 0, 2, 0)
+        data, status = self.command(4, cdb, 2 * self.block_size, True)
+        self.assertEqual(status, ScsiCmdStatus.COMMAND_PASSED)
+        self.assertEqual(data, struct.pack('>I', 3) * (self.block_size // 4) + struct.pack('>I', 4) * (self.block_size // 4))
+
+    def testWrite10(self):
+        cdb = struct.pack('>BBIBHB', 0x2a, 0, 5, 0, 1, 0)
+        payload = b'\xa5' * self.block_size
+        self.assertEqual(self.command(5, cdb, self.block_size, False, payload), (b'', ScsiCmdStatus.COMMAND_PASSED))
+        self.assertEqual(self.disk_image.get_sector_data(5), payload)
+
+    def blocks(self, lba, count):
+        return b''.join(struct.pack('>I', i) * (self.block_size // 4) for i in range(lba, lba + count))
+
+    def testRead6(self):
+        cdb = struct.pack('>BBHBB', 0x08, 0, 7, 3, 0)
+        self.assertEqual(self.command(6, cdb, 3 * self.block_size, True), (self.blocks(7, 3), ScsiCmdStatus.COMMAND_PASSED))
+
+    def testRead12(self):
+        cdb = struct.pack('>BBIIBB', 0xa8, 0, 10, 4, 0, 0)
+        self.assertEqual(self.command(7, cdb, 4 * self.block_size, True), (self.blocks(10, 4), ScsiCmdStatus.COMMAND_PASSED))
+
+    def testRead16(self):
+        cdb = struct.pack('>BBQIBB', 0x88, 0, 60, 4, 0, 0)
+        self.assertEqual(self.command(8, cdb, 4 * self.block_size, True), (self.blocks(60, 4), ScsiCmdStatus.COMMAND_PASSED))
+
+    def testReadOutOfImageFails(self):
+        cdb = struct.pack('>BBIBHB', 0x28, 0, self.num_blocks - 1, 0, 2, 0)
+        self.assertEqual(self.command(9, cdb, 2 * self.block_size, True), (b'', ScsiCmdStatus.COMMAND_FAILED))
+
+    def testGetPacket(self):
+        cdb = struct.pack('>BBIBHB', 0x28, 0, 1, 0, 1, 0)
+        self.scsi.handle_data(build_cbw(10, cdb, self.block_size, True))
+        packets = []
+        while True:
+            packet = self.scsi.get_packet(64)
+            if packet is None:
+                break
+            packets.append(bytes(packet))
+        self.assertEqual([len(p) for p in packets], [64] * (self.block_size // 64) + [13])
+        self.assertEqual(b''.join(packets[:-1]), self.blocks(1, 1))
+
+    def testWrite10MultipleBlocks(self):
+        cdb = struct.pack('>BBIBHB', 0x2a, 0, 20, 0, 3, 0)
+        payload = bytes(bytearray(range(256))) * (3 * self.block_size // 256)
+        self.scsi.put_data(build_cbw(11, cdb, len(payload), False))
+        for offset in range(0, len(payload), 64):
+            self.scsi.put_data(payload[offset:offset + 64])
+        self.assertEqual(bytes(self.get_data())[12], ScsiCmdStatus.COMMAND_PASSED)
+        self.assertEqual(bytes(self.disk_image.get_sectors_view(20, 3)), payload)
+        self.assertEqual(self.disk_image.get_sector_data(23), self.blocks(23, 1))
+
+    def testWrite6(self):
+        cdb = struct.pack('>BBHBB', 0x0a, 0, 30, 2, 0)
+        payload = b'\x5a' * (2 * self.block_size)
+        self.assertEqual(self.command(12, cdb, len(payload), False, payload), (b'', ScsiCmdStatus.COMMAND_PASSED))
+        self.assertEqual(bytes(self.disk_image.get_sectors_view(30, 2)), payload)
+
+    def testWrite12(self):
+        cdb = struct.pack('>BBIIBB', 0xaa, 0, 40, 2, 0, 0)
+        payload = b'\x12' * (2 * self.block_size)
+        self.assertEqual(self.command(13, cdb, len(payload), False, payload), (b'', ScsiCmdStatus.COMMAND_PASSED))
+        self.assertEqual(bytes(self.disk_image.get_sectors_view(40, 2)), payload)
+
+    def testWrite16(self):
+        cdb = struct.pack('>BBQIBB', 0x8a, 0, 50, 2, 0, 0)
+        payload = b'\x16' * (2 * self.block_size)
+        self.assertEqual(self.command(14, cdb, len(payload), False, payload), (b'', ScsiCmdStatus.COMMAND_PASSED))
+        self.assertEqual(bytes(self.disk_image.get_sectors_view(50, 2)), payload)
+
+    def testWriteOutOfImageFails(self):
+        cdb = struct.pack('>BBIBHB', 0x2a, 0, self.num_blocks - 1, 0, 2, 0)
+        payload = b'\xff' * (2 * self.block_size)
+        self.assertEqual(self.command(15, cdb, len(payload), False, payload), (b'', ScsiCmdStatus.COMMAND_FAILED))
+        self.assertEqual(self.disk_image.get_sector_data(self.num_blocks - 1), self.blocks(self.num_blocks - 1, 1))
+        # the data was consumed, the next command is served
+        self.assertEqual(self.command(16, b'\x00' * 6), (b'', ScsiCmdStatus.COMMAND_PASSED))
+
+    def testHugeWriteIsNotBuffered(self):
+        cdb = struct.pack('>BBQIBB', 0x8a, 0, 0, 0xffffffff, 0, 0)
+        self.scsi.handle_data(build_cbw(17, cdb, 2 * self.block_size, False))
+        self.assertIsNone(self.scsi.write_buffer)
+        self.assertEqual(self.scsi.write_length, 2 * self.block_size)
+        self.scsi.handle_data(b'\xff' * (2 * self.block_size))
+        self.assertEqual(bytes(self.get_data())[12], ScsiCmdStatus.COMMAND_FAILED)
+        self.assertEqual(self.disk_image.get_sector_data(0), self.blocks(0, 1))
+        self.assertEqual(self.command(18, b'\x00' * 6), (b'', ScsiCmdStatus.COMMAND_PASSED))
+
+    def testWriteLongerThanTransferFails(self):
+        cdb = struct.pack('>BBIBHB', 0x2a, 0, 8, 0, 4, 0)
+        payload = b'\xee' * self.block_size
+        self.assertEqual(self.command(19, cdb, len(payload), False, payload), (b'', ScsiCmdStatus.COMMAND_FAILED))
+        self.assertEqual(bytes(self.disk_image.get_sectors_view(8, 4)), self.blocks(8, 4))
+        self.assertEqual(self.command(20, b'\x00' * 6), (b'', ScsiCmdStatus.COMMAND_PASSED))
+
+    def testWriteWithoutTransferFails(self):
+        cdb = struct.pack('>BBIBHB', 0x2a, 0, 8, 0, 1, 0)
+        self.scsi.put_data(build_cbw(21, cdb, 0, False))
+        self.scsi.put_data(build_cbw(22, b'\x00' * 6))
+        statuses = [bytes(self.get_data()) for _ in range(2)]
+        self.assertEqual([struct.unpack('<I', csw[4:8])[0] for csw in statuses], [21, 22])
+        self.assertEqual([csw[12] for csw in statuses], [ScsiCmdStatus.COMMAND_FAILED, ScsiCmdStatus.COMMAND_PASSED])
+        self.assertFalse(self.scsi.is_write_in_progress)
+        self.assertEqual(self.disk_image.get_sector_data(8), self.blocks(8, 1))
+
+    def testVerify10(self):
+        cdb = struct.pack('>BBIBHB', 0x2f, 0x02, 2, 0, 2, 0)
+        self.assertEqual(self.command(17, cdb, 2 * self.block_size, False, self.blocks(2, 2)), (b'', ScsiCmdStatus.COMMAND_PASSED))
+        self.assertEqual(self.command(18, cdb, 2 * self.block_size, False, self.blocks(3, 2)), (b'', ScsiCmdStatus.COMMAND_FAILED))
+        # without byte check, only the range is checked
+        cdb = struct.pack('>BBIBHB', 0x2f, 0, 2, 0, 2, 0)
+        self.assertEqual(self.command(19, cdb), (b'', ScsiCmdStatus.COMMAND_PASSED))
+
+    def testSyncIsDeferred(self):
+        cdb = struct.pack('>BBIBHB', 0x2a, 0, 5, 0, 1, 0)
+        self.command(20, cdb, self.block_size, False, b'\xa5' * self.block_size)
+        self.assertTrue(self.disk_image.dirty)
+        self.assertEqual(self.command(21, b'\x35' + b'\x00' * 9), (b'', ScsiCmdStatus.COMMAND_PASSED))
+        self.assertFalse(self.disk_image.dirty)
+        with open(self.image_file, 'rb') as f:
+            f.seek(5 * self.block_size)
+            self.assertEqual(f.read(self.block_size), b'\xa5' * self.block_size)
+
+
+class OverlayDiskImageTests(unittest.TestCase):
+
+    block_size = 0x200
+    num_blocks = 16
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.image_file = os.path.join(self.tmp_dir, 'disk.img')
+        self.delta_file = os.path.join(self.tmp_dir, 'disk.delta')
+        self.base = b''.join(struct.pack('>I', i) * (self.block_size // 4) for i in range(self.num_blocks))
+        with open(self.image_file, 'wb') as f:
+            f.write(self.base)
+        self.disk_image = OverlayDiskImage(self.image_file, self.block_size, self.delta_file)
+
+    def tearDown(self):
+        self.disk_image.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def testWritesAreOverlaid(self):
+        self.disk_image.put_sector_data(3, b'\xa5' * (2 * self.block_size))
+        self.assertEqual(self.disk_image.get_sector_data(4), b'\xa5' * self.block_size)
+        data = bytes(self.disk_image.get_sectors_view(2, 3))
+        self.assertEqual(data[:self.block_size], self.base[2 * self.block_size:3 * self.block_size])
+        self.assertEqual(data[self.block_size:], b'\xa5' * (2 * self.block_size))
+        with open(self.image_file, 'rb') as f:
+            self.assertEqual(f.read(), self.base)
+
+    def testResetDropsWrites(self):
+        self.disk_image.put_sector_data(1, b'\x01' * self.block_size)
+        self.disk_image.reset()
+        self.assertEqual(bytes(self.disk_image.get_sectors_view(0, self.num_blocks)), self.base)
+
+    def testDeltaIsSaved(self):
+        self.disk_image.put_sector_data(1, b'\x01' * self.block_size)
+        self.disk_image.reset()
+        self.disk_image.reset()
+        self.disk_image.put_sector_data(7, b'\x07')
+        self.disk_image.close()
+        self.assertEqual(read_delta(self.delta_file), [
+            (0, {1: b'\x01' * self.block_size}),
+            (2, {7: b'\x07' + b'\x00' * (self.block_size - 1)}),
+        ])
+
+    def testScsiWrite(self):
+        scsi = ScsiDevice(TestApp(event_handler=EventHandler()), self.disk_image)
+        scsi.stop()
+        scsi.handle_data(build_cbw(1, struct.pack('>BBIBHB', 0x2a, 0, 5, 0, 1, 0), self.block_size))
+        scsi.handle_data(b'\x5a' * self.block_size)
+        scsi.handle_data(build_cbw(2, struct.pack('>BBIBHB', 0x28, 0, 5, 0, 1, 0), self.block_size, True))
+        self.assertEqual(bytes(scsi.get_data())[12], ScsiCmdStatus.COMMAND_PASSED)
+        self.assertEqual(bytes(scsi.get_data()), b'\x5a' * self.block_size)
+
+
+class DiskBackendTests(unittest.TestCase):
+
+    block_size = 0x200
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.app = TestApp(event_handler=EventHandler())
+        self.scsi = None
+
+    def tearDown(self):
+        if self.scsi:
+            self.scsi.stop()
+            self.scsi.disk_image.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def command(self, disk_image, cdb, length=0, direction_in=True):
+        if self.scsi is None:
+            self.scsi = ScsiDevice(self.app, disk_image)
+            self.scsi.stop()
+        self.scsi.handle_data(build_cbw(1, cdb, length, direction_in))
+        data = b''
+        while True:
+            item = bytes(self.scsi.get_data())
+            if len(item) == 13 and item[:4] == b'USBS':
+                return data, item[12]
+            data += item
+
+    def testParseSize(self):
+        self.assertEqual(parse_size('64G'), 64 << 30)
+        self.assertEqual(parse_size('1.5T'), 3 << 39)
+        self.assertEqual(parse_size('4096'), 4096)
+        self.assertEqual(parse_size(512), 512)
+
+    def testSparseCapacity(self):
+        disk_image = SparseDiskImage(4 << 40, self.block_size)
+        num_blocks = (4 << 40) // self.block_size
+        self.assertEqual(
+            self.command(disk_image, b'\x25' + b'\x00' * 9, 8),
+            (struct.pack('>II', 0xffffffff, self.block_size), ScsiCmdStatus.COMMAND_PASSED)
+        )
+        data, status = self.command(disk_image, struct.pack('>BBQIBB', 0x9e, 0x10, 0, 32, 0, 0), 32)
+        self.assertEqual(status, ScsiCmdStatus.COMMAND_PASSED)
+        self.assertEqual(data, struct.pack('>QI', num_blocks - 1, self.block_size) + b'\x00' * 20)
+        data, status = self.command(disk_image, struct.pack('>BBIBHB', 0x23, 0, 0, 0, 12, 0), 12)
+        self.assertEqual(data, struct.pack('>IIB', 8, 0xffffffff, 2) + b'\x00\x02\x00')
+
+    def testUnsupportedServiceAction(self):
+        disk_image = SparseDiskImage(64 << 20, self.block_size)
+        # GET LBA STATUS
+        self.assertEqual(
+            self.command(disk_image, struct.pack('>BBQIBB', 0x9e, 0x12, 0, 32, 0, 0), 32),
+            (b'', ScsiCmdStatus.COMMAND_FAILED)
+        )
+
+    def testReadFormatCapacities(self):
+        disk_image = SparseDiskImage(64 << 20, self.block_size)
+        data, status = self.command(disk_image, struct.pack('>BBIBHB', 0x23, 0, 0, 0, 12, 0), 12)
+        self.assertEqual(status, ScsiCmdStatus.COMMAND_PASSED)
+        self.assertEqual(data, struct.pack('>IIB', 8, (64 << 20) // self.block_size, 2) + b'\x00\x02\x00')
+
+    def testSparseReadWrite(self):
+        disk_image = SparseDiskImage(64 << 30, self.block_size)
+        last = disk_image.get_sector_count()
+        self.assertEqual(bytes(disk_image.get_sectors_view(last - 1, 2)), b'\x00' * (2 * self.block_size))
+        disk_image.put_sector_data(last, b'\x42' * self.block_size)
+        self.assertEqual(bytes(disk_image.get_sectors_view(last - 1, 2)), b'\x00' * self.block_size + b'\x42' * self.block_size)
+        disk_image.put_sector_data(last, b'\x00' * self.block_size)
+        self.assertEqual(disk_image.sectors, {})
+        self.assertRaises(ValueError, disk_image.get_sectors_view, last, 2)
+
+    def testFileBackend(self):
+        image_file = os.path.join(self.tmp_dir, 'disk.img')
+        with open(image_file, 'wb') as f:
+            f.write(b'\x11' * (8 * self.block_size))
+        disk_image = FileDiskImage(image_file, self.block_size)
+        self.assertEqual(disk_image.get_sector_count(), 7)
+        disk_image.put_sector_data(2, b'\x22' * (2 * self.block_size))
+        self.assertEqual(bytes(disk_image.get_sectors_view(1, 3)), b'\x11' * self.block_size + b'\x22' * (2 * self.block_size))
+        disk_image.close()
+        with open(image_file, 'rb') as f:
+            self.assertEqual(f.read()[2 * self.block_size:4 * self.block_size], b'\x22' * (2 * self.block_size))
+
+    def testOverlayOnlyWithMmap(self):
+        for disk_backend, disk_size in (('file', None), ('sparse', '1M'), ('vfat', None), ('chunked', None)):
+            with self.assertRaises(Exception) as raised:
+                USBMassStorageDevice(
+                    self.app, None, disk_image_filename=self.tmp_dir, overlay=True,
+                    disk_backend=disk_backend, disk_size=disk_size
+                )
+            self.assertEqual(str(raised.exception), 'The overlay is only supported by the mmap disk backend')
+
+    def testUnknownBackend(self):
+        with self.assertRaises(Exception) as raised:
+            USBMassStorageDevice(self.app, None, disk_backend='nbd')
+        self.assertIn('Unknown disk backend nbd', str(raised.exception))
+
+
+class DiskOptionsTests(unittest.TestCase):
+
+    def get_kwargs(self, dev_name, **options):
+        app = TestApp(event_handler=EventHandler())
+        app.options = dict(('--%s' % name.replace('_', '-'), value) for name, value in options.items())
+        return app.get_user_device_kwargs(dev_name)
+
+    def testDiskBackends(self):
+        self.assertEqual(self.get_kwargs('mass_storage', disk='file:disk.img'), {
+            'disk_backend': 'file', 'disk_image_filename': 'disk.img',
+        })
+        self.assertEqual(self.get_kwargs('mass_storage', disk='sparse:64G'), {
+            'disk_backend': 'sparse', 'disk_size': '64G',
+        })
+
+    def testVfatSize(self):
+        self.assertEqual(self.get_kwargs('mass_storage', disk='vfat:/tmp/payload'), {
+            'disk_backend': 'vfat', 'disk_image_filename': '/tmp/payload',
+        })
+        self.assertEqual(self.get_kwargs('mass_storage', disk='vfat:/tmp/payload:4G'), {
+            'disk_backend': 'vfat', 'disk_image_filename': '/tmp/payload', 'disk_size': '4G',
+        })
+
+    def testOverlay(self):
+        self.assertEqual(self.get_kwargs('mass_storage', overlay=True, overlay_delta='delta.bin'), {
+            'overlay': True, 'overlay_delta_filename': 'delta.bin',
+        })
+
+    def testOtherDeviceClass(self):
+        self.assertEqual(self.get_kwargs('keyboard', vid='0x1234'), {'vid': 0x1234})
+        self.assertRaises(Exception, self.get_kwargs, 'keyboard', disk='sparse:1G')
+        self.assertRaises(Exception, self.get_kwargs, 'keyboard', overlay=True)
@@ -0,0 +1,122 @@
+'''
+Tests for the registry of the fuzzing templates
+'''
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+from numap.fuzz.templates import registry
+from numap.fuzz.templates.registry import REGISTRY_VERSION, TEMPLATE_MODULES, load_registry, get_templates
+
+
+class RegistryTests(unittest.TestCase):
+
+    # the generic module builds no template, its attributes stand for them
+    entries = {
+        'device_descriptor': ['generic', 'Descriptor'],
+        'string_descriptor': ['generic', 'String'],
+    }
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.tmp_dir, 'numap', 'template_registry.json')
+        self.registry = registry.registry
+        registry.registry = None
+        self.builds = 0
+
+    def tearDown(self):
+        registry.registry = self.registry
+        shutil.rmtree(self.tmp_dir)
+
+    def build_registry(self):
+        self.builds += 1
+        return dict(self.entries)
+
+    def load(self):
+        registry.registry = None
+        with patch('numap.fuzz.templates.registry.build_registry', self.build_registry):
+            return load_registry(self.cache_file)
+
+    def read_cache(self):
+        with open(self.cache_file, 'r') as f:
+            return json.load(f)
+
+    def write_cache(self, cached):
+        with open(self.cache_file, 'w') as f:
+            json.dump(cached, f)
+
+    def testCached(self):
+        self.assertEqual(self.load(), self.entries)
+        self.assertEqual(self.builds, 1)
+        cached = self.read_cache()
+        self.assertEqual(cached['version'], REGISTRY_VERSION)
+        self.assertEqual(sorted(cached['stamp']), sorted(TEMPLATE_MODULES))
+        self.assertEqual(cached['templates'], self.entries)
+        self.assertEqual(self.load(), self.entries)
+        self.assertEqual(self.builds, 1)
+
+    def testLoadedOnce(self):
+        entries = self.load()
+        os.remove(self.cache_file)
+        self.assertIs(load_registry(self.cache_file), entries)
+        self.assertFalse(os.path.exists(self.cache_file))
+
+    def testInvalidatedBySize(self):
+        self.load()
+        cached = self.read_cache()
+        cached['stamp']['hid'][0] += 1
+        cached['templates'] = {}
+        self.write_cache(cached)
+        self.assertEqual(self.load(), self.entries)
+        self.assertEqual(self.builds, 2)
+        self.assertEqual(self.read_cache()['stamp'], registry._stamp())
+
+    def testInvalidatedByMtime(self):
+        self.load()
+        cached = self.read_cache()
+        cached['stamp']['enum'][1] -= 10
+        cached['templates'] = {}
+        self.write_cache(cached)
+        self.assertEqual(self.load(), self.entries)
+        self.assertEqual(self.builds, 2)
+
+    def testInvalidatedByVersion(self):
+        self.load()
+        cached = self.read_cache()
+        cached['version'] = REGISTRY_VERSION - 1
+        self.write_cache(cached)
+        self.load()
+        self.assertEqual(self.builds, 2)
+
+    def testCorruptCache(self):
+        os.makedirs(os.path.dirname(self.cache_file))
+        with open(self.cache_file, 'w') as f:
+            f.write('{"version": ')
+        self.assertEqual(self.load(), self.entries)
+        self.assertEqual(self.read_cache()['templates'], self.entries)
+
+    def testCacheNotWritable(self):
+        self.cache_file = os.path.join(self.tmp_dir, 'file', 'template_registry.json')
+        open(os.path.dirname(self.cache_file), 'w').close()
+        with self.assertLogs('numap', 'WARNING'):
+            self.assertEqual(self.load(), self.entries)
+
+    def testNames(self):
+        from numap.fuzz.templates import generic
+        self.load()
+        imported = []
+
+        def import_module(name):
+            imported.append(name)
+            return __import__(name, fromlist=['_'])
+
+        with patch('numap.fuzz.templates.registry.importlib.import_module', import_module):
+            templates = get_templates(['string_descriptor', 'hub_descriptor'])
+            self.assertEqual(list(templates), ['string_descriptor'])
+            self.assertIs(templates['string_descriptor'], generic.String)
+            self.assertEqual(imported, ['numap.fuzz.templates.generic'])
+            self.assertEqual(get_templates([]), {})
+            self.assertEqual(sorted(get_templates()), sorted(self.entries))
@@ -0,0 +1,91 @@
+'''
+Tests for the replay of usbmon captures
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+from infra_event_handler import EventHandler
+from infra_app import TestApp
+from numap.apps.replay import NumapReplayApp, Transfer, extract_transfers, main, __doc__ as replay_doc
+from numap.phy.vhost import VirtualHostPhy
+from numap.phy.usbmon import PcapRingWriter, TracingPhy, Usbmon, UsbmonEvent, read_pcap
+
+
+class ReplayTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'capture.pcap')
+        app = TestApp(event_handler=EventHandler())
+        writer = PcapRingWriter(self.filename)
+        writer.start()
+        dev = app.load_device('keyboard', TracingPhy(VirtualHostPhy(app), writer))
+        dev.connect()
+        dev.run()
+        writer.stop()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def get_app(self, device_name):
+        argv = ['numapreplay', '-C', device_name, '-r', self.filename, '-n', '3', '-q']
+        with patch('sys.argv', argv):
+            return NumapReplayApp(replay_doc)
+
+    def testExtractTransfers(self):
+        transfers = extract_transfers(read_pcap(self.filename))
+        self.assertEqual(transfers[0].kind, Transfer.control)
+        self.assertEqual(transfers[0].setup[:2], (0x80, 0x06))
+        self.assertEqual(transfers[0].expected[:2], b'\x12\x01')
+        # the transfers after SET_ADDRESS are to the new address
+        self.assertIn((0x00, 0x09), [t.setup[:2] for t in transfers if t.kind == Transfer.control])
+        self.assertEqual(extract_transfers(read_pcap(self.filename), devnum=5), [])
+
+    def testOtherDevicesSkipped(self):
+        events = list(read_pcap(self.filename))
+
+        def other_device(urb_id, devnum):
+            # GET_STATUS of a hub port, a completed interrupt IN, and an enumeration at address 0
+            return [
+                UsbmonEvent(0, urb_id, Usbmon.submit, Usbmon.xfer_control, 0x80, devnum, Usbmon.setup_present,
+                            -115, 4, b'\xa3\x00\x00\x00\x01\x00\x04\x00', b''),
+                UsbmonEvent(0, urb_id + 1, Usbmon.complete, Usbmon.xfer_types[3], 0x81, devnum, 0,
+                            Usbmon.status_ok, 1, b'', b'\x02'),
+                UsbmonEvent(0, urb_id, Usbmon.complete, Usbmon.xfer_control, 0x80, devnum, 0,
+                            Usbmon.status_ok, 4, b'', b'\x00\x01\x00\x00'),
+            ]
+
+        def later_enumeration(urb_id):
+            return [
+                UsbmonEvent(0, urb_id, Usbmon.submit, Usbmon.xfer_control, 0x80, 0, Usbmon.setup_present,
+                            -115, 64, b'\x80\x06\x00\x01\x00\x00\x40\x00', b''),
+                UsbmonEvent(0, urb_id, Usbmon.complete, Usbmon.xfer_control, 0x80, 0, 0,
+                            Usbmon.status_ok, 18, b'', b'\x12\x01' + b'\x00' * 16),
+            ]
+
+        middle = len(events) // 2
+        interleaved = (
+            other_device(1000, 1) + events[:middle] + other_device(2000, 9) + events[middle:] + later_enumeration(3000)
+        )
+
+        def summary(transfers):
+            return [(t.kind, t.ep_num, t.setup, bytes(t.data), t.expected, t.expected_stall) for t in transfers]
+
+        self.assertEqual(summary(extract_transfers(interleaved)), summary(extract_transfers(events)))
+
+    def testReplayMatches(self):
+        self.assertEqual(self.get_app('keyboard').run(), 0)
+
+    def testReplayOtherDeviceDiffers(self):
+        self.assertNotEqual(self.get_app('printer').run(), 0)
+
+    def testExitStatus(self):
+        for device_name, status in (('keyboard', 0), ('printer', 1)):
+            argv = ['numapreplay', '-C', device_name, '-r', self.filename, '-q']
+            with patch('sys.argv', argv):
+                with self.assertRaises(SystemExit) as cm:
+                    main()
+            self.assertEqual(cm.exception.code, status)
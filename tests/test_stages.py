@@ -0,0 +1,111 @@
+'''
+Tests for the stage trace
+'''
+
+import os
+import struct
+import unittest
+import tempfile
+from numap.core.usb_device import USBDeviceRequest
+from numap.fuzz.stage_trace import StageLogger, read_stage_trace, write_text_trace
+from numap.fuzz.fuzz_engine import get_stages
+from numap.fuzz import helpers
+from numap.fuzz.helpers import AppMode, set_app_mode, set_stage_logger
+from infra_event_handler import EventHandler
+from infra_app import TestApp
+
+
+class StageTraceTests(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.stages')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def testTraceRoundTrip(self):
+        logger = StageLogger(self.filename)
+        logger.start()
+        logger.log_stage('device_descriptor')
+        logger.new_cycle()
+        logger.log_stage('device_descriptor')
+        logger.log_stage('configuration_descriptor')
+        logger.stop()
+        hits = list(read_stage_trace(self.filename))
+        self.assertEqual([h.seq for h in hits], [0, 1, 2])
+        self.assertEqual([h.cycle for h in hits], [0, 1, 1])
+        self.assertEqual([h.stage for h in hits], ['device_descriptor', 'device_descriptor', 'configuration_descriptor'])
+        self.assertTrue(all(h.timestamp is not None for h in hits))
+
+    def testRequestSummary(self):
+        logger = StageLogger(self.filename)
+        logger.start()
+        logger.log_stage('device_descriptor', USBDeviceRequest(struct.pack('<BBHHH', 0x80, 6, 0x0100, 0, 64)))
+        logger.log_stage('string_descriptor')
+        logger.stop()
+        hits = list(read_stage_trace(self.filename))
+        self.assertEqual(hits[0].request, (0x80, 6, 0x0100, 0, 64))
+        self.assertIsNone(hits[1].request)
+
+    def testDescriptorStageRequest(self):
+        app_mode = helpers.app_mode
+        stage_logger = helpers.stage_logger
+        app = TestApp(event_handler=EventHandler())
+        app.mode = AppMode.record_stages
+        device = app.load_device('keyboard', app.load_phy('test'))
+        logger = StageLogger(self.filename)
+        set_stage_logger(logger)
+        set_app_mode(AppMode.record_stages)
+        try:
+            logger.start()
+            device.handle_request(struct.pack('<BBHHH', 0x80, 6, 0x0100, 0, 0x12))
+            device.handle_request(struct.pack('<BBHHH', 0x80, 6, 0x0302, 0x0409, 0xff))
+            device.get_descriptor()
+            logger.stop()
+        finally:
+            set_app_mode(app_mode)
+            set_stage_logger(stage_logger)
+        hits = list(read_stage_trace(self.filename))
+        self.assertEqual([(h.stage, h.request) for h in hits], [
+            ('device_descriptor', (0x80, 6, 0x0100, 0, 0x12)),
+            ('string_descriptor', (0x80, 6, 0x0302, 0x0409, 0xff)),
+            ('device_descriptor', None),
+        ])
+
+    def testTextConversion(self):
+        logger = StageLogger(self.filename)
+        logger.start()
+        logger.log_stage('device_descriptor')
+        logger.new_cycle()
+        logger.log_stage('configuration_descriptor')
+        logger.stop()
+        hits = list(read_stage_trace(self.filename))
+        fd, text_filename = tempfile.mkstemp(suffix='.txt')
+        with os.fdopen(fd, 'w') as f:
+            write_text_trace(hits, f)
+        text_hits = list(read_stage_trace(text_filename))
+        os.remove(text_filename)
+        self.assertEqual([(h.seq, h.cycle, h.stage) for h in text_hits], [(h.seq, h.cycle, h.stage) for h in hits])
+
+    def testCountIsPerCycle(self):
+        logger = StageLogger(self.filename)
+        logger.start()
+        for stage in ['device_descriptor', 'string_descriptor', 'string_descriptor']:
+            logger.log_stage(stage)
+        logger.new_cycle()
+        for stage in ['device_descriptor', 'string_descriptor', 'configuration_descriptor']:
+            logger.log_stage(stage)
+        logger.stop()
+        stages = get_stages(self.filename)
+        self.assertEqual(list(stages.items()), [
+            ('device_descriptor', 1),
+            ('string_descriptor', 2),
+            ('configuration_descriptor', 1),
+        ])
+
+    def testLegacyStageFile(self):
+        with open(self.filename, 'w') as f:
+            f.write('device_descriptor\nstring_descriptor\nstring_descriptor\n')
+        stages = get_stages(self.filename)
+        self.assertEqual(list(stages.items()), [('device_descriptor', 1), ('string_descriptor', 2)])
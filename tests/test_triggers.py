@@ -0,0 +1,238 @@
+'''
+Tests for the command channel between the fuzz controller and numapfuzz
+'''
+
+import os
+import time
+import shutil
+import logging
+import tempfile
+import unittest
+from threading import Thread
+from numap.fuzz.triggers import (
+    Command, FileTriggerSender, FileTriggerReceiver, SocketTriggerSender, SocketTriggerReceiver,
+    QueueTriggerSender, QueueTriggerReceiver
+)
+
+
+class BaseTriggerTests(object):
+
+    ack_timeout = 0.05
+
+    def _setUp(self):
+        self.trigger_dir = tempfile.mkdtemp()
+        self.logger = logging.getLogger('numap.test_triggers')
+        self.sender = self.create_sender()
+        self.sender.setup()
+        self.receivers = []
+        self.threads = []
+
+    def tearDown(self):
+        self.sender.teardown()
+        for receiver in self.receivers:
+            receiver.close()
+        for thread in self.threads:
+            thread.join(5)
+        shutil.rmtree(self.trigger_dir)
+
+    def create_receiver(self):
+        receiver = self.receiver_class(self.trigger_dir)
+        receiver.open()
+        self.receivers.append(receiver)
+        return receiver
+
+    def start(self, target, *args):
+        thread = Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+        return thread
+
+    def serve(self, receiver, received, delay=0):
+        command = receiver.wait()
+        received.append(command)
+        time.sleep(delay)
+        receiver.ack(command)
+
+    def wait_for(self, condition, timeout=5):
+        end = time.time() + timeout
+        while not condition():
+            self.assertLess(time.time(), end)
+            time.sleep(0.01)
+
+    def testRoundTrip(self):
+        receiver = self.create_receiver()
+        for command in (Command.disconnect, Command.connect, Command.stop):
+            received = []
+            thread = self.start(self.serve, receiver, received)
+            self.sender.send(command)
+            thread.join(5)
+            self.assertEqual(received, [command])
+        self.assertIsNone(receiver.poll())
+
+    def testSendWaitsForAck(self):
+        receiver = self.create_receiver()
+        thread = self.start(self.sender.send, Command.connect)
+        self.wait_for(lambda: receiver.poll() is not None)
+        time.sleep(self.ack_timeout * 2)
+        self.assertTrue(thread.is_alive())
+        receiver.ack(Command.connect)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def testHeartbeat(self):
+        receiver = self.create_receiver()
+        self.assertEqual(self.sender.get_last_heartbeat(), 0)
+        before = time.time() - 1
+        receiver.heartbeat()
+        self.wait_for(lambda: self.sender.get_last_heartbeat() >= before)
+
+
+class FileTriggerTests(unittest.TestCase, BaseTriggerTests):
+
+    receiver_class = FileTriggerReceiver
+
+    def setUp(self):
+        self._setUp()
+
+    def create_sender(self):
+        return FileTriggerSender(self.trigger_dir, self.logger)
+
+    def testDisconnectBeforeConnect(self):
+        receiver = self.create_receiver()
+        open(os.path.join(self.trigger_dir, FileTriggerSender.trigger_files[Command.connect]), 'a').close()
+        open(os.path.join(self.trigger_dir, FileTriggerSender.trigger_files[Command.disconnect]), 'a').close()
+        self.assertEqual(receiver.poll(), Command.disconnect)
+        receiver.ack(Command.disconnect)
+        self.assertEqual(receiver.poll(), Command.connect)
+
+    def testStackRestart(self):
+        receiver = self.create_receiver()
+        thread = self.start(self.sender.send, Command.connect)
+        self.wait_for(lambda: receiver.poll() == Command.connect)
+        # the stack goes away without an ack, the command is kept for the next one
+        receiver.close()
+        received = []
+        self.serve(self.create_receiver(), received)
+        thread.join(5)
+        self.assertEqual(received, [Command.connect])
+
+    def testHeartbeatWithoutTriggerDir(self):
+        receiver = self.create_receiver()
+        shutil.rmtree(self.trigger_dir)
+        receiver.heartbeat()
+        self.assertEqual(self.sender.get_last_heartbeat(), 0)
+        os.mkdir(self.trigger_dir)
+
+
+class SocketTriggerTests(unittest.TestCase, BaseTriggerTests):
+
+    receiver_class = SocketTriggerReceiver
+
+    def setUp(self):
+        self._setUp()
+
+    def create_sender(self):
+        sender = SocketTriggerSender(self.trigger_dir, self.logger)
+        sender.ack_timeout = self.ack_timeout
+        return sender
+
+    def testAckTimeout(self):
+        receiver = self.create_receiver()
+        received = []
+        self.start(self.serve, receiver, received, self.ack_timeout * 3)
+        with self.assertLogs(self.logger, logging.WARNING) as logs:
+            self.sender.send(Command.connect)
+        self.assertEqual(received, [Command.connect])
+        self.assertTrue(any('still waiting for umap_stack to ack connect' in line for line in logs.output))
+
+    def testWaitForStack(self):
+        thread = self.start(self.sender.send, Command.connect)
+        with self.assertLogs(self.logger, logging.WARNING) as logs:
+            self.wait_for(lambda: logs.output)
+        self.assertIn('still waiting for umap_stack to connect', logs.output[0])
+        received = []
+        self.serve(self.create_receiver(), received)
+        thread.join(5)
+        self.assertEqual(received, [Command.connect])
+
+    def testStackReconnect(self):
+        receiver = self.create_receiver()
+        thread = self.start(self.sender.send, Command.disconnect)
+        self.assertEqual(receiver.wait(), Command.disconnect)
+        # the stack goes away without an ack, the command is sent again to the next one
+        receiver.close()
+        received = []
+        self.serve(self.create_receiver(), received)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(received, [Command.disconnect])
+
+    def testControllerRestart(self):
+        receiver = self.create_receiver()
+        receiver.retry_interval = 0
+        self.wait_for(self.sender.connected.is_set)
+        self.sender.teardown()
+        self.wait_for(lambda: receiver.poll() is None and receiver.sock is None)
+        # no ack or heartbeat while the controller is gone
+        receiver.heartbeat()
+        receiver.ack(Command.connect)
+        self.sender = self.create_sender()
+        self.sender.setup()
+        received = []
+        thread = self.start(self.serve, receiver, received)
+        self.sender.send(Command.connect)
+        thread.join(5)
+        self.assertEqual(received, [Command.connect])
+
+    def testPartialMessages(self):
+        receiver = self.create_receiver()
+        self.wait_for(self.sender.connected.is_set)
+        self.sender.conn.sendall(b'disconn')
+        self.wait_for(lambda: receiver.poll() is None and receiver.buff)
+        self.sender.conn.sendall(b'ect\nconnect\n')
+        received = []
+
+        def poll():
+            command = receiver.poll()
+            if command is not None:
+                received.append(command)
+            return len(received) == 2
+
+        self.wait_for(poll)
+        self.assertEqual(received, [Command.disconnect, Command.connect])
+
+
+class QueueTriggerTests(unittest.TestCase, BaseTriggerTests):
+
+    def setUp(self):
+        self._setUp()
+
+    def create_sender(self):
+        sender = QueueTriggerSender(None, self.logger)
+        sender.ack_timeout = self.ack_timeout
+        return sender
+
+    def create_receiver(self):
+        receiver = QueueTriggerReceiver(self.sender)
+        receiver.open()
+        self.receivers.append(receiver)
+        return receiver
+
+    def testAckTimeout(self):
+        receiver = self.create_receiver()
+        received = []
+        self.start(self.serve, receiver, received, self.ack_timeout * 3)
+        with self.assertLogs(self.logger, logging.WARNING) as logs:
+            self.sender.send(Command.stop)
+        self.assertEqual(received, [Command.stop])
+        self.assertTrue(any('still waiting for umap_stack to ack stop' in line for line in logs.output))
+
+    def testStaleAckIgnored(self):
+        receiver = self.create_receiver()
+        receiver.ack(Command.disconnect)
+        received = []
+        thread = self.start(self.serve, receiver, received)
+        self.sender.send(Command.connect)
+        thread.join(5)
+        self.assertEqual(received, [Command.connect])
@@ -0,0 +1,151 @@
+'''
+Tests for the queue logging and the log ring buffer
+'''
+
+import os
+import io
+import shutil
+import logging
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from unittest.mock import patch
+from numap.utils import ulogger
+from numap.utils.ulogger import (
+    HexDump, RingBufferHandler, read_ring_buffer, start_queue_logging, stop_queue_logging, main
+)
+
+
+class CaptureHandler(logging.Handler):
+
+    def __init__(self):
+        super(CaptureHandler, self).__init__()
+        self.setFormatter(logging.Formatter(ulogger.FORMAT))
+        self.messages = []
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+        self.messages.append(self.format(record))
+
+
+class QueueLoggingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = ulogger.numap_logger
+        self.handlers = list(self.logger.handlers)
+        self.level = self.logger.level
+        for handler in self.handlers:
+            self.logger.removeHandler(handler)
+        self.capture = CaptureHandler()
+        self.logger.addHandler(self.capture)
+        self.logger.setLevel(logging.DEBUG)
+
+    def tearDown(self):
+        stop_queue_logging()
+        self.logger.removeHandler(self.capture)
+        for handler in self.handlers:
+            self.logger.addHandler(handler)
+        self.logger.setLevel(self.level)
+
+    def testStartStop(self):
+        start_queue_logging()
+        self.assertNotIn(self.capture, self.logger.handlers)
+        self.assertIn(self.capture, ulogger.queue_listener.handlers)
+        self.logger.info('queued %d', 1)
+        stop_queue_logging()
+        self.assertIsNone(ulogger.queue_listener)
+        self.assertEqual(self.logger.handlers, [self.capture])
+        self.assertEqual(self.capture.messages, ['[INFO  ] queued 1'])
+        self.logger.info('direct')
+        self.assertEqual(self.capture.messages[-1], '[INFO  ] direct')
+
+    def testStartTwice(self):
+        start_queue_logging()
+        listener = ulogger.queue_listener
+        start_queue_logging()
+        self.assertIs(ulogger.queue_listener, listener)
+        self.assertEqual(len(self.logger.handlers), 1)
+
+    def testArgumentsRenderedWhenQueued(self):
+        start_queue_logging()
+        buf = bytearray(b'\x01\x02\x03')
+        self.logger.debug('data: %s %s', HexDump(buf), HexDump(memoryview(buf)[1:]))
+        buf[:] = b'\xff\xff\xff'
+        stop_queue_logging()
+        self.assertEqual(self.capture.messages, ['[DEBUG ] data: 010203 0203'])
+        self.assertIsNone(self.capture.records[0].args)
+
+    def testExceptionText(self):
+        start_queue_logging()
+        try:
+            raise ValueError('oops')
+        except ValueError:
+            self.logger.exception('failed')
+        stop_queue_logging()
+        record = self.capture.records[0]
+        self.assertIsNone(record.exc_info)
+        self.assertIn('ValueError: oops', record.exc_text)
+        self.assertIn('ValueError: oops', self.capture.messages[0])
+
+
+class RingBufferTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'numap.logring')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def emit(self, handler, levelno, msg):
+        handler.handle(logging.LogRecord('numap', levelno, __file__, 0, msg, None, None))
+
+    def testReadBack(self):
+        handler = RingBufferHandler(self.filename)
+        self.emit(handler, logging.INFO, 'first')
+        self.emit(handler, logging.ERROR, 'second ü')
+        handler.flush()
+        records = list(read_ring_buffer(self.filename))
+        self.assertEqual([(levelno, msg) for _, levelno, msg in records], [
+            (logging.INFO, 'first'), (logging.ERROR, 'second ü'),
+        ])
+        self.assertLessEqual(records[0][0], records[1][0])
+
+    def testCapacityEviction(self):
+        entry_size = RingBufferHandler.record_header.size + len('record 0')
+        handler = RingBufferHandler(self.filename, capacity=entry_size * 3)
+        for i in range(10):
+            self.emit(handler, logging.DEBUG, 'record %d' % i)
+        self.assertEqual(handler.size, entry_size * 3)
+        handler.flush()
+        self.assertEqual(
+            [msg for _, _, msg in read_ring_buffer(self.filename)], ['record 7', 'record 8', 'record 9']
+        )
+
+    def testLastRecordKept(self):
+        handler = RingBufferHandler(self.filename, capacity=4)
+        self.emit(handler, logging.INFO, 'larger than the capacity')
+        handler.flush()
+        self.assertEqual([msg for _, _, msg in read_ring_buffer(self.filename)], ['larger than the capacity'])
+
+    def testNotRingBuffer(self):
+        with open(self.filename, 'wb') as f:
+            f.write(b'not a ring buffer')
+        self.assertRaises(ValueError, list, read_ring_buffer(self.filename))
+
+    def testMain(self):
+        handler = RingBufferHandler(self.filename)
+        self.emit(handler, logging.INFO, 'first')
+        self.emit(handler, logging.ERROR, 'second')
+        handler.flush()
+        out = io.StringIO()
+        with patch('sys.argv', ['numap-logring', self.filename]), redirect_stdout(out):
+            main()
+        self.assertEqual(out.getvalue(), 'first\nsecond\n')
+
+    def testMainUsage(self):
+        with patch('sys.argv', ['numap-logring']):
+            with self.assertRaises(SystemExit) as cm:
+                main()
+        self.assertIn('numap-logring FILE', str(cm.exception.code))
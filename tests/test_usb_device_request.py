@@ -0,0 +1,57 @@
+'''
+Tests for setup request parsing
+'''
+
+import unittest
+import struct
+from numap.core.usb import Request
+from numap.core.usb_device import USBDeviceRequest
+
+
+class SetupRequestObject(object):
+    '''
+    Request object as created by the facedancer backends
+    '''
+    def __init__(self, request_type, request, value, index, length, data=b''):
+        self.request_type = request_type
+        self.request = request
+        self.value = value
+        self.index = index
+        self.length = length
+        self.data = data
+
+
+class USBDeviceRequestTests(unittest.TestCase):
+
+    def testParseSetupPacket(self):
+        req = USBDeviceRequest(struct.pack('<BBHHH', 0xa1, 0x21, 0x0302, 0x0001, 7))
+        self.assertEqual(req.request_type, 0xa1)
+        self.assertEqual(req.request, 0x21)
+        self.assertEqual(req.value, 0x0302)
+        self.assertEqual(req.index, 0x0001)
+        self.assertEqual(req.length, 7)
+        self.assertEqual(req.get_direction(), Request.direction_device_to_host)
+        self.assertEqual(req.get_type(), Request.type_class)
+        self.assertEqual(req.get_recipient(), Request.recipient_interface)
+        self.assertEqual(req.data, b'')
+
+    def testDataStageIsView(self):
+        buf = bytearray(struct.pack('<BBHHH', 0x21, 0x20, 0, 1, 3) + b'abc')
+        req = USBDeviceRequest(buf)
+        self.assertIsInstance(req.data, memoryview)
+        self.assertEqual(bytes(req.data), b'abc')
+
+    def testEndpointIndex(self):
+        req = USBDeviceRequest(struct.pack('<BBHHH', 0x02, 0x01, 0, 0x83, 0))
+        self.assertEqual(req.get_recipient(), Request.recipient_endpoint)
+        self.assertEqual(req.get_index(), 3)
+
+    def testRaw(self):
+        setup = struct.pack('<BBHHH', 0x80, 0x06, 0x0100, 0, 0x12)
+        self.assertEqual(USBDeviceRequest(setup + b'\x01\x02').raw(), setup)
+
+    def testFromRequestObject(self):
+        req = USBDeviceRequest(SetupRequestObject(0x21, 0x20, 0x1234, 1, 3, b'abc'))
+        self.assertEqual(req.get_type(), Request.type_class)
+        self.assertEqual(req.data, b'abc')
+        self.assertEqual(req.raw(), struct.pack('<BBHHH', 0x21, 0x20, 0x1234, 1, 3))
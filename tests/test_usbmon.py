@@ -0,0 +1,66 @@
+'''
+Tests for the usbmon pcap tracer
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+from infra_event_handler import EventHandler
+from infra_app import TestApp
+from numap.core.usb import State
+from numap.phy.vhost import VirtualHostPhy
+from numap.phy.usbmon import PcapRingWriter, TracingPhy, Usbmon, read_pcap
+
+
+class UsbmonTraceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'trace.pcap')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testEnumerationTrace(self):
+        app = TestApp(event_handler=EventHandler())
+        writer = PcapRingWriter(self.filename)
+        writer.start()
+        phy = TracingPhy(VirtualHostPhy(app), writer)
+        dev = app.load_device('keyboard', phy)
+        dev.connect()
+        dev.run()
+        writer.stop()
+        self.assertEqual(dev.state, State.configured)
+        events = list(read_pcap(self.filename))
+        # each transfer has a submission and a completion
+        self.assertEqual(len(events) % 2, 0)
+        first, response = events[0], events[1]
+        self.assertEqual(first.event_type, Usbmon.submit)
+        self.assertEqual(first.xfer_type, Usbmon.xfer_control)
+        self.assertEqual(first.setup[:2], b'\x80\x06')
+        self.assertEqual(response.event_type, Usbmon.complete)
+        self.assertEqual(response.urb_id, first.urb_id)
+        self.assertEqual(response.data[:2], b'\x12\x01')
+        set_configuration = [e for e in events if e.setup[:2] == b'\x00\x09']
+        self.assertEqual(len(set_configuration), 1)
+        self.assertEqual(set_configuration[0].devnum, dev.address)
+
+    def testRingBufferWrapsAndDrops(self):
+        writer = PcapRingWriter(self.filename, buffer_size=1000, flush_interval=60)
+        writer.start()
+        payloads = [bytes([i]) * 100 for i in range(20)]
+        # the background thread does not drain the buffer when it is half full
+        with patch.object(writer.wakeup, 'set'):
+            for i, payload in enumerate(payloads):
+                writer.write(i, Usbmon.complete, Usbmon.xfer_bulk, 0x81, 1, Usbmon.setup_absent, 0, 100, Usbmon.no_setup, payload)
+                if i == 10:
+                    # only 5 records of 180 bytes fit in the ring buffer
+                    self.assertEqual(writer.dropped, 6)
+                    writer.flush()
+        writer.stop()
+        self.assertEqual(writer.dropped, 6 + 4)
+        ids = [e.urb_id for e in read_pcap(self.filename)]
+        self.assertEqual(ids, [0, 1, 2, 3, 4, 11, 12, 13, 14, 15])
+        self.assertTrue(all(e.data == payloads[e.urb_id] for e in read_pcap(self.filename)))
@@ -0,0 +1,144 @@
+'''
+Tests for the virtual FAT32 disk
+'''
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from numap.dev.vfat import VirtualFatDiskImage
+
+
+class FatReader(object):
+    '''
+    Minimal FAT32 reader, to check the virtual disk
+    '''
+
+    def __init__(self, disk_image):
+        self.disk_image = disk_image
+        boot = self.read(0, 1)
+        self.signature_ok = boot[510:512] == b'\x55\xaa'
+        (self.sector_size, self.spc, self.reserved, self.num_fats) = struct.unpack_from('<HBHB', boot, 11)
+        self.total_sectors, self.fat_sectors = struct.unpack_from('<II', boot, 32)
+        self.root_cluster, = struct.unpack_from('<I', boot, 44)
+        self.fs_type = boot[82:90]
+        self.data_start = self.reserved + self.num_fats * self.fat_sectors
+
+    def read(self, sector, count):
+        return bytes(self.disk_image.get_sectors_view(sector, count))
+
+    def fat_entry(self, cluster, fat=0):
+        sector = self.reserved + fat * self.fat_sectors + cluster * 4 // self.sector_size
+        return struct.unpack_from('<I', self.read(sector, 1), cluster * 4 % self.sector_size)[0] & 0x0fffffff
+
+    def read_chain(self, cluster, size=None):
+        data = b''
+        while 2 <= cluster < 0x0ffffff8:
+            data += self.read(self.data_start + (cluster - 2) * self.spc, self.spc)
+            cluster = self.fat_entry(cluster)
+        return data if size is None else data[:size]
+
+    def list_dir(self, cluster):
+        '''
+        :return: {long name: (attributes, first cluster, size)}
+        '''
+        data = self.read_chain(cluster)
+        entries = {}
+        long_parts = []
+        for offset in range(0, len(data), 32):
+            entry = data[offset:offset + 32]
+            if entry[0] == 0:
+                break
+            if entry[11] == 0x0f:
+                long_parts.insert(0, entry[1:11] + entry[14:26] + entry[28:32])
+                continue
+            if entry[11] & 0x08:
+                continue
+            name = entry[0:8].decode().rstrip()
+            ext = entry[8:11].decode().rstrip()
+            short = name + ('.' + ext if ext else '')
+            if long_parts:
+                raw = b''.join(long_parts)
+                short = raw.decode('utf-16-le').split('\x00')[0]
+                long_parts = []
+            hi, = struct.unpack_from('<H', entry, 20)
+            lo, size = struct.unpack_from('<HI', entry, 26)
+            entries[short] = (entry[11], (hi << 16) | lo, size)
+        return entries
+
+
+class VirtualFatDiskImageTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp_dir, 'payload')
+        os.makedirs(os.path.join(self.src, 'sub dir', 'deeper'))
+        self.files = {
+            'README.TXT': b'hello\n',
+            'a long file name.bin': bytes(bytearray(range(256))) * 100,
+            'empty': b'',
+            os.path.join('sub dir', 'x.y.z'): b'\x42' * 4096,
+            os.path.join('sub dir', 'deeper', 'big.dat'): os.urandom(3 * 4096 + 17),
+        }
+        for name, data in self.files.items():
+            with open(os.path.join(self.src, name), 'wb') as f:
+                f.write(data)
+        self.disk_image = VirtualFatDiskImage(self.src)
+        self.reader = FatReader(self.disk_image)
+
+    def tearDown(self):
+        self.disk_image.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def read_file(self, path):
+        cluster = self.reader.root_cluster
+        parts = path.split(os.sep)
+        for part in parts[:-1]:
+            attr, cluster, size = self.reader.list_dir(cluster)[part]
+            self.assertTrue(attr & 0x10)
+        attr, cluster, size = self.reader.list_dir(cluster)[parts[-1]]
+        return self.reader.read_chain(cluster, size)
+
+    def testBootSector(self):
+        self.assertTrue(self.reader.signature_ok)
+        self.assertEqual(self.reader.fs_type, b'FAT32   ')
+        self.assertEqual(self.reader.total_sectors, self.disk_image.num_blocks)
+        self.assertGreaterEqual((self.reader.total_sectors - self.reader.data_start) // self.reader.spc, 65525)
+        # backup boot sector
+        self.assertEqual(self.reader.read(6, 1), self.reader.read(0, 1))
+
+    def testFiles(self):
+        for name, data in self.files.items():
+            self.assertEqual(self.read_file(name), data, name)
+
+    def testDirectories(self):
+        root = self.reader.list_dir(self.reader.root_cluster)
+        self.assertEqual(sorted(root), sorted(['README.TXT', 'a long file name.bin', 'empty', 'sub dir']))
+        sub = self.reader.list_dir(root['sub dir'][1])
+        self.assertEqual(sub['.'][1], root['sub dir'][1])
+        self.assertEqual(sub['..'][1], 0)
+        deeper = self.reader.list_dir(sub['deeper'][1])
+        self.assertEqual(deeper['..'][1], root['sub dir'][1])
+
+    def testFatCopiesMatch(self):
+        for cluster in range(0, 64):
+            self.assertEqual(self.reader.fat_entry(cluster, 0), self.reader.fat_entry(cluster, 1))
+        # free clusters
+        self.assertEqual(self.reader.fat_entry(self.disk_image.next_free_cluster), 0)
+
+    def testMultiSectorReadSpansRegions(self):
+        data = self.reader.read(0, self.reader.data_start + 16)
+        self.assertEqual(len(data), (self.reader.data_start + 16) * 512)
+
+    def testWritesStayInMemory(self):
+        sector = self.disk_image.data_start + 100 * 8
+        self.disk_image.put_sector_data(sector, b'\x99' * 512)
+        self.assertEqual(self.disk_image.get_sector_data(sector), b'\x99' * 512)
+        self.testFiles()
+
+    def testSize(self):
+        disk_image = VirtualFatDiskImage(self.src, size=1 << 30)
+        self.assertLessEqual(disk_image.size, 1 << 30)
+        self.assertGreater(disk_image.size, (1 << 30) - 4096)
+        self.assertRaises(Exception, VirtualFatDiskImage, self.src, size=1 << 20)
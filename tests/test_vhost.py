@@ -0,0 +1,37 @@
+'''
+Tests for the virtual host phy
+'''
+
+import unittest
+from infra_event_handler import EventHandler
+from infra_app import TestApp
+from numap.core.usb import State
+from numap.phy.vhost import VirtualHostPhy, get_virtual_host_phy
+from numap.phy.hosts import hosts
+
+
+class VirtualHostTests(unittest.TestCase):
+
+    def enumerate(self, device_name, host_name):
+        app = TestApp(event_handler=EventHandler())
+        phy = VirtualHostPhy(app, hosts[host_name]())
+        dev = app.load_device(device_name, phy)
+        dev.connect()
+        dev.run()
+        return dev, phy
+
+    def testEnumerationPerHost(self):
+        for host_name in sorted(hosts):
+            for device_name in ['keyboard', 'printer', 'ftdi']:
+                dev, phy = self.enumerate(device_name, host_name)
+                self.assertEqual(dev.state, State.configured, '%s on %s' % (device_name, host_name))
+                self.assertEqual(phy.completed_sessions, 1)
+                self.assertEqual(dev.address, phy.host.address)
+                self.assertTrue(phy.host.interfaces)
+
+    def testParsePhyString(self):
+        phy = get_virtual_host_phy(None, 'vhost:windows:0')
+        self.assertEqual(phy.host.name, 'windows')
+        self.assertEqual(phy.sessions, 0)
+        self.assertEqual(get_virtual_host_phy(None, 'vhost').host.name, 'linux')
+        self.assertRaises(Exception, get_virtual_host_phy, None, 'vhost:amiga')